@@ -0,0 +1,467 @@
+# cluster.py
+# Runs several SD-MCAN controllers side by side, each owning a region: the
+# edge switches connected to it and the subnets its dhcp_server hands out.
+#
+# Controllers talk to each other over TCP, one JSON message per line. Where
+# each host is attached and which lease it holds is kept in a directory that
+# is split between the controllers by hashing the host's MAC, so every
+# controller only stores its share of the hosts rather than all of them.
+# When a host we have never seen asks for an address, its DHCP packets are
+# held back while we look it up in the directory. If it holds a lease in
+# another region, we adopt that lease so the host keeps its address, and
+# tell the old region to hold the address for it until it lets go.
+#
+# Routing between regions is not handled here: a host that moved keeps its
+# address and is reachable within its new region.
+
+# POX
+from pox.core import core
+from pox.lib.recoco import Task, Select, Timer
+from pox.lib.revent import EventHalt
+from pox.lib.addresses import EthAddr
+
+# general
+import errno
+import json
+import socket
+import time
+import zlib
+
+log = core.getLogger()
+
+# seconds to wait for the directory before serving a new host anyway
+LOOKUP_TIMEOUT = 0.5
+
+# seconds between attempts to reach a peer we are not connected to
+RECONNECT_INTERVAL = 1.0
+
+# seconds between label usage updates
+LABEL_INTERVAL = 10
+
+
+def parse_addr (addr):
+  '''
+  Split "host:port" into (host, port).
+  '''
+
+  host, _, port = addr.rpartition(':')
+  return host or '127.0.0.1', int(port)
+
+
+def directory_node (members, mac):
+  '''
+  The member that keeps the directory record for this MAC. Every member
+  must be given the same member list for this to agree across the cluster.
+  '''
+
+  return members[zlib.crc32(str(mac)) % len(members)]
+
+
+class PeerLink (object):
+  '''
+  Carries messages between cluster members. Members are named by the
+  address they listen on. Each member connects out to every peer and only
+  sends over those connections, and only reads from the connections its
+  peers open to it, so there is never a question of which of two
+  connections to use.
+
+  Does not depend on the recoco loop: whoever drives it selects on
+  readers() and writers() and hands what is ready to service().
+  '''
+
+  def __init__ (self, me, peers, handler):
+    self.me = me
+    self.peers = [p for p in peers if p != me]
+    self.members = sorted(set([me] + self.peers))
+    self.handler = handler  # called with every message received
+
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.listener.bind(parse_addr(me))
+    self.listener.listen(16)
+    self.listener.setblocking(0)
+
+    self.incoming = {}    # socket -> partial line
+    self.outgoing = {}    # peer -> socket
+    self.connecting = {}  # peer -> socket, connect in progress
+    self.queues = dict((p, []) for p in self.peers)  # peer -> [data]
+    self.next_try = {}    # peer -> time of next connect attempt
+    self.sent = 0
+    self.received = 0
+
+  def connected (self):
+    return len(self.outgoing) == len(self.peers)
+
+  def send (self, peer, msg):
+    '''
+    Queue msg for peer. Messages to ourselves are handled right away.
+    '''
+
+    msg['src'] = self.me
+    if peer == self.me:
+      self.handler(msg)
+      return
+    self.queues[peer].append(json.dumps(msg) + '\n')
+    self.sent += 1
+
+  def broadcast (self, msg):
+    for peer in self.peers:
+      self.send(peer, dict(msg))
+
+  def connect (self):
+    '''
+    Start connecting to peers we are not connected to.
+    '''
+
+    now = time.time()
+    for peer in self.peers:
+      if peer in self.outgoing or peer in self.connecting:
+        continue
+      if self.next_try.get(peer, 0) > now:
+        continue
+      s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      s.setblocking(0)
+      err = s.connect_ex(parse_addr(peer))
+      if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        self.connecting[peer] = s
+      else:
+        s.close()
+        self.next_try[peer] = now + RECONNECT_INTERVAL
+
+  def readers (self):
+    return [self.listener] + self.incoming.keys()
+
+  def writers (self):
+    return (self.connecting.values() +
+            [s for p, s in self.outgoing.iteritems() if self.queues[p]])
+
+  def service (self, readable, writable):
+    for s in readable:
+      if s is self.listener:
+        try:
+          conn, _ = self.listener.accept()
+        except socket.error:
+          continue
+        conn.setblocking(0)
+        self.incoming[conn] = ''
+      elif s in self.incoming:
+        self._read(s)
+    for s in writable:
+      peer = self._peer_of(s)
+      if peer is None:
+        continue
+      if peer in self.connecting:
+        del self.connecting[peer]
+        if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+          s.close()
+          self.next_try[peer] = time.time() + RECONNECT_INTERVAL
+          continue
+        self.outgoing[peer] = s
+        log.info('connected to cluster peer %s', peer)
+      self._write(peer, s)
+
+  def _peer_of (self, s):
+    for table in (self.connecting, self.outgoing):
+      for peer, sock in table.iteritems():
+        if sock is s:
+          return peer
+    return None
+
+  def _read (self, s):
+    try:
+      data = s.recv(65536)
+    except socket.error as e:
+      if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return
+      data = ''
+    if not data:
+      del self.incoming[s]
+      s.close()
+      return
+    lines = (self.incoming[s] + data).split('\n')
+    self.incoming[s] = lines.pop()
+    for line in lines:
+      if not line:
+        continue
+      self.received += 1
+      try:
+        msg = json.loads(line)
+      except ValueError:
+        log.warn('bad cluster message: %r', line[:80])
+        continue
+      self.handler(msg)
+
+  def _write (self, peer, s):
+    queue = self.queues[peer]
+    if not queue:
+      return
+    data = ''.join(queue)
+    try:
+      n = s.send(data)
+    except socket.error as e:
+      if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return
+      log.warn('lost cluster peer %s', peer)
+      del self.outgoing[peer]
+      s.close()
+      self.next_try[peer] = time.time() + RECONNECT_INTERVAL
+      return  # the queue stays, it goes out once we reconnect
+    self.queues[peer] = [data[n:]] if n < len(data) else []
+
+  def close (self):
+    for s in ([self.listener] + self.incoming.keys() +
+              self.outgoing.values() + self.connecting.values()):
+      s.close()
+
+
+class Directory (object):
+  '''
+  This member's share of the cluster-wide host directory, and the message
+  handling around it. Records are dicts with the host's mac, ip, the cidr
+  and gateway of the subnet the address came from, the home member that
+  subnet belongs to, the owner member the host is attached to now and the
+  seconds remaining on the lease. Members' clocks need not agree: the
+  remaining time is kept as an expiry in this member's time and turned
+  back into seconds remaining when the record is handed out.
+
+  What happens to leases is left to a region object with adopt(record),
+  moved(mac) and released(mac) methods; resolve(mac, record) is called
+  with the answer to every lookup(mac).
+  '''
+
+  def __init__ (self, link, region, resolve):
+    self.link = link
+    self.me = link.me
+    self.region = region
+    self.resolve = resolve
+    self.records = {}  # MAC -> record, for the MACs this member keeps
+    self.labels = {}   # member -> labels in use there
+    self.lookups = 0
+    self.moves_in = 0
+
+  def node (self, mac):
+    return directory_node(self.link.members, mac)
+
+  # what this member tells the cluster
+  def register (self, record):
+    record = dict(record, op='register', owner=self.me)
+    self.link.send(self.node(record['mac']), record)
+
+  def unregister (self, mac, home):
+    self.link.send(self.node(mac), dict(op='unregister', mac=mac))
+    if home is not None and home != self.me:
+      self.link.send(home, dict(op='released', mac=mac))
+
+  def keeps (self, mac):
+    return self.node(mac) == self.me
+
+  def lookup (self, mac):
+    '''
+    Ask the directory where this MAC was last seen. The answer comes back
+    through resolve(); use keeps() and record() for MACs kept here.
+    '''
+
+    self.lookups += 1
+    self.link.send(self.node(mac), dict(op='lookup', mac=mac))
+
+  def record (self, mac):
+    '''
+    The record kept here for this MAC, or None.
+    '''
+
+    record = self.records.get(mac)
+    if record is None:
+      return None
+    record = dict(record, remaining = record['expires'] - time.time())
+    del record['expires']
+    return record
+
+  def publish_labels (self, count):
+    self.labels[self.me] = count
+    self.link.broadcast(dict(op='labels', count=count))
+
+  def adopt (self, record):
+    '''
+    Take over a host the directory placed in another region, and tell that
+    region it has gone.
+    '''
+
+    self.region.adopt(record)
+    self.moves_in += 1
+    self.link.send(record['owner'], dict(op='moved', mac=record['mac']))
+
+  # what the cluster tells this member
+  def handle (self, msg):
+    op = msg.get('op')
+    src = msg.get('src')
+    mac = msg.get('mac')
+    if op == 'register':
+      del msg['op'], msg['src']
+      msg['expires'] = time.time() + msg.pop('remaining')
+      self.records[mac] = msg
+    elif op == 'unregister':
+      record = self.records.get(mac)
+      if record is not None and record['owner'] == src:
+        del self.records[mac]
+    elif op == 'lookup':
+      self.link.send(src, dict(op='found', mac=mac, record=self.record(mac)))
+    elif op == 'found':
+      self.resolve(mac, msg.get('record'))
+    elif op == 'moved':
+      self.region.moved(mac)
+    elif op == 'released':
+      self.region.released(mac)
+    elif op == 'labels':
+      self.labels[src] = msg.get('count')
+    else:
+      log.warn('unknown cluster message from %s: %s', src, op)
+
+
+class PeerService (Task):
+  '''
+  recoco task that drives the PeerLink.
+  '''
+
+  def __init__ (self, link):
+    Task.__init__(self)
+    self.link = link
+
+  def run (self):
+    link = self.link
+    while core.running:
+      link.connect()
+      rlist, wlist, _ = yield Select(link.readers(), link.writers(), [],
+                                     RECONNECT_INTERVAL)
+      link.service(rlist, wlist)
+    link.close()
+
+
+class Cluster (object):
+  '''
+  POX component that makes this controller one region of a cluster. It
+  sits between topology_tracker and dhcp_server: DHCP packets from hosts
+  dhcp_server doesn't know are held until the directory has been asked
+  about them. Leases dhcp_server hands out or lets go of are registered
+  in the directory.
+  '''
+
+  def __init__ (self, listen, peers):
+    self.link = PeerLink(listen, peers, self._handle_message)
+    self.directory = Directory(self.link, self, self._resolve)
+    self.pending = {}  # MAC -> (deadline, [held DHCPEvents])
+    self.labels = None
+    core.listen_to_dependencies(self, ['topology_tracker', 'dhcp_server'])
+    PeerService(self.link).start()
+    Timer(LOOKUP_TIMEOUT / 2, self._check_pending, recurring=True)
+    Timer(LABEL_INTERVAL, self._publish_labels, recurring=True)
+    log.info('cluster member %s of %s', listen, ', '.join(self.link.members))
+
+  def _all_dependencies_met (self):
+    # get DHCP packets ahead of dhcp_server
+    core.topology_tracker.addListenerByName("DHCPEvent", self._dhcp_PacketIn,
+                                            priority=1)
+    core.dhcp_server.add_renewal_hook(self._renewed)
+
+  def _handle_message (self, msg):
+    self.directory.handle(msg)
+
+  def _dhcp_PacketIn (self, event):
+    if getattr(event, '_sdmcan_cluster', False):
+      return
+    dhcp = core.dhcp_server
+    if not dhcp.edges:
+      return
+    src = event.packetin.parsed.src
+    if dhcp.knows(src):
+      return
+    mac = str(src)
+    directory = self.directory
+    if directory.keeps(mac):
+      directory.lookups += 1
+      self._place(mac, directory.record(mac))
+      return
+    pending = self.pending.get(mac)
+    if pending is None:
+      pending = self.pending[mac] = (time.time() + LOOKUP_TIMEOUT, [])
+      directory.lookup(mac)
+    pending[1].append(event)
+    return EventHalt
+
+  def _place (self, mac, record):
+    '''
+    A host we didn't know showed up, adopt its lease if the directory has
+    it in another region.
+    '''
+
+    if record is not None and record['owner'] != self.link.me:
+      log.info('%s moved here from %s with %s', mac, record['owner'],
+               record['ip'])
+      self.directory.adopt(record)
+
+  def _resolve (self, mac, record):
+    pending = self.pending.pop(mac, None)
+    if pending is None:
+      return  # too late, it was served as a new host
+    self._place(mac, record)
+    tracker = core.topology_tracker
+    for event in pending[1]:
+      event._sdmcan_cluster = True
+      event.halt = False
+      tracker.raiseEventNoErrors(event)
+
+  def _check_pending (self):
+    now = time.time()
+    for mac in [m for m, p in self.pending.iteritems() if p[0] < now]:
+      log.debug('no directory answer for %s in time', mac)
+      self._resolve(mac, None)
+
+  def _publish_labels (self):
+    if not core.hasComponent('route_manager'):
+      return
+    count = len(core.route_manager.label_table)
+    if count != self.labels:
+      self.labels = count
+      self.directory.publish_labels(count)
+
+  # keeping the directory up to date
+  def _handle_dhcp_server_DHCPLease (self, event):
+    dhcp = core.dhcp_server
+    mac = EthAddr(event.mac)
+    subnet, lease = dhcp.find_lease(mac)
+    if event.renew:
+      if subnet is not None:
+        self._register(mac, subnet, lease)
+    elif event.expire:
+      self.directory.unregister(str(mac),
+                                subnet.home if subnet is not None else None)
+
+  def _renewed (self, mac, subnet, lease):
+    # the same address again, the directory only needs the new expiry
+    self._register(mac, subnet, lease)
+
+  def _register (self, mac, subnet, lease):
+    cidr = "%s/%i" % (subnet.pool.network, subnet.pool.network_size)
+    self.directory.register(dict(mac=str(mac), ip=str(lease.ip),
+                                 cidr=cidr, gateway=str(subnet.server.addr),
+                                 home=subnet.home or self.link.me,
+                                 remaining=lease.lastTimeSeen +
+                                 lease.interval - time.time()))
+
+  # region callbacks for the Directory
+  def adopt (self, record):
+    core.dhcp_server.adopt(EthAddr(str(record['mac'])), str(record['ip']),
+                           str(record['cidr']), str(record['gateway']),
+                           str(record['home']), record['remaining'])
+
+  def moved (self, mac):
+    core.dhcp_server.hold(EthAddr(str(mac)))
+
+  def released (self, mac):
+    core.dhcp_server.unhold(EthAddr(str(mac)))
+
+
+def launch (listen = '127.0.0.1:7000', peers = ''):
+  if not core.hasComponent("cluster"):
+    core.register("cluster", Cluster(listen,
+                                     [p for p in peers.split(',') if p]))
@@ -26,15 +26,19 @@ from pox.lib.packet.ethernet import ethernet
 from pox.lib.addresses import IPAddr,EthAddr,parse_cidr,cidr_to_netmask
 from pox.lib.addresses import IP_BROADCAST, IP_ANY
 from pox.lib.revent import Event, EventHalt, EventMixin
-from pox.lib.util import dpid_to_str
+from pox.lib.util import dpid_to_str, str_to_dpid, str_to_bool
 from pox.lib.recoco import Timer
 import route_manager
+import handover
 
 # networkX
 from networkx.algorithms.clique import find_cliques
+from networkx.algorithms.core import core_number
 
 # general
 import time
+import struct
+import random
 from collections import namedtuple
 
 GATEWAY_DUMMY_MAC = '03:00:00:00:be:ef'
@@ -43,12 +47,98 @@ log = core.getLogger()
 # Times (in seconds) to use for differente timouts:
 timeoutSec = dict(
   timerInterval=5,     # Seconds between timer routine activations
-  leaseInterval=60*60  # Time until DHCP leases expire - 1 hour
+  leaseInterval=60*60, # Time until DHCP leases expire - 1 hour
+  offerInterval=60     # Time an offered lease time waits for its REQUEST
   )
 
+# Renewal (T1) and rebinding (T2) times as fractions of the lease time
+RENEW_FRACTION = 0.5
+REBIND_FRACTION = 0.875
+
+# Adaptive leases range from leaseInterval/ADAPTIVE_SCALE for hosts that
+# keep roaming to leaseInterval*ADAPTIVE_SCALE for hosts that stay put
+ADAPTIVE_SCALE = 4
+
 # used in Subnet
 Server = namedtuple('Server', 'dpid addr')
 
+# ways of picking out the core mesh, see find_core()
+CORE_MODES = ('clique', 'kcore', 'config')
+
+# DHCP magic cookie and option codes used when packing reply templates
+DHCP_MAGIC = 0x63825363
+DHCP_LEASE_TIME_OPT = 51
+DHCP_SERVER_ID_OPT = 54
+DHCP_RENEWAL_TIME_OPT = 58
+DHCP_REBINDING_TIME_OPT = 59
+DHCP_END_OPT = 255
+
+
+def _word_sum (data):
+  """
+  Sum of the 16-bit big endian words in data (which has even length).
+  """
+
+  return sum(struct.unpack('!%iH' % (len(data) // 2), data))
+
+
+def _fold (total):
+  """
+  Fold a word sum into a 16-bit one's complement checksum.
+  """
+
+  while total >> 16:
+    total = (total & 0xffff) + (total >> 16)
+  return ~total & 0xffff
+
+
+def switch_graph (graph):
+  """
+  The switches of a topology_tracker graph and the links between them.
+  Hosts are keyed by MAC string, switches by dpid.
+  """
+
+  return graph.subgraph([n for n in graph if not isinstance(n, basestring)])
+
+
+def find_core (switches, mode = 'clique', core_dpids = (), timeout = 1.0):
+  """
+  Pick out the core mesh of a switch-only graph.
+
+  mode is one of:
+    config - use the configured core_dpids
+    kcore  - the main k-core, i.e. the switches of highest core number
+    clique - the largest clique found within timeout seconds
+  """
+
+  if mode == 'config':
+    missing = [dpid for dpid in core_dpids if dpid not in switches]
+    if missing:
+      log.warn('Configured core switches %s not in topology',
+               ','.join(dpid_to_str(d) for d in missing))
+    return [dpid for dpid in core_dpids if dpid in switches]
+
+  if mode == 'kcore':
+    cores = core_number(switches)
+    if not cores:
+      return []
+    k = max(cores.itervalues())
+    return [dpid for dpid in cores if cores[dpid] == k]
+
+  if mode == 'clique':
+    best = []
+    deadline = time.time() + timeout
+    for clique in find_cliques(switches):
+      if len(clique) > len(best):
+        best = clique
+      if time.time() > deadline:
+        log.warn('Clique search stopped after %.1fs, using best clique '
+                 'found so far (%i switches)', timeout, len(best))
+        break
+    return best
+
+  raise RuntimeError("Unknown core mode %s" % (mode,))
+
 
 def ip_for_event (event):
   """
@@ -80,8 +170,8 @@ class LeaseEntry (Alive):
   Holds information for leased IP addresses.
   """
 
-  def __init__ (self, ip):
-    super(LeaseEntry,self).__init__()
+  def __init__ (self, ip, lease_time=timeoutSec['leaseInterval']):
+    super(LeaseEntry,self).__init__(lease_time)
     self.ip = IPAddr(ip)
 
   def __str__(self):
@@ -102,6 +192,17 @@ class LeaseEntry (Alive):
     return not self.__eq__(other)
 
 
+class LeaseHistory (object):
+  """
+  How a client has been using its leases, for adaptive lease times.
+  """
+
+  def __init__ (self, dpid):
+    self.dpid = dpid  # switch the client last asked from
+    self.streak = 0   # renewals since the client last moved
+    self.moves = 0    # recent moves, decays as the client renews in place
+
+
 # unmodified from original dhcpd.py
 class AddressPool (object):
   """
@@ -279,6 +380,8 @@ class DHCPLease (Event):
   """
   Raised when a lease is given
 
+  Renewals of the address a host already holds are not raised, they only
+  refresh the lease and host timestamps (see DHCPDMulti.add_renewal_hook).
   Call nak() to abort this lease
   """
 
@@ -340,6 +443,134 @@ class Subnet (object):
       log.debug("Removing my own IP (%s) from address pool", self.server.addr)
       self.pool.remove(self.server.addr)
 
+    self.replies = ReplyTemplate(self)
+
+    # cluster member this subnet belongs to when it was adopted from a
+    # peer controller (see cluster.py), None for our own subnets
+    self.home = None
+
+
+class ReplyTemplate (object):
+  """
+  Pre-packed DHCP replies for one subnet.
+
+  Every OFFER, ACK and NAK a subnet sends differs only in a handful of
+  fields, so instead of building and packing pkt.ethernet/ipv4/udp/dhcp
+  objects for each reply we keep one packed frame per message type and
+  requested option set. Replies are copies of that frame with the xid,
+  yiaddr, chaddr, lease time and destination patched in. The IP and UDP
+  checksums are updated incrementally from a precomputed partial sum.
+  """
+
+  # offsets into the packed Ethernet/IPv4/UDP/BOOTP frame
+  ETH_DST = 0
+  ETH_SRC = 6
+  IP_CSUM = 24
+  IP_DST = 30
+  UDP_CSUM = 40
+  XID = 46
+  YIADDR = 58
+  CHADDR = 70
+  OPTIONS = 282
+
+  def __init__ (self, subnet):
+    self.server_addr = subnet.server.addr
+    self.opts = {}  # option code -> packed option
+    self.opts[pkt.dhcp.SUBNET_MASK_OPT] = struct.pack('!BB4s',
+        pkt.dhcp.SUBNET_MASK_OPT, 4, IPAddr(subnet.subnet).toRaw())
+    if subnet.server.addr is not None:
+      self.opts[pkt.dhcp.ROUTERS_OPT] = struct.pack('!BB4s',
+          pkt.dhcp.ROUTERS_OPT, 4, subnet.server.addr.toRaw())
+    if subnet.dns_addr is not None:
+      self.opts[pkt.dhcp.DNS_SERVER_OPT] = struct.pack('!BB4s',
+          pkt.dhcp.DNS_SERVER_OPT, 4, subnet.dns_addr.toRaw())
+    self.frames = {} # (msg type, option codes) -> (frame, partial sums)
+
+  def _pack (self, msg_type, codes):
+    """
+    Pack the fixed part of a reply and precompute its checksum sums.
+
+    The lease, renewal and rebinding time options always come first so
+    that their values sit on 16-bit boundaries and can be folded into the
+    UDP checksum directly.
+    """
+
+    options = b''
+    if msg_type != pkt.dhcp.NAK_MSG:
+      options += struct.pack('!BBIBBIBBI', DHCP_LEASE_TIME_OPT, 4, 0,
+                             DHCP_RENEWAL_TIME_OPT, 4, 0,
+                             DHCP_REBINDING_TIME_OPT, 4, 0)
+    options += struct.pack('!BBB', pkt.dhcp.MSG_TYPE_OPT, 1, msg_type)
+    options += struct.pack('!BB4s', DHCP_SERVER_ID_OPT, 4,
+                           self.server_addr.toRaw())
+    for code in codes:
+      options += self.opts[code]
+    options += struct.pack('!B', DHCP_END_OPT)
+
+    bootp = struct.pack('!BBBBIHH4s4s4s4s16s64s128sI', pkt.dhcp.BOOTREPLY,
+                        1, 6, 0, 0, 0, 0, IP_ANY.toRaw(), IP_ANY.toRaw(),
+                        self.server_addr.toRaw(), IP_ANY.toRaw(), b'', b'',
+                        b'', DHCP_MAGIC) + options
+    udp_len = 8 + len(bootp)
+    udp = struct.pack('!HHHH', pkt.dhcp.SERVER_PORT, pkt.dhcp.CLIENT_PORT,
+                      udp_len, 0) + bootp
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + udp_len, 0, 0, 64,
+                     pkt.ipv4.UDP_PROTOCOL, 0, self.server_addr.toRaw(),
+                     IP_ANY.toRaw())
+    eth = struct.pack('!6s6sH', b'\x00' * 6, b'\x00' * 6,
+                      pkt.ethernet.IP_TYPE)
+
+    # partial one's complement sums with every patched field zeroed
+    ip_sum = _word_sum(ip)
+    pseudo = self.server_addr.toRaw() + struct.pack('!BBH', 0,
+        pkt.ipv4.UDP_PROTOCOL, udp_len)
+    udp_sum = _word_sum(pseudo) + _word_sum(udp)
+    lease_off = self.OPTIONS + 2 if msg_type != pkt.dhcp.NAK_MSG else None
+    return (bytearray(eth + ip + udp), ip_sum, udp_sum, lease_off)
+
+  def build (self, msg_type, src_mac, dst_mac, dst_ip, xid, chaddr,
+             yiaddr = None, times = (0, 0, 0), wanted_opts = ()):
+    """
+    Return a packed reply frame for one client.
+
+    times is the (lease, renewal, rebinding) time to hand out.
+    """
+
+    if msg_type == pkt.dhcp.NAK_MSG:
+      codes = ()
+    else:
+      codes = tuple(c for c in (pkt.dhcp.SUBNET_MASK_OPT, pkt.dhcp.ROUTERS_OPT,
+                                pkt.dhcp.DNS_SERVER_OPT)
+                    if c in wanted_opts and c in self.opts)
+    key = (msg_type, codes)
+    template = self.frames.get(key)
+    if template is None:
+      template = self.frames[key] = self._pack(msg_type, codes)
+    frame, ip_sum, udp_sum, lease_off = template
+
+    buf = frame[:]
+    dst_ip = dst_ip.toRaw()
+    chaddr = chaddr.toRaw()
+    yiaddr = yiaddr.toRaw() if yiaddr is not None else IP_ANY.toRaw()
+    buf[self.ETH_DST:self.ETH_DST + 6] = dst_mac.toRaw()
+    buf[self.ETH_SRC:self.ETH_SRC + 6] = src_mac.toRaw()
+    buf[self.IP_DST:self.IP_DST + 4] = dst_ip
+    buf[self.XID:self.XID + 4] = struct.pack('!I', xid)
+    buf[self.YIADDR:self.YIADDR + 4] = yiaddr
+    buf[self.CHADDR:self.CHADDR + 6] = chaddr
+
+    dst_sum = _word_sum(dst_ip)
+    udp_sum += (dst_sum + (xid >> 16) + (xid & 0xffff) + _word_sum(yiaddr) +
+                _word_sum(chaddr))
+    if lease_off is not None:
+      for i,t in enumerate(times):
+        struct.pack_into('!I', buf, lease_off + 6 * i, t)
+        udp_sum += (t >> 16) + (t & 0xffff)
+
+    struct.pack_into('!H', buf, self.IP_CSUM, _fold(ip_sum + dst_sum))
+    struct.pack_into('!H', buf, self.UDP_CSUM, _fold(udp_sum) or 0xffff)
+    return bytes(buf)
+
 
 class DHCPDMulti (EventMixin):
   '''
@@ -348,7 +579,10 @@ class DHCPDMulti (EventMixin):
 
   _eventMixin_events = set([DHCPLease])
 
-  def __init__ (self, network = "192.168.0.0/24", dns = None):
+  def __init__ (self, network = "192.168.0.0/24", dns = None,
+                lease_time = timeoutSec['leaseInterval'], lease_jitter = 0.0,
+                adaptive = False, core_mode = 'clique', core_dpids = (),
+                clique_timeout = 1.0, route_options = None):
 
       # attributes of our network
       self.network, self.network_size = parse_cidr(network)
@@ -356,17 +590,40 @@ class DHCPDMulti (EventMixin):
       self.subnets = {}  # IP -> subnet
       self.core = []
       self.edges = {}
+      self.gateways = set() # gateway IPs of every subnet, adopted ones too
       self.edge_to_tuple = {} # dpid -> (network, core dpid)
       self.mobile_hosts = {} # MAC -> IP
+      self.adopted = {} # MAC -> Subnet, hosts that brought a lease with them
+      self.held = {} # MAC -> (Subnet, IP), leases of hosts now in another region
+
+      # how to find the core mesh
+      if core_mode not in CORE_MODES:
+        raise RuntimeError("core_mode must be one of " + ", ".join(CORE_MODES))
+      self.core_mode = core_mode
+      self.core_dpids = core_dpids
+      self.clique_timeout = clique_timeout
+      self.startup_time = None # seconds from stable to serving
+      self.created = time.time()
+      self.first_ack = None # seconds from coming up to the first ACK
 
       # attributes to track DHCP
-      self.lease_time = timeoutSec['leaseInterval']
+      self.lease_time = lease_time
+      self.lease_jitter = lease_jitter # +/- fraction of the lease time
+      self.adaptive = adaptive # scale leases by how much hosts roam
+      self.history = {} # Eth -> LeaseHistory, only when adaptive
       self.offers = {} # Subnet -> {Eth -> IP we offered}
+      self.offer_times = {} # Eth -> (lease time we offered, when), for the ACK
+      self.renewal_hooks = [] # f(mac, subnet, lease) for quiet renewals
       self.leases = {} # Subnet -> {Eth -> LeaseEntry}
+      self._server_macs = {} # dpid -> EthAddr replies are sent from
       self._t = None
 
       # if this is the first time the server has been started up
       self._first_stable = True
+      self.plan = None # core and edges we serve, see make_plan()
+      self.passive = False # standby controllers wait, see replication.py
+      # launch() options for route_manager, which comes up once we serve
+      self.route_options = dict(route_options or {})
 
       core.listen_to_dependencies(self)
       core.openflow.addListeners(self)
@@ -407,44 +664,74 @@ class DHCPDMulti (EventMixin):
     When the topology is stable, start the DHCP server.
     '''
 
-    graph = event.graph
-    if event.stable and self._first_stable:
-      cliques = find_cliques(graph)
-      core = max(cliques, key=lambda x: len(x))
-      edge_ips = []
-
-      if core is None:
+    if event.stable and self._first_stable and not self.passive:
+      start = time.time()
+      plan = self.make_plan(event.graph)
+      if plan is None:
         log.warn('No core mesh found in this network...')
         return
+      self.start(plan)
+      self.startup_time = time.time() - start
+      log.info('serving %i subnets off a %i switch core (%s) %.3fs after '
+               'stable', len(self.edges), len(self.core), self.core_mode,
+               self.startup_time)
 
-      edges = []
-      [edges.extend([x for x in graph.neighbors(c) if x not in core]) for c in core]
-
-      #edges = [node for node in graph if node not in core and
-      #       not isinstance(node, str)]
-
-      for i,c in enumerate(edges):
-        network_addr = IPAddr(self.network).toUnsigned() | (i << (32 - self.network_size))
-        server_addr = IPAddr(network_addr + 1)
-        edge_ips.append(server_addr)
-        network_addr = IPAddr(network_addr)
-        cidr = "%s/%s" % (str(network_addr), str(self.network_size))
-        pool = SimpleAddressPool(cidr)
-        subnet = Subnet(network = server_addr, pool = pool,
-                        server = Server(c, server_addr),
-                        dns = self.dns_addr, subnet = self.network_size)
-        self.subnets[cidr] = subnet
-        self.edge_to_tuple[c] = (cidr, graph.neighbors(c)[0])
-        self.leases[subnet] = {}
-        self.offers[subnet] = {}
-        log.info('{0} serves subnet {1}'.format(server_addr, network_addr))
+  def make_plan (self, graph):
+    '''
+    Work out the core mesh and the edge switches hanging off it. Returns a
+    plan for start(): the core dpids and the [edge dpid, core uplink] pairs
+    in subnet order, or None if there is no core.
+    '''
 
-      self.core = core
-      self.edges = dict(zip(edges, edge_ips))
-      self._first_stable = False
-      self._t = Timer(timeoutSec['timerInterval'], self._check_leases,
-                      recurring=True)
-      route_manager.launch()
+    switches = switch_graph(graph)
+    core = find_core(switches, self.core_mode, self.core_dpids,
+                     self.clique_timeout)
+    if not core:
+      return None
+
+    # edge switches hang off the core, each gets its own subnet
+    core_set = set(core)
+    edges = []
+    seen = set()
+    for c in core:
+      for x in switches.neighbors(c):
+        if x not in core_set and x not in seen:
+          seen.add(x)
+          edges.append([x, c])
+    return dict(core = list(core), edges = edges)
+
+  def start (self, plan, routes = True):
+    '''
+    Set up a subnet for every edge switch in the plan and start serving.
+    Also launches route_manager unless routes is False.
+    '''
+
+    edge_ips = []
+    for i,(c,uplink) in enumerate(plan['edges']):
+      network_addr = IPAddr(self.network).toUnsigned() | (i << (32 - self.network_size))
+      server_addr = IPAddr(network_addr + 1)
+      edge_ips.append(server_addr)
+      network_addr = IPAddr(network_addr)
+      cidr = "%s/%s" % (str(network_addr), str(self.network_size))
+      pool = SimpleAddressPool(cidr)
+      subnet = Subnet(network = server_addr, pool = pool,
+                      server = Server(c, server_addr),
+                      dns = self.dns_addr, subnet = self.network_size)
+      self.subnets[cidr] = subnet
+      self.edge_to_tuple[c] = (cidr, uplink)
+      self.leases[subnet] = {}
+      self.offers[subnet] = {}
+      log.info('{0} serves subnet {1}'.format(server_addr, network_addr))
+
+    self.plan = plan
+    self.core = plan['core']
+    self.edges = dict(zip([c for c,_ in plan['edges']], edge_ips))
+    self.gateways.update(edge_ips)
+    self._first_stable = False
+    self._t = Timer(timeoutSec['timerInterval'], self._check_leases,
+                    recurring=True)
+    if routes:
+      route_manager.launch(**self.route_options)
 
   def _dhcp_PacketIn (self, event):
     '''
@@ -456,8 +743,10 @@ class DHCPDMulti (EventMixin):
 
     # Is it to us?  (Or at least not specifically NOT to us...)
     ipp = event.parsed.find('ipv4')
+    # unicast renewals go to the gateway, which may be one of a subnet
+    # adopted from another region
     if (ipp.dstip not in (IP_ANY, IP_BROADCAST) and
-       ipp.dstip not in self.edges.values()):
+       ipp.dstip not in self.gateways):
       return
 
     nwp = ipp.payload
@@ -473,12 +762,13 @@ class DHCPDMulti (EventMixin):
     host = graph.node[str(src)]
     if host is not None:
       ip_addr = host['info'].ipaddr
+      if ip_addr is None and src not in self.adopted:
+        # a host that left its old port when it went down comes back with
+        # no address in the topology, its lease still says where it is from
+        ip_addr = self.find_lease(src)[1]
       if ip_addr is not None:
         ip_addr = ip_addr.ip
-        home_subnet = [self.subnets[s] for s in self.subnets if ip_addr
-                          in self.subnets[s].pool.removed]
-        assert len(home_subnet) is 1
-        home_subnet = home_subnet[0]
+        home_subnet = self.get_home_subnet(ip_addr)
         if home_subnet != subnet:
           log.debug('{0} moved from {1} to {2}, is now mobile with {3}'.format(
                    src, home_subnet.server.addr, subnet.server.addr, ip_addr))
@@ -489,11 +779,15 @@ class DHCPDMulti (EventMixin):
           log.debug('{0} moved from {1} to {2}, is now back on home subnet with {3}'.format(
                     src, home_subnet.server.addr, subnet.server.addr, ip_addr))
           del self.mobile_hosts[src]
+      elif src in self.adopted:
+        # a host that brought its lease over from another controller
+        subnet = self.adopted[src]
 
     if t.type == p.DISCOVER_MSG:
       self.exec_discover(event, p, subnet)
     elif t.type == p.REQUEST_MSG:
-      self.exec_request(event, p, subnet)
+      self.exec_request(event, p, subnet,
+                        host.get('info') if host is not None else None)
     elif t.type == p.RELEASE_MSG:
       self.exec_release(event, p, subnet)
 
@@ -504,17 +798,24 @@ class DHCPDMulti (EventMixin):
     Delete outdated flows from switches.
     '''
 
-    ip = event.ip
+    ips = event.ips
     graph = event.graph
 
-    assert ip is not None and graph is not None
-    log.debug("Removing flows for {0}".format(ip))
-    for switch in self.edges:
+    assert ips and graph is not None
+    log.debug("Removing flows for {0}".format(", ".join(map(str, ips))))
+
+    # the deletes for every address go to each switch in one write
+    data = []
+    for ip in ips:
       msg = of.ofp_flow_mod()
       msg.match.dl_type = ethernet.IP_TYPE
       msg.match.nw_dst = ip
       msg.command = of.OFPFC_DELETE
-      graph.node[switch]['connection'].send(msg)
+      data.append(msg.pack())
+    data = b''.join(data)
+    for switch in self.edges:
+      if switch in graph:
+        graph.node[switch]['connection'].send(data)
 
   # verification that component is ready
   def _all_dependencies_met (self):
@@ -526,6 +827,12 @@ class DHCPDMulti (EventMixin):
     Checks for expired leases
     """
 
+    # lease times offered to clients that never asked for them
+    now = time.time()
+    for client, (_, when) in self.offer_times.items():
+      if now - when > timeoutSec['offerInterval']:
+        del self.offer_times[client]
+
     for subnet in self.subnets.itervalues():
       leases = self.leases[subnet]
       for client in leases.keys():
@@ -534,72 +841,106 @@ class DHCPDMulti (EventMixin):
           log.debug("Entry %s: IP address %s expired",
                     str(client), str(lease.ip) )
           subnet.pool.append(lease.ip)
+          self.adopted.pop(client, None)
           ev = DHCPLease(client, lease.ip, expire=True)
           self.raiseEvent(ev)
           del leases[client]
+          self.forget_history(client)
           if ev._nak:
             self.nak(ev)
 
   # helpers for sending DHCP packets
-  def reply (self, event, subnet, msg):
+  def reply (self, event, subnet, msg_type, yiaddr = None, wanted_opts = (),
+             lease = 0):
+    """
+    Send a DHCP reply built from the subnet's reply templates.
+    """
 
-    # fill out the rest of the DHCP packet
     orig = event.parsed.find('dhcp')
-    broadcast = (orig.flags & orig.BROADCAST_FLAG) != 0
-    msg.op = msg.BOOTREPLY
-    msg.chaddr = event.parsed.src
-    msg.htype = 1
-    msg.hlen = 6
-    msg.xid = orig.xid
-    msg.add_option(pkt.DHCP.DHCPServerIdentifierOption(subnet.server.addr))
-
-    # create ethernet header
-    ethp = pkt.ethernet(src=ip_for_event(event),dst=event.parsed.src)
-    ethp.type = pkt.ethernet.IP_TYPE
-    ipp = pkt.ipv4(srcip = subnet.server.addr)
-    ipp.dstip = event.parsed.find('ipv4').srcip
-    if broadcast:
-      ipp.dstip = IP_BROADCAST
-      ethp.dst = pkt.ETHERNET.ETHER_BROADCAST
-
-    # create UDP header
-    ipp.protocol = ipp.UDP_PROTOCOL
-    udpp = pkt.udp()
-    udpp.srcport = pkt.dhcp.SERVER_PORT
-    udpp.dstport = pkt.dhcp.CLIENT_PORT
-
-    # encapsulate and reply to host
-    udpp.payload = msg
-    ipp.payload = udpp
-    ethp.payload = ipp
-    po = of.ofp_packet_out(data=ethp.pack())
+    if (orig.flags & orig.BROADCAST_FLAG) != 0:
+      dst_mac, dst_ip = pkt.ETHERNET.ETHER_BROADCAST, IP_BROADCAST
+    else:
+      dst_mac, dst_ip = event.parsed.src, event.parsed.find('ipv4').srcip
+
+    src_mac = self._server_macs.get(event.dpid)
+    if src_mac is None:
+      src_mac = self._server_macs[event.dpid] = ip_for_event(event)
+
+    times = (lease, int(lease * RENEW_FRACTION), int(lease * REBIND_FRACTION))
+    data = subnet.replies.build(msg_type, src_mac, dst_mac, dst_ip, orig.xid,
+                                event.parsed.src, yiaddr, times, wanted_opts)
+    po = of.ofp_packet_out(data=data)
     po.actions.append(of.ofp_action_output(port=event.port))
     event.connection.send(po)
 
-  def nak (self, event, subnet, msg = None):
-    if msg is None:
-      msg = pkt.dhcp()
-    msg.add_option(pkt.DHCP.DHCPMsgTypeOption(msg.NAK_MSG))
-    msg.siaddr = subnet.server.addr
-    self.reply(event, subnet, msg)
+  def nak (self, event, subnet):
+    self.reply(event, subnet, pkt.dhcp.NAK_MSG)
 
-  def fill (self, wanted_opts, subnet, msg):
+  def lease_for (self, src, dpid):
     """
-    Fill out some options in msg
+    Lease time to give a client.
+
+    Leases are spread by +/- lease_jitter so hosts that arrive together
+    don't all renew together. In adaptive mode, hosts that keep renewing
+    from the same switch get longer leases and hosts that roam get
+    shorter ones.
+    """
+
+    lease = self.lease_time
+    if self.adaptive:
+      h = self.history.get(src)
+      if h is None:
+        h = self.history[src] = LeaseHistory(dpid)
+      elif h.dpid != dpid:
+        h.dpid = dpid
+        h.moves += 1
+        h.streak = 0
+      scale = float(min(1 + h.streak, ADAPTIVE_SCALE)) / (1 + h.moves)
+      lease *= max(scale, 1.0 / ADAPTIVE_SCALE)
+    if self.lease_jitter:
+      lease *= 1 + random.uniform(-self.lease_jitter, self.lease_jitter)
+    return max(int(lease), 1)
+
+  def renewed (self, src):
     """
-    if msg.SUBNET_MASK_OPT in wanted_opts:
-      msg.add_option(pkt.DHCP.DHCPSubnetMaskOption(subnet.subnet))
-    if msg.ROUTERS_OPT in wanted_opts and subnet.server.addr is not None:
-      msg.add_option(pkt.DHCP.DHCPRoutersOption(subnet.server.addr))
-    if msg.DNS_SERVER_OPT in wanted_opts and subnet.dns_addr is not None:
-      msg.add_option(pkt.DHCP.DHCPDNSServersOption(subnet.dns_addr))
-    msg.add_option(pkt.DHCP.DHCPIPAddressLeaseTimeOption(self.lease_time))
+    A client renewed its lease in place.
+    """
+
+    h = self.history.get(src)
+    if h is not None:
+      h.streak += 1
+      h.moves = max(h.moves - 1, 0)
+
+  def add_renewal_hook (self, hook):
+    """
+    Call hook(mac, subnet, lease) whenever a client renews the address the
+    topology already knows it by. These renewals raise no DHCPLease, but
+    anything keeping lease expiry times elsewhere needs the new one.
+    """
+
+    self.renewal_hooks.append(hook)
+
+  def forget_history (self, src):
+    """
+    Drop a client's adaptive history once it holds no lease anywhere. A
+    roaming client's old lease runs out after it moved, and its moves
+    must still count.
+    """
+
+    if src in self.history and self.find_lease(src)[0] is None:
+      del self.history[src]
+
+  def wanted_opts (self, p):
+    """
+    Options the client asked for in its parameter request list
+    """
+    if p.PARAM_REQ_OPT in p.options:
+      return set(p.options[p.PARAM_REQ_OPT].options)
+    return ()
 
   # helpers for different stages in DHCP handshake
   def exec_discover (self, event, p, subnet):
     # creates an OFFER in response to a DISCOVER
-    reply = pkt.dhcp()
-    reply.add_option(pkt.DHCP.DHCPMsgTypeOption(p.OFFER_MSG))
     src = event.parsed.src
 
     # if this host already has a lease
@@ -624,16 +965,14 @@ class DHCPDMulti (EventMixin):
             offer = wanted_ip
         subnet.pool.remove(offer)
         self.offers[subnet][src] = offer
-    reply.yiaddr = offer            # your IP
-    reply.siaddr = subnet.server.addr     # server's IP
 
-    wanted_opts = set()
-    if p.PARAM_REQ_OPT in p.options:
-      wanted_opts.update(p.options[p.PARAM_REQ_OPT].options)
-    self.fill(wanted_opts, subnet, reply)
-    self.reply(event, subnet, reply)
+    # the ACK gives the lease time offered here, so jitter and the adaptive
+    # history are worked out once per transaction
+    lease = self.lease_for(src, event.dpid)
+    self.offer_times[src] = (lease, time.time())
+    self.reply(event, subnet, p.OFFER_MSG, offer, self.wanted_opts(p), lease)
 
-  def exec_request (self, event, p, subnet):
+  def exec_request (self, event, p, subnet, host = None):
     # create and send ACKNOWLEDGE in response to REQUEST
 
     if not p.REQUEST_IP_OPT in p.options:
@@ -646,6 +985,9 @@ class DHCPDMulti (EventMixin):
     dpid = event.connection.dpid
     port = event.port
     got_ip = None
+    refresh = False
+    lease = None
+    offered = self.offer_times.pop(src, (None, None))[0]
 
     # renew
     if src in self.leases[subnet]:
@@ -655,6 +997,9 @@ class DHCPDMulti (EventMixin):
       else:
         got_ip = self.leases[subnet][src]
         got_ip.refresh() # this is a lease renew
+        self.renewed(src)
+        refresh = (host is not None and host.ipaddr is not None and
+                   host.ipaddr.ip == got_ip.ip)
 
     # respond to offer
     if got_ip is None:
@@ -664,6 +1009,7 @@ class DHCPDMulti (EventMixin):
           del self.offers[subnet][src]
         else:
           got_ip = LeaseEntry(self.offers[subnet][src])
+          lease = offered
 
     # new host request
     if got_ip is None:
@@ -677,26 +1023,34 @@ class DHCPDMulti (EventMixin):
       return
 
     assert got_ip == wanted_ip
+    if lease is None:
+      lease = self.lease_for(src, dpid)
+    got_ip.interval = lease
     self.leases[subnet][src] = got_ip
-    ev = DHCPLease(src, got_ip.ip, port, dpid, renew=True)
-    log.debug("%s leased %s to %s" % (subnet.server.addr, got_ip, src))
-    self.raiseEvent(ev)
-    if ev._nak:
-      self.nak(event, subnet)
-      return
 
-    # create ack reply
-    reply = pkt.dhcp()
-    reply.add_option(pkt.DHCP.DHCPMsgTypeOption(p.ACK_MSG))
-    reply.yiaddr = wanted_ip
-    reply.siaddr = subnet.server.addr
-
-    wanted_opts = set()
-    if p.PARAM_REQ_OPT in p.options:
-      wanted_opts.update(p.options[p.PARAM_REQ_OPT].options)
-    self.fill(wanted_opts, subnet, reply)
+    # a renewal of the address the topology already knows this host by
+    # changes nothing but timestamps, so don't fan it out as an event
+    if refresh:
+      host.refresh()
+      host.ipaddr.refresh()
+      host.ipaddr.pings.received()
+      for hook in self.renewal_hooks:
+        hook(src, subnet, got_ip)
+    else:
+      ev = DHCPLease(src, got_ip.ip, port, dpid, renew=True)
+      log.debug("%s leased %s to %s" % (subnet.server.addr, got_ip, src))
+      self.raiseEvent(ev)
+      if ev._nak:
+        self.nak(event, subnet)
+        return
 
-    self.reply(event, subnet, reply)
+    # send ack reply
+    self.reply(event, subnet, p.ACK_MSG, wanted_ip, self.wanted_opts(p),
+               got_ip.interval)
+    handover.mark(src, 'ack')
+    if self.first_ack is None:
+      self.first_ack = time.time() - self.created
+      log.info('first ACK %.3fs after startup', self.first_ack)
 
   def exec_release (self, event, p, subnet):
     src = event.parsed.src
@@ -713,6 +1067,7 @@ class DHCPDMulti (EventMixin):
     log.info("%s released %s from %s" % (subnet.server.addr, p.ciaddr, src))
     self.raiseEvent(ev)
     del self.leases[subnet][p.chaddr]
+    self.forget_history(p.chaddr)
     subnet.pool.append(p.ciaddr)
 
     log.debug("%s released %s" % (src,p.ciaddr))
@@ -730,6 +1085,16 @@ class DHCPDMulti (EventMixin):
     assert len(subnet) == 1
     return subnet[0]
 
+  def get_home_subnet (self, ip):
+    """
+    Get the subnet whose pool this address was taken from.
+    """
+
+    subnet = [self.subnets[s] for s in self.subnets
+              if ip in self.subnets[s].pool.removed]
+    assert len(subnet) == 1
+    return subnet[0]
+
   # functions for identifying switches
   def is_router (self, ip_addr):
     '''
@@ -740,7 +1105,120 @@ class DHCPDMulti (EventMixin):
     match = [ip for ip in self.subnets.itervalues() if ip_addr == ip.server.addr]
     return len(match) == 1
 
+  # sharing leases with other controllers, see cluster.py
+  def find_lease (self, mac):
+    '''
+    Return (subnet, LeaseEntry) for the host with this MAC, or (None, None).
+    '''
+
+    for subnet, leases in self.leases.iteritems():
+      lease = leases.get(mac)
+      if lease is not None:
+        return subnet, lease
+    return None, None
+
+  def knows (self, mac):
+    '''
+    Do we have a lease or an offer out for this MAC?
+    '''
+
+    if mac in self.held:
+      return False
+    for subnet in self.leases:
+      if mac in self.leases[subnet] or mac in self.offers[subnet]:
+        return True
+    return False
+
+  def adopt (self, mac, ip, cidr, gateway, home, remaining = None):
+    '''
+    Take on the lease of a host that moved here from another controller's
+    region, so it keeps its address for the remaining seconds of its lease
+    (a full lease if not known). Subnets of other regions are kept
+    alongside our own, with no server switch of their own. Returns the
+    subnet the lease went into.
+    '''
+
+    ip = IPAddr(ip)
+    held = self.held.pop(mac, None)
+    if held is not None:
+      subnet = held[0]  # one of ours, coming home
+    else:
+      subnet = self.subnets.get(cidr)
+      if subnet is None:
+        network, size = parse_cidr(cidr)
+        gateway = IPAddr(gateway)
+        subnet = Subnet(network = gateway, pool = SimpleAddressPool(cidr),
+                        server = Server(None, gateway),
+                        dns = self.dns_addr, subnet = size)
+        subnet.home = home
+        self.subnets[cidr] = subnet
+        self.gateways.add(gateway)
+        self.leases[subnet] = {}
+        self.offers[subnet] = {}
+        log.info('adopted subnet %s from %s', cidr, home)
+    if ip in subnet.pool:
+      subnet.pool.remove(ip)
+    lease_time = self.lease_time if remaining is None else max(int(remaining),
+                                                                1)
+    self.leases[subnet][mac] = LeaseEntry(ip, lease_time)
+    self.adopted[mac] = subnet
+    if subnet.home is not None:
+      self.mobile_hosts[mac] = ip
+    return subnet
+
+  def hold (self, mac):
+    '''
+    The host with this MAC now leases its address from another controller.
+    Forget our lease, but keep the address out of our pool until the other
+    controller lets it go (see unhold()).
+    '''
+
+    subnet, lease = self.find_lease(mac)
+    if subnet is None:
+      return
+    del self.leases[subnet][mac]
+    self.adopted.pop(mac, None)
+    self.mobile_hosts.pop(mac, None)
+    if subnet.home is None:
+      self.held[mac] = (subnet, lease.ip)
+    else:
+      subnet.pool.append(lease.ip)
+
+  def restore (self, mac, ip, cidr, gateway, home, remaining):
+    '''
+    Put back a lease replicated from the controller we took over from,
+    with the time it had left.
+    '''
+
+    ip = IPAddr(ip)
+    subnet = self.subnets.get(cidr)
+    if subnet is None or home is not None:
+      self.adopt(mac, ip, cidr, gateway, home, remaining)
+      return
+    if ip in subnet.pool:
+      subnet.pool.remove(ip)
+    self.leases[subnet][mac] = LeaseEntry(ip, max(int(remaining), 1))
+
+  def unhold (self, mac):
+    '''
+    The host with this MAC gave up the address it took to another region,
+    put it back in our pool.
+    '''
+
+    held = self.held.pop(mac, None)
+    if held is not None:
+      held[0].pool.append(held[1])
+
 
 # load DHCPDMulti
-def launch (network = "192.168.0.0/24", dns = None):
-  core.register('dhcp_server', DHCPDMulti(network, dns))
+def launch (network = "192.168.0.0/24", dns = None,
+            lease_time = timeoutSec['leaseInterval'], lease_jitter = 0.0,
+            adaptive_leases = False, core_mode = 'clique', core_dpids = '',
+            clique_timeout = 1.0, route_options = None):
+  core_dpids = [str_to_dpid(d) for d in core_dpids.split(',') if d]
+  core.register('dhcp_server', DHCPDMulti(network, dns, int(lease_time),
+                                          float(lease_jitter),
+                                          str_to_bool(adaptive_leases),
+                                          core_mode, core_dpids,
+                                          float(clique_timeout),
+                                          route_options))
@@ -0,0 +1,175 @@
+# flow_stats.py
+# Flow table statistics for SD-MCAN.
+#
+# Every interval seconds, asks every switch for its flow table and its
+# aggregate flow count, all at once: the requests go out together and the
+# replies are taken as they come. With metrics running, the aggregate
+# counts are taken from the replies to its requests instead of asking
+# twice. Each switch's rules are counted by what
+# installed them:
+#
+#   core        - label path rules on core switches (route_manager)
+#   push        - rules at a source edge that push a label
+#   pop         - rules at a destination edge that pop a label
+#   same_subnet - rules between hosts behind the same edge, no label
+#   dhcp        - the rule sending DHCP to the controller (dhcp_server)
+#   arp         - ARP rules (topology_tracker's pings, gateway adverts)
+#   other       - anything else: LLDP, storm_guard's drops, ...
+#
+# This replaces running ovs-ofctl dump-flows on each switch in turn, and
+# works with any OpenFlow 1.0 switch. The aggregate count is kept next to
+# the count of rules in the flow table reply, which should agree.
+#
+# Counts are not fetched when they are read: each switch's row is the one
+# from its last reply, so it can be up to an interval old (more if the
+# switch is slow to answer). Every row has the time its flow table reply
+# came in, and snapshots have the time they were taken, so readers can see
+# how old each row is.
+#
+# From the POX CLI:
+#   core.flow_stats.snapshot()      - the last counts, per switch
+#   core.flow_stats.write(path)     - the same to a .csv or .json file
+# With metrics running they are also served at /flows and /flows.csv (see
+# tools/get_flow_data.py).
+
+# POX
+from pox.core import core
+from pox.lib.recoco import Timer
+from pox.lib.util import dpid_to_str
+from pox.lib.packet.ethernet import ethernet
+import pox.openflow.libopenflow_01 as of
+import pox.lib.packet as pkt
+
+# general
+import json
+import time
+
+from route_manager import path_rule_key
+
+log = core.getLogger()
+
+CLASSES = ('core', 'push', 'pop', 'same_subnet', 'dhcp', 'arp', 'other')
+COLUMNS = ('dpid', 'time', 'flows', 'aggregate') + CLASSES
+
+
+def classify (stats):
+  '''
+  Which of CLASSES the rule in a flow stats entry belongs to.
+  '''
+
+  m, actions = stats.match, stats.actions
+  if path_rule_key(stats) is not None:
+    return 'core'
+  kinds = [type(a) for a in actions]
+  if of.ofp_action_strip_vlan in kinds:
+    return 'pop'
+  if m.dl_type == ethernet.IP_TYPE and m.nw_dst is not None:
+    if of.ofp_action_vlan_vid in kinds:
+      return 'push'
+    if of.ofp_action_dl_addr in kinds:
+      return 'same_subnet'
+  if m.tp_src == pkt.dhcp.CLIENT_PORT and m.tp_dst == pkt.dhcp.SERVER_PORT:
+    return 'dhcp'
+  if m.dl_type == ethernet.ARP_TYPE:
+    return 'arp'
+  return 'other'
+
+
+class FlowStats (object):
+  '''
+  POX component that polls every switch's flow table and counts its rules.
+  '''
+
+  def __init__ (self, interval = 10.0):
+    self.interval = interval
+    # dpid -> the last counts, replaced whole on every reply so they can be
+    # read from another thread
+    self.switches = {}
+    self.aggregates = {}  # dpid -> flow count from the last aggregate reply
+    self.polls = 0
+    core.openflow.addListeners(self)
+    core.addListenerByName("ComponentRegistered", self._registered)
+    if core.hasComponent('metrics'):
+      self._serve(core.metrics)
+    self._t = Timer(interval, self.poll, recurring = True)
+    log.info("counting flows every %ss", interval)
+
+  def _registered (self, event):
+    if event.name == 'metrics':
+      self._serve(event.component)
+
+  def _serve (self, metrics):
+    metrics.add_page('/flows', 'application/json',
+                     lambda: json.dumps(self.snapshot()))
+    metrics.add_page('/flows.csv', 'text/csv', self.csv)
+
+  def poll (self):
+    '''
+    Ask every switch for its flow table, and for its aggregate count
+    unless metrics asks for it already.
+    '''
+
+    aggregate = not core.hasComponent('metrics')
+    for con in core.openflow.connections:
+      con.send(of.ofp_stats_request(body = of.ofp_flow_stats_request()))
+      if aggregate:
+        con.send(of.ofp_stats_request(
+            body = of.ofp_aggregate_stats_request()))
+    self.polls += 1
+
+  def _handle_FlowStatsReceived (self, event):
+    counts = dict.fromkeys(CLASSES, 0)
+    for stats in event.stats:
+      counts[classify(stats)] += 1
+    counts.update(dpid = dpid_to_str(event.dpid), time = time.time(),
+                  flows = len(event.stats),
+                  aggregate = self.aggregates.get(event.dpid))
+    self.switches[event.dpid] = counts
+
+  def _handle_AggregateFlowStatsReceived (self, event):
+    self.aggregates[event.dpid] = event.stats.flow_count
+    counts = self.switches.get(event.dpid)
+    if counts is not None:
+      counts = dict(counts, aggregate = event.stats.flow_count)
+      self.switches[event.dpid] = counts
+
+  def _handle_ConnectionDown (self, event):
+    self.switches.pop(event.dpid, None)
+    self.aggregates.pop(event.dpid, None)
+
+  def snapshot (self):
+    '''
+    The last counts of every switch, and the totals.
+    '''
+
+    switches = [c for _, c in sorted(self.switches.items())]
+    totals = dict((k, sum(c[k] for c in switches)) for k in
+                  ('flows',) + CLASSES)
+    return dict(polls = self.polls, interval = self.interval,
+                time = time.time(), switches = switches, totals = totals,
+                mean = (float(totals['flows']) / len(switches)
+                        if switches else 0.0))
+
+  def csv (self):
+    lines = [','.join(COLUMNS)]
+    for _, c in sorted(self.switches.items()):
+      lines.append(','.join('' if c[k] is None else str(c[k])
+                            for k in COLUMNS))
+    return '\n'.join(lines) + '\n'
+
+  def write (self, path):
+    '''
+    Write the last counts to path, as CSV if it ends in .csv and as JSON
+    otherwise.
+    '''
+
+    with open(path, 'w') as f:
+      if path.endswith('.csv'):
+        f.write(self.csv())
+      else:
+        json.dump(self.snapshot(), f, indent = 2)
+
+
+def launch (interval = 10):
+  if not core.hasComponent("flow_stats"):
+    core.register("flow_stats", FlowStats(float(interval)))
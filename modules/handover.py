@@ -0,0 +1,300 @@
+# handover.py
+# Handover timelines for mobile hosts in SD-MCAN.
+#
+# When a host turns up on a new port, this keeps a timeline of what the
+# controller does about it until the host can talk again:
+#
+#   packet_in   - the first packet-in from the host at its new port
+#   move        - topology_tracker moves the host (update_host(move=True)),
+#                 or the host joins on another port after it left, as it
+#                 does when its old port went down first
+#   flow_delete - the FlowDeleteEvent for the host's old rules
+#   discover    - a DHCP DISCOVER from the host
+#   request     - a DHCP REQUEST from the host
+#   ack         - the DHCP ACK sent back to it
+#   rule        - the first push, pop or same-subnet rule installed for
+#                 traffic to or from the host
+#   forwarded   - the first packet to or from the host sent on by the
+#                 controller
+#
+# A timeline is finished window seconds after it started, or when the host
+# moves again, and then goes into a ring buffer of the last size timelines.
+# Steps are kept as seconds after the first packet-in. A host that leaves
+# is remembered for window seconds, so that turning up somewhere else in
+# that time is still a move; its old rules went with the leave, so those
+# timelines have no flow_delete step.
+#
+# dhcp_server and route_manager report their steps with mark(), which costs
+# a global lookup when tracing is off and a dictionary lookup when no host
+# is moving. Packet-ins are checked against the port each host was last
+# seen on, by raw MAC, before anything parses them.
+#
+# From the POX CLI:
+#   core.handover.snapshot()   - finished timelines and step percentiles
+#   core.handover.dump(path)   - the same, written to a JSON file
+# With metrics running the snapshot is also served at /handover (see
+# tests/walk_tests/walk_test.py).
+
+# POX
+from pox.core import core
+from pox.lib.addresses import EthAddr
+from pox.lib.recoco import Timer
+from pox.lib.util import dpid_to_str
+from pox.lib.packet.ethernet import ethernet
+import pox.lib.packet as pkt
+
+# general
+from collections import deque
+import json
+import struct
+import time
+
+log = core.getLogger()
+
+STEPS = ('packet_in', 'move', 'flow_delete', 'discover', 'request', 'ack',
+         'rule', 'forwarded')
+
+# seconds a packet-in from a new port waits for topology_tracker to call it
+# a move before it is forgotten
+MOVE_TIMEOUT = 1.0
+
+DHCP_STEPS = {pkt.dhcp.DISCOVER_MSG: 'discover',
+              pkt.dhcp.REQUEST_MSG: 'request'}
+
+_tracer = None  # the running Handover, if any
+
+
+def mark (mac, step):
+  '''
+  Note a step in the handover of the host with this MAC, if it is moving.
+  '''
+
+  if _tracer is not None:
+    _tracer.mark(mac, step)
+
+
+def percentile (values, p):
+  '''
+  The p'th percentile of sorted values, by nearest rank.
+  '''
+
+  if not values:
+    return None
+  i = int(round(p / 100.0 * (len(values) - 1)))
+  return values[i]
+
+
+class Trace (object):
+  '''
+  The timeline of one host's move.
+  '''
+
+  def __init__ (self, mac, old, new, start):
+    self.mac = mac     # EthAddr
+    self.old = old     # (dpid, port) it was on
+    self.new = new     # (dpid, port) it turned up on
+    self.start = start
+    self.ip = None
+    self.steps = {}    # step -> time
+
+  def add (self, step, when):
+    if step not in self.steps:
+      self.steps[step] = when
+
+  def to_dict (self):
+    return dict(mac = str(self.mac), ip = self.ip and str(self.ip),
+                old = [dpid_to_str(self.old[0]), self.old[1]],
+                new = [dpid_to_str(self.new[0]), self.new[1]],
+                start = self.start,
+                steps = dict((step, when - self.start)
+                             for step, when in self.steps.iteritems()))
+
+
+class Handover (object):
+  '''
+  POX component that keeps handover timelines for hosts that move.
+  '''
+
+  def __init__ (self, size = 1000, window = 10.0):
+    self.window = window
+    self.where = {}      # raw MAC -> (dpid, port) the host was last seen on
+    self.left = {}       # raw MAC -> ((dpid, port), IP, when) of hosts gone
+    self.open = {}       # raw MAC -> Trace being recorded
+    self.ips = {}        # IP -> raw MAC, for the open traces
+    self.done = deque(maxlen = size)
+    self.finished = 0    # timelines finished, including ones pushed out
+    self.discarded = 0   # port changes topology_tracker didn't call a move
+
+    # before anyone can halt or pool a packet-in
+    core.openflow.addListeners(self, priority=5)
+    # and before dhcp_server halts a DHCPEvent
+    core.listen_to_dependencies(self, ['topology_tracker'],
+                                listen_args={'topology_tracker':
+                                             {'priority':1}})
+    core.addListenerByName("ComponentRegistered", self._registered)
+    if core.hasComponent('metrics'):
+      self._serve(core.metrics)
+    self._t = Timer(1, self._expire, recurring = True)
+
+  def _registered (self, event):
+    if event.name == 'metrics':
+      self._serve(event.component)
+
+  def _serve (self, metrics):
+    metrics.add_page('/handover', 'application/json',
+                     lambda: json.dumps(self.snapshot()))
+
+  # recording
+  def _handle_openflow_PacketIn (self, event):
+    data = event.data
+    if data is None or len(data) < 14:
+      return
+    where = self.where.get(data[6:12])
+    ip = None
+    if where is None:
+      if not self.left:
+        # not a host we know, or not one that could have moved
+        return
+      left = self.left.get(data[6:12])
+      if left is None:
+        return
+      where, ip = left[0], left[1]
+    new = (event.dpid, event.port)
+    if where == new:
+      return
+    raw = data[6:12]
+    trace = self.open.get(raw)
+    if trace is not None and trace.new == new:
+      return
+    if struct.unpack_from('!H', data, 12)[0] == ethernet.LLDP_TYPE:
+      return
+    self._begin(raw, where, new, ip)
+
+  def _begin (self, raw, old, new, ip = None):
+    '''
+    Start a trace. ip is the host's address if it is no longer in the
+    topology.
+    '''
+
+    if raw in self.open:
+      self._finish(raw)
+    trace = self.open[raw] = Trace(EthAddr(raw), old, new, time.time())
+    trace.add('packet_in', trace.start)
+    node = core.topology_tracker.graph.node.get(str(trace.mac))
+    if node is not None and 'info' in node:
+      ipaddr = node['info'].ipaddr
+      if ipaddr is not None:
+        ip = ipaddr.ip
+    if ip is not None:
+      trace.ip = ip
+      self.ips[ip] = raw
+    return trace
+
+  def _finish (self, raw):
+    trace = self.open.pop(raw)
+    if trace.ip is not None and self.ips.get(trace.ip) == raw:
+      del self.ips[trace.ip]
+    if 'move' not in trace.steps:
+      self.discarded += 1
+      return
+    self.done.append(trace)
+    self.finished += 1
+
+  def _expire (self):
+    now = time.time()
+    for raw, trace in self.open.items():
+      if 'move' not in trace.steps:
+        if now - trace.start > MOVE_TIMEOUT:
+          self._finish(raw)
+      elif now - trace.start > self.window:
+        self._finish(raw)
+    for raw, (_, _, when) in self.left.items():
+      if now - when > self.window:
+        del self.left[raw]
+
+  def mark (self, mac, step):
+    if not self.open:
+      return
+    trace = self.open.get(mac.toRaw())
+    if trace is not None:
+      trace.add(step, time.time())
+
+  def _handle_topology_tracker_HostEvent (self, event):
+    host = event.host
+    raw = host.macaddr.toRaw()
+    if event.leave:
+      # it may turn up on another port soon, which is a move; a trace for
+      # a packet-in there already stays open for it
+      gone = (host.dpid, host.port)
+      self.where.pop(raw, None)
+      self.left[raw] = (gone, host.ipaddr and host.ipaddr.ip, time.time())
+      trace = self.open.get(raw)
+      if trace is not None and trace.new == gone:
+        self._finish(raw)
+      return
+    where = (host.dpid, host.port)
+    left = self.left.pop(raw, None) if event.join else None
+    if left is not None and left[0] == where:
+      # back on the port it left, not a move
+      left = None
+    if event.move or left is not None:
+      trace = self.open.get(raw)
+      if trace is None or trace.new != where:
+        # moved without us seeing the packet-in, e.g. from another region
+        if left is not None:
+          trace = self._begin(raw, left[0], where, left[1])
+        else:
+          trace = self._begin(raw, self.where.get(raw, where), where)
+      trace.add('move', time.time())
+    self.where[raw] = where
+
+  def _handle_topology_tracker_FlowDeleteEvent (self, event):
+    if not self.ips:
+      return
+    for ip in event.ips:
+      raw = self.ips.get(ip)
+      if raw is not None:
+        self.open[raw].add('flow_delete', time.time())
+
+  def _handle_topology_tracker_DHCPEvent (self, event):
+    if not self.open:
+      return
+    packet = event.packetin.parsed
+    trace = self.open.get(packet.src.toRaw())
+    if trace is None:
+      return
+    p = packet.find('dhcp')
+    if p is None:
+      return
+    t = p.options.get(p.MSG_TYPE_OPT)
+    step = DHCP_STEPS.get(t.type) if t is not None else None
+    if step is not None:
+      trace.add(step, time.time())
+
+  # reading out
+  def snapshot (self):
+    '''
+    Finished timelines, oldest first, and percentiles of each step.
+    '''
+
+    traces = [t.to_dict() for t in list(self.done)]
+    summary = {}
+    for step in STEPS:
+      times = sorted(t['steps'][step] for t in traces if step in t['steps'])
+      if times:
+        summary[step] = dict(count = len(times), p50 = percentile(times, 50),
+                             p90 = percentile(times, 90),
+                             p99 = percentile(times, 99), max = times[-1])
+    return dict(finished = self.finished, discarded = self.discarded,
+                moving = len(self.open), summary = summary, traces = traces)
+
+  def dump (self, path):
+    with open(path, 'w') as f:
+      json.dump(self.snapshot(), f, indent = 2)
+
+
+def launch (size = 1000, window = 10):
+  global _tracer
+  if not core.hasComponent("handover"):
+    _tracer = Handover(int(size), float(window))
+    core.register("handover", _tracer)
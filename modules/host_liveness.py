@@ -0,0 +1,131 @@
+# host_liveness.py
+# Host liveness from flow counters for SD-MCAN.
+#
+# topology_tracker learns that a host is still around from its packet-ins,
+# and once those stop it ARP pings the host every so often. With flows
+# installed, a busy host hardly sends any packet-ins, so nearly all of that
+# becomes ping traffic through the controller.
+#
+# This asks the edge switches for their flow tables every interval seconds
+# instead, and watches the counters of the rules route_manager installs to
+# deliver to hosts: the pop rules and the same-subnet rules, whose output
+# port leads to a host. A rule that has carried packets since the last poll
+# refreshes the host on that (dpid, port) with the rule's destination IP,
+# and the address itself, so topology_tracker only pings hosts whose rules
+# have gone quiet. The rules are also installed with OFPFF_SEND_FLOW_REM, so
+# a rule that idles out between polls still gets its last packets counted.
+#
+# Traffic going to a host is taken as a sign of life: replies to it keep
+# coming only while it talks back. A host that disappears while others
+# keep sending to it stays known until its rules idle out.
+
+# POX
+from pox.core import core
+from pox.lib.recoco import Timer
+import pox.openflow.libopenflow_01 as of
+
+# general
+import time
+
+log = core.getLogger()
+
+
+def host_rule_port (stats):
+  '''
+  The output port of a rule that delivers to a host (it strips the label
+  or rewrites the destination MAC before output), or None.
+  '''
+
+  actions = stats.actions
+  if len(actions) != 2 or not isinstance(actions[1], of.ofp_action_output):
+    return None
+  if isinstance(actions[0], of.ofp_action_strip_vlan):
+    return actions[1].port
+  if (isinstance(actions[0], of.ofp_action_dl_addr) and
+      actions[0].type == of.OFPAT_SET_DL_DST):
+    return actions[1].port
+  return None
+
+
+class HostLiveness (object):
+  '''
+  POX component that refreshes hosts from their rules' flow counters.
+  '''
+
+  def __init__ (self, interval = 10):
+    self.interval = interval
+    self.counters = {} # dpid -> {(match, priority) -> (port, packets)}
+    self.polls = 0
+    self.refreshed = 0
+    self.flows_removed = 0
+    core.listen_to_dependencies(self, ['openflow', 'topology_tracker',
+                                       'dhcp_server'])
+
+  def _all_dependencies_met (self):
+    core.addListenerByName("ComponentRegistered", self._registered)
+    if core.hasComponent('route_manager'):
+      core.route_manager.send_flow_removed = True
+    self._t = Timer(self.interval, self._poll, recurring = True)
+    log.info('refreshing hosts from flow counters every %ss', self.interval)
+
+  def _registered (self, event):
+    if event.name == 'route_manager':
+      event.component.send_flow_removed = True
+
+  def _poll (self):
+    # only edge switches have rules leading to hosts
+    dhcp = core.dhcp_server
+    for dpid in dhcp.edges:
+      con = core.openflow.getConnection(dpid)
+      if con is not None:
+        con.send(of.ofp_stats_request(body = of.ofp_flow_stats_request()))
+        self.polls += 1
+
+  def refresh (self, dpid, port, ip = None, when = None):
+    '''
+    Refresh the host on (dpid, port) with this IP, or all of the hosts on
+    it when there is no IP to tell them apart by.
+    '''
+
+    for host in core.topology_tracker.hosts_on(dpid, port):
+      if (ip is not None and host.ipaddr is not None and
+          host.ipaddr.ip != ip):
+        continue
+      host.refresh(when)
+      if host.ipaddr is not None:
+        host.ipaddr.refresh(when)
+        host.ipaddr.pings.received()
+      self.refreshed += 1
+
+  def _handle_openflow_FlowStatsReceived (self, event):
+    dpid = event.connection.dpid
+    old = self.counters.get(dpid, {})
+    new = {}
+    for stats in event.stats:
+      port = host_rule_port(stats)
+      if port is None:
+        continue
+      key = (stats.match.pack(), stats.priority)
+      counter = old.get(key)
+      packets = counter[1] if counter is not None and counter[0] == port else 0
+      if stats.packet_count > packets:
+        self.refresh(dpid, port, stats.match.nw_dst)
+      new[key] = (port, stats.packet_count)
+    # rules the switch no longer has are forgotten
+    self.counters[dpid] = new
+
+  def _handle_openflow_FlowRemoved (self, event):
+    ofp = event.ofp
+    self.flows_removed += 1
+    key = (ofp.match.pack(), ofp.priority)
+    counter = self.counters.get(event.connection.dpid, {}).pop(key, None)
+    if counter is None or ofp.packet_count <= counter[1]:
+      return
+    # the last of those packets went through no later than idle_timeout ago
+    self.refresh(event.connection.dpid, counter[0], ofp.match.nw_dst,
+                 time.time() - ofp.idle_timeout)
+
+
+def launch (interval = 10):
+  if not core.hasComponent("host_liveness"):
+    core.register("host_liveness", HostLiveness(float(interval)))
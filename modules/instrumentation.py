@@ -0,0 +1,344 @@
+# instrumentation.py
+# Handler latency histograms and counters for SD-MCAN.
+#
+# Wraps the event handlers and timers of topology_tracker, dhcp_server and
+# route_manager (and the optional modules, when they are loaded) so every
+# call is counted and its run time goes into a histogram with power-of-two
+# microsecond buckets. Recording a call costs two clock reads and a few
+# integer updates, so it can stay on in production. Everything sent to a
+# switch is counted too: flow_mods, deletes, packet_outs and the rest, per
+# switch. Queue depths (packets held for unknown destinations, packet-ins
+# waiting on the worker pool, links waiting for their switch, log entries
+# queued for a standby) are read when asked for.
+#
+# From the POX CLI:
+#   core.instrumentation.show()      - print handlers, queues and switches
+#   core.instrumentation.snapshot()  - the same as a dict, e.g. for JSON
+#   core.instrumentation.reset()     - start counting again
+#
+# Handlers are wrapped on their classes, so this has to be launched before
+# the modules it instruments register their listeners; sd-mcan does that.
+
+# POX
+from pox.core import core
+from pox.lib.recoco import Timer
+from pox.lib.util import dpid_to_str
+import pox.openflow.libopenflow_01 as of
+
+# general
+import functools
+import math
+import struct
+import sys
+import time
+
+log = core.getLogger()
+
+# bucket i holds calls that took [2^(i-1), 2^i) microseconds; the last
+# one also holds anything slower
+BUCKETS = 32
+
+# how often call rates are worked out, in seconds
+RATE_INTERVAL = 10.0
+
+OFP_HEADER = struct.Struct('!BBHI')
+FLOW_MOD_COMMAND = struct.Struct('!H')
+FLOW_MOD_COMMAND_OFFSET = 56  # header, match and cookie
+OFPT_PACKET_OUT = 13
+OFPT_FLOW_MOD = 14
+DELETES = (of.OFPFC_DELETE, of.OFPFC_DELETE_STRICT)
+
+# what gets wrapped: module -> {class name: [method names]}
+HANDLERS = {
+  'topology_tracker': {'DynamicTopology': [
+      '_handle_openflow_PacketIn', '_handle_openflow_ConnectionUp',
+      '_handle_openflow_ConnectionDown', '_handle_openflow_PortStatus',
+      '_handle_openflow_discovery_LinkEvent', '_check_host_timeouts',
+      '_dhcp_lease']},
+  'dhcp_server': {'DHCPDMulti': [
+      '_dhcp_PacketIn', '_check_leases', '_topology_tracker_stable',
+      '_delete_flows', '_handle_ConnectionUp']},
+  'route_manager': {'ProactiveFlows': [
+      '_handle_PacketIn', '_all_dependencies_met', '_expire_pending',
+      '_host_ip', '_lease', '_host_moved']},
+  'host_liveness': {'HostLiveness': [
+      '_poll', '_handle_openflow_FlowStatsReceived',
+      '_handle_openflow_FlowRemoved']},
+  'storm_guard': {'StormGuard': ['_handle_PacketIn']},
+  'packetin_workers': {'PacketInWorkers': ['_handle_PacketIn',
+                                           'handle_result']},
+}
+
+_stats = {}    # name -> Stat
+_switches = {} # dpid -> [flow_mods, deletes, packet_outs, other]
+
+
+class Histogram (object):
+  '''
+  Call latencies in power-of-two microsecond buckets.
+  '''
+
+  def __init__ (self):
+    self.buckets = [0] * BUCKETS
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add (self, seconds):
+    us = seconds * 1e6
+    i = math.frexp(us)[1] if us >= 1 else 0
+    self.buckets[i if i < BUCKETS else BUCKETS - 1] += 1
+    self.count += 1
+    self.total += seconds
+    if seconds > self.max:
+      self.max = seconds
+
+  def percentile (self, p):
+    '''
+    Upper bound of the bucket the p'th percentile falls in, in seconds.
+    '''
+
+    if not self.count:
+      return 0.0
+    want = p / 100.0 * self.count
+    seen = 0
+    for i, n in enumerate(self.buckets):
+      seen += n
+      if seen >= want:
+        return min((2 ** i) / 1e6, self.max)
+    return self.max
+
+  def to_dict (self):
+    return dict(count = self.count, total = self.total, max = self.max,
+                mean = self.total / self.count if self.count else 0.0,
+                p50 = self.percentile(50), p90 = self.percentile(90),
+                p99 = self.percentile(99),
+                buckets = dict((2 ** i, n) for i, n in enumerate(self.buckets)
+                               if n))
+
+
+class Stat (object):
+  '''
+  Calls, errors and latencies of one handler or timer.
+  '''
+
+  def __init__ (self):
+    self.reset()
+
+  def reset (self):
+    '''
+    Start counting again. Done in place, as timed() wrappers keep hold of
+    their Stat.
+    '''
+
+    self.latency = Histogram()
+    self.errors = 0
+    self.rate = 0.0   # calls per second over the last RATE_INTERVAL
+    self._last = 0    # calls when the rate was last worked out
+
+  def roll (self, elapsed):
+    count = self.latency.count
+    self.rate = (count - self._last) / elapsed if elapsed > 0 else 0.0
+    self._last = count
+
+  def to_dict (self):
+    d = self.latency.to_dict()
+    d.update(errors = self.errors, rate = self.rate)
+    return d
+
+
+def timed (name, f):
+  '''
+  Wrap f so its calls are counted under name.
+  '''
+
+  stat = _stats.setdefault(name, Stat())
+  now = time.time
+  @functools.wraps(f)
+  def run (*args, **kw):
+    start = now()
+    try:
+      return f(*args, **kw)
+    except Exception:
+      stat.errors += 1
+      raise
+    finally:
+      stat.latency.add(now() - start)
+  run._instrumented = True
+  return run
+
+
+def instrument (cls, names):
+  '''
+  Wrap methods of cls in place. Listeners and Timers bound afterwards
+  call the wrapped methods.
+  '''
+
+  for name in names:
+    f = cls.__dict__.get(name)
+    if f is None or getattr(f, '_instrumented', False):
+      continue
+    setattr(cls, name, timed('%s.%s' % (cls.__name__, name), f))
+
+
+def count_sent (dpid, data):
+  '''
+  Count an OpenFlow message object, or packed messages, sent to dpid.
+  '''
+
+  counts = _switches.get(dpid)
+  if counts is None:
+    counts = _switches[dpid] = [0, 0, 0, 0]
+  if isinstance(data, of.ofp_flow_mod):
+    counts[1 if data.command in DELETES else 0] += 1
+  elif isinstance(data, of.ofp_packet_out):
+    counts[2] += 1
+  elif isinstance(data, bytes):
+    i = 0
+    while i + OFP_HEADER.size <= len(data):
+      _, kind, length, _ = OFP_HEADER.unpack_from(data, i)
+      if (kind == OFPT_FLOW_MOD and
+          i + FLOW_MOD_COMMAND_OFFSET + 2 <= len(data)):
+        command = FLOW_MOD_COMMAND.unpack_from(data,
+                                               i + FLOW_MOD_COMMAND_OFFSET)[0]
+        counts[1 if command in DELETES else 0] += 1
+      elif kind == OFPT_PACKET_OUT:
+        counts[2] += 1
+      else:
+        counts[3] += 1
+      if length < OFP_HEADER.size:
+        break
+      i += length
+  else:
+    counts[3] += 1
+
+
+def _instrument_connections ():
+  from pox.openflow.of_01 import Connection
+  send = Connection.send
+  if getattr(send, '_instrumented', False):
+    return
+  def counted_send (self, data):
+    if self.dpid is not None:
+      count_sent(self.dpid, data)
+    return send(self, data)
+  counted_send._instrumented = True
+  Connection.send = counted_send
+
+
+def _queues ():
+  '''
+  Current depths of the queues worth watching, by name.
+  '''
+
+  queues = {}
+  if core.hasComponent('route_manager'):
+    routes = core.route_manager
+    queues['route_manager.pending_destinations'] = len(routes.pending)
+    queues['route_manager.pending_packets'] = sum(
+        len(p.events) for p in routes.pending.itervalues())
+  if core.hasComponent('topology_tracker'):
+    queues['topology_tracker.waiting_links'] = len(
+        core.topology_tracker.waiting_links)
+  if core.hasComponent('packetin_workers'):
+    queues['packetin_workers.in_flight'] = len(
+        core.packetin_workers.pool.pending)
+  if core.hasComponent('replication'):
+    link = core.replication.link
+    queues['replication.backlog'] = sum(len(q) for q in
+                                        link.queues.itervalues())
+  ready = getattr(core.scheduler, '_ready', None)
+  if ready is not None:
+    queues['scheduler.ready'] = len(ready)
+  return queues
+
+
+class Instrumentation (object):
+  '''
+  POX component that reads out the handler statistics and message counts.
+  '''
+
+  def __init__ (self, log_interval = 0):
+    self.started = time.time()
+    self._rolled = self.started
+    self._t = Timer(RATE_INTERVAL, self._roll, recurring = True)
+    self._log_t = None
+    if log_interval > 0:
+      self._log_t = Timer(log_interval, self._log, recurring = True)
+
+  def _roll (self):
+    now = time.time()
+    for stat in _stats.values():
+      stat.roll(now - self._rolled)
+    self._rolled = now
+
+  def _log (self):
+    busy = sorted(_stats.iteritems(), key = lambda s: -s[1].latency.total)
+    log.info('busiest handlers: %s', ', '.join(
+        '%s %i calls %.1fms' % (name, s.latency.count, s.latency.total * 1e3)
+        for name, s in busy[:5] if s.latency.count))
+
+  def snapshot (self):
+    '''
+    Everything counted so far, as plain data.
+    '''
+
+    switches = {}
+    totals = dict(flow_mods = 0, deletes = 0, packet_outs = 0, other = 0)
+    for dpid, (mods, deletes, outs, other) in _switches.items():
+      switches[dpid_to_str(dpid)] = dict(flow_mods = mods, deletes = deletes,
+                                         packet_outs = outs, other = other)
+      totals['flow_mods'] += mods
+      totals['deletes'] += deletes
+      totals['packet_outs'] += outs
+      totals['other'] += other
+    return dict(uptime = time.time() - self.started,
+                handlers = dict((name, s.to_dict())
+                                for name, s in _stats.items()
+                                if s.latency.count),
+                queues = _queues(), sent = totals, switches = switches)
+
+  def reset (self):
+    for stat in _stats.values():
+      stat.reset()
+    _switches.clear()
+    self.started = self._rolled = time.time()
+
+  def show (self, switches = False):
+    '''
+    Print the statistics, busiest handlers first.
+    '''
+
+    snap = self.snapshot()
+    print('%-52s %9s %8s %9s %9s %9s %9s' % (
+        'handler', 'calls', 'rate', 'p50', 'p99', 'max', 'total'))
+    for name, h in sorted(snap['handlers'].iteritems(),
+                          key = lambda s: -s[1]['total']):
+      print('%-52s %9i %7.1f/s %7.0fus %7.0fus %7.0fus %7.1fms' % (
+          name, h['count'], h['rate'], h['p50'] * 1e6, h['p99'] * 1e6,
+          h['max'] * 1e6, h['total'] * 1e3))
+    print('')
+    for name, depth in sorted(snap['queues'].iteritems()):
+      print('%-52s %9i' % (name, depth))
+    print('')
+    print('sent: %(flow_mods)i flow_mods, %(deletes)i deletes, '
+          '%(packet_outs)i packet_outs, %(other)i other' % snap['sent'])
+    if switches:
+      for dpid, c in sorted(snap['switches'].iteritems()):
+        print('  %s: %i flow_mods, %i deletes, %i packet_outs, %i other' % (
+            dpid, c['flow_mods'], c['deletes'], c['packet_outs'],
+            c['other']))
+
+
+def launch (log_interval = 0):
+  for module, classes in HANDLERS.iteritems():
+    m = sys.modules.get(module)
+    if m is None:
+      # not loaded, so nothing of it to instrument
+      continue
+    for cls, names in classes.iteritems():
+      if hasattr(m, cls):
+        instrument(getattr(m, cls), names)
+  _instrument_connections()
+  if not core.hasComponent("instrumentation"):
+    core.register("instrumentation", Instrumentation(float(log_interval)))
@@ -0,0 +1,286 @@
+# metrics.py
+# Prometheus metrics for SD-MCAN.
+#
+# Serves /metrics in the Prometheus text format on a local port: hosts per
+# switch, leases and pool use per subnet, mobile hosts, labels in use
+# against what fits in a VLAN ID, flows per switch and, when
+# instrumentation is loaded, handler latency histograms and the messages
+# sent to each switch.
+#
+# Nothing is worked out when a scrape comes in. The page is rendered on the
+# event loop every interval seconds, from counters the modules already keep
+# up to date as things happen (topology_tracker's per-port host index, the
+# per-subnet lease tables, the address pools' free counts), so rendering
+# costs in proportion to switches and subnets, never hosts. Scrapes are
+# answered from a thread with the last page rendered and never touch
+# controller state. Flow counts come from aggregate stats requests sent to
+# every switch on the same interval.
+#
+# Other modules can serve pages of their own from the same port with
+# core.metrics.add_page(); handover.py serves its traces this way.
+
+# POX
+from pox.core import core
+from pox.lib.recoco import Timer
+from pox.lib.util import dpid_to_str
+import pox.openflow.libopenflow_01 as of
+
+# general
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import threading
+import time
+
+from cluster import parse_addr
+from route_manager import LABEL_START
+import instrumentation
+
+log = core.getLogger()
+
+# labels are carried in the 12 bit VLAN ID, and 4095 is reserved
+MAX_LABEL = 4094
+
+# handler latency buckets exported, 1us up to 16.8s; anything slower only
+# counts towards +Inf
+HISTOGRAM_BUCKETS = 25
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+class Page (object):
+  '''
+  A metrics page being rendered, in the Prometheus text format.
+  '''
+
+  def __init__ (self):
+    self.lines = []
+
+  def metric (self, name, kind, help, samples):
+    '''
+    Add a metric. samples is a list of (labels dict or None, value).
+    '''
+
+    self.lines.append('# HELP %s %s' % (name, help))
+    self.lines.append('# TYPE %s %s' % (name, kind))
+    for labels, value in samples:
+      self.sample(name, labels, value)
+
+  def sample (self, name, labels, value):
+    if labels:
+      name = '%s{%s}' % (name, ','.join('%s="%s"' % (k, escape(v))
+                                        for k, v in sorted(labels.items())))
+    self.lines.append('%s %s' % (name, format_value(value)))
+
+  def text (self):
+    return '\n'.join(self.lines) + '\n'
+
+
+def escape (value):
+  return (str(value).replace('\\', r'\\').replace('"', r'\"')
+          .replace('\n', r'\n'))
+
+
+def format_value (value):
+  if isinstance(value, float):
+    if value != value:
+      return 'NaN'
+    return repr(value)
+  return str(int(value))
+
+
+class _Handler (BaseHTTPRequestHandler):
+
+  def do_GET (self):
+    page = self.server.metrics.pages.get(self.path.split('?')[0])
+    if page is None:
+      self.send_error(404)
+      return
+    content_type, render = page
+    try:
+      body = render()
+    except Exception:
+      log.exception("rendering %s", self.path)
+      self.send_error(500)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message (self, format, *args):
+    # scrapes every few seconds are not worth a log line each
+    pass
+
+
+class Metrics (object):
+  '''
+  POX component that serves controller metrics to Prometheus.
+  '''
+
+  def __init__ (self, listen = '127.0.0.1:9105', interval = 5.0):
+    self.interval = interval
+    self.flows = {}      # dpid -> flows, from the last aggregate stats reply
+    self.render_time = 0.0
+    self.page = ''
+    self.pages = {'/metrics': (CONTENT_TYPE, lambda: self.page)}
+    self.render()
+
+    self.server = HTTPServer(parse_addr(listen), _Handler)
+    self.server.metrics = self
+    self._thread = threading.Thread(target = self.server.serve_forever,
+                                    name = 'metrics')
+    self._thread.daemon = True
+    self._thread.start()
+
+    core.openflow.addListeners(self)
+    core.addListenerByName("GoingDownEvent", lambda e: self.close())
+    self._t = Timer(interval, self._tick, recurring = True)
+    log.info("serving metrics on http://%s/metrics", listen)
+
+  def add_page (self, path, content_type, render):
+    '''
+    Serve the string render() returns at path. render is called on the
+    server thread, so it must only read state the event loop is done
+    changing.
+    '''
+
+    self.pages[path] = (content_type, render)
+
+  def close (self):
+    self._t.cancel()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def _tick (self):
+    for con in core.openflow.connections:
+      con.send(of.ofp_stats_request(body = of.ofp_aggregate_stats_request()))
+    self.render()
+
+  def _handle_AggregateFlowStatsReceived (self, event):
+    self.flows[event.dpid] = event.stats.flow_count
+
+  def _handle_ConnectionDown (self, event):
+    self.flows.pop(event.dpid, None)
+
+  def render (self):
+    '''
+    Render the page scrapes are answered with.
+    '''
+
+    start = time.time()
+    page = Page()
+    self._controller(page)
+    self._hosts(page)
+    self._leases(page)
+    self._labels(page)
+    page.metric('sdmcan_switch_flows', 'gauge', 'Flows in each switch, as of '
+                'its last aggregate stats reply',
+                [(dict(dpid = dpid_to_str(dpid)), n)
+                 for dpid, n in sorted(self.flows.iteritems())])
+    self._handlers(page)
+    page.metric('sdmcan_metrics_render_seconds', 'gauge', 'Time taken to '
+                'render the last metrics page', [(None, self.render_time)])
+    # a single reference swap, so the server thread sees one page or the
+    # other and never half of one
+    self.page = page.text()
+    self.render_time = time.time() - start
+
+  def _controller (self, page):
+    stable = (core.hasComponent('topology_tracker') and
+              core.topology_tracker.stable)
+    serving = (core.hasComponent('dhcp_server') and
+               core.dhcp_server.plan is not None)
+    page.metric('sdmcan_stable', 'gauge', 'Whether the topology is stable',
+                [(None, int(bool(stable)))])
+    page.metric('sdmcan_serving', 'gauge', 'Whether DHCP is being served',
+                [(None, int(serving))])
+    page.metric('sdmcan_switches', 'gauge', 'Switches connected',
+                [(None, len(core.openflow.connections))])
+
+  def _hosts (self, page):
+    if not core.hasComponent('topology_tracker'):
+      return
+    tracker = core.topology_tracker
+    # a port behind a hub or an access switch can have several hosts
+    counts = dict((dpid_to_str(dpid), sum(len(on_port)
+                                          for on_port in ports.itervalues()))
+                  for dpid, ports in tracker.host_ports.iteritems())
+    page.metric('sdmcan_hosts', 'gauge', 'Hosts attached to each switch',
+                [(dict(dpid = dpid), n) for dpid, n in sorted(counts.items())])
+    page.metric('sdmcan_hosts_total', 'gauge', 'Hosts in the network',
+                [(None, sum(counts.itervalues()))])
+
+  def _leases (self, page):
+    if not core.hasComponent('dhcp_server'):
+      return
+    dhcp = core.dhcp_server
+    leases, offers, size, used, utilization = [], [], [], [], []
+    for cidr, subnet in sorted(dhcp.subnets.iteritems()):
+      labels = dict(subnet = cidr)
+      pool = subnet.pool
+      taken = pool.count - len(pool)
+      leases.append((labels, len(dhcp.leases.get(subnet, ()))))
+      offers.append((labels, len(dhcp.offers.get(subnet, ()))))
+      size.append((labels, pool.count))
+      used.append((labels, taken))
+      utilization.append((labels, float(taken) / pool.count))
+    page.metric('sdmcan_leases', 'gauge', 'Leases held in each subnet',
+                leases)
+    page.metric('sdmcan_offers', 'gauge', 'Addresses offered and not yet '
+                'requested in each subnet', offers)
+    page.metric('sdmcan_pool_addresses', 'gauge', 'Addresses in each '
+                'subnet\'s pool', size)
+    page.metric('sdmcan_pool_used', 'gauge', 'Addresses taken out of each '
+                'subnet\'s pool', used)
+    page.metric('sdmcan_pool_utilization', 'gauge', 'Fraction of each '
+                'subnet\'s pool taken', utilization)
+    page.metric('sdmcan_mobile_hosts', 'gauge', 'Hosts away from their home '
+                'subnet', [(None, len(dhcp.mobile_hosts))])
+
+  def _labels (self, page):
+    if not core.hasComponent('route_manager'):
+      return
+    used = len(core.route_manager.label_table)
+    limit = MAX_LABEL - LABEL_START + 1
+    page.metric('sdmcan_labels', 'gauge', 'Path labels allocated',
+                [(None, used)])
+    page.metric('sdmcan_labels_limit', 'gauge', 'Path labels that fit in a '
+                'VLAN ID', [(None, limit)])
+    page.metric('sdmcan_labels_utilization', 'gauge', 'Fraction of the '
+                'path labels allocated', [(None, float(used) / limit)])
+
+  def _handlers (self, page):
+    if not core.hasComponent('instrumentation'):
+      return
+    stats = sorted((name, s) for name, s in instrumentation._stats.items()
+                   if s.latency.count)
+    name = 'sdmcan_handler_seconds'
+    page.metric(name, 'histogram', 'Run time of event handlers and timers',
+                [])
+    for handler, s in stats:
+      h = s.latency
+      seen = 0
+      for i, n in enumerate(h.buckets[:HISTOGRAM_BUCKETS]):
+        seen += n
+        page.sample(name + '_bucket', dict(handler = handler,
+                                           le = repr((2 ** i) / 1e6)), seen)
+      page.sample(name + '_bucket', dict(handler = handler, le = '+Inf'),
+                  h.count)
+      page.sample(name + '_sum', dict(handler = handler), h.total)
+      page.sample(name + '_count', dict(handler = handler), h.count)
+    page.metric('sdmcan_handler_errors_total', 'counter', 'Event handler and '
+                'timer calls that raised',
+                [(dict(handler = handler), s.errors) for handler, s in stats])
+
+    kinds = ('flow_mod', 'delete', 'packet_out', 'other')
+    sent = []
+    for dpid, counts in sorted(instrumentation._switches.items()):
+      for kind, n in zip(kinds, counts):
+        sent.append((dict(dpid = dpid_to_str(dpid), kind = kind), n))
+    page.metric('sdmcan_messages_sent_total', 'counter', 'OpenFlow messages '
+                'sent to each switch', sent)
+
+
+def launch (listen = '127.0.0.1:9105', interval = 5):
+  if not core.hasComponent("metrics"):
+    core.register("metrics", Metrics(listen, float(interval)))
@@ -0,0 +1,368 @@
+# packetin_workers.py
+# Moves packet-in parsing, classification and reply construction for DHCP
+# and ARP off POX's recoco thread into a pool of worker processes.
+#
+# Packet-ins are sharded over the workers by dpid, so every switch's packets
+# are handled in order. The workers are stateless apart from the set of
+# gateway addresses: they parse the raw packet, decode DHCP requests into a
+# compact tuple and pack ARP replies for the gateway addresses outright.
+# Host, lease and label state stays in the POX process, which is the single
+# writer for all of it: decoded DHCP requests come back to it and are handed
+# to topology_tracker and dhcp_server as usual, just without being parsed
+# on the recoco thread. Everything else, ARP for other addresses included,
+# takes the normal path without going through the workers.
+
+# POX
+from pox.core import core
+from pox.lib.recoco import Task, Select
+from pox.lib.revent import EventHalt
+from pox.lib.addresses import IPAddr, EthAddr
+import pox.openflow.libopenflow_01 as of
+import pox.lib.packet as pkt
+from pox.lib.packet.ethernet import ethernet
+from pox.lib.packet.arp import arp
+import topology_tracker
+
+# general
+import multiprocessing
+import struct
+
+log = core.getLogger()
+
+GATEWAY_DUMMY_MAC = '03:00:00:00:be:ef'
+
+# what the workers hand back
+DHCP = 'dhcp'
+GATEWAY_ARP = 'gwarp'
+OTHER = 'other'
+
+
+def should_offload (data, gateways):
+  '''
+  Cheaply tell from the raw frame whether a packet-in is something the
+  workers handle (an ARP request for one of the gateways, raw addresses in
+  gateways, or UDP from the DHCP client port to the server port), without
+  parsing it.
+  '''
+
+  if len(data) < 42:
+    return False
+  etype, = struct.unpack_from('!H', data, 12)
+  if etype == ethernet.ARP_TYPE:
+    # anything else would only be parsed again on the normal path
+    return (struct.unpack_from('!H', data, 20)[0] == arp.REQUEST and
+            data[38:42] in gateways)
+  if etype == ethernet.IP_TYPE:
+    vihl, proto = struct.unpack_from('!B8xB', data, 14)
+    udp = 14 + (vihl & 0xf) * 4
+    if proto == pkt.ipv4.UDP_PROTOCOL and len(data) >= udp + 4:
+      return (struct.unpack_from('!HH', data, udp) ==
+              (pkt.dhcp.CLIENT_PORT, pkt.dhcp.SERVER_PORT))
+  return False
+
+
+def dpid_to_mac_raw (dpid):
+  return struct.pack('!Q', dpid & 0xffFFffFFffFF)[2:]
+
+
+def decode (dpid, port, data, gateways):
+  '''
+  Worker side: parse one packet-in and return (kind, fields). Addresses
+  are passed back raw so the results pickle small.
+  '''
+
+  packet = ethernet(data)
+  if not packet.parsed:
+    return OTHER, None
+
+  a = packet.find('arp')
+  if a is not None:
+    if (a.opcode == arp.REQUEST and a.prototype == arp.PROTO_TYPE_IP and
+        a.hwtype == arp.HW_TYPE_ETHERNET and a.protosrc != 0 and
+        a.protodst.toUnsigned() in gateways):
+      # reply on behalf of the gateway right here
+      reply = struct.pack('!HHBBH6s4s6s4s', arp.HW_TYPE_ETHERNET,
+                          arp.PROTO_TYPE_IP, 6, 4, arp.REPLY,
+                          EthAddr(GATEWAY_DUMMY_MAC).toRaw(),
+                          a.protodst.toRaw(), a.hwsrc.toRaw(),
+                          a.protosrc.toRaw())
+      frame = (a.hwsrc.toRaw() + dpid_to_mac_raw(dpid) +
+               struct.pack('!H', ethernet.ARP_TYPE) + reply)
+      return GATEWAY_ARP, (packet.src.toRaw(), a.protosrc.toUnsigned(), frame)
+    return OTHER, None
+
+  # the same checks as topology_tracker's is_dhcp()
+  u = packet.find('udp')
+  if (u is None or u.srcport != pkt.dhcp.CLIENT_PORT or
+      u.dstport != pkt.dhcp.SERVER_PORT):
+    return OTHER, None
+  p = packet.find('dhcp')
+  ipp = packet.find('ipv4')
+  if p is None or not p.parsed or p.op != p.BOOTREQUEST:
+    return OTHER, None
+  t = p.options.get(p.MSG_TYPE_OPT)
+  if t is None:
+    return OTHER, None
+  requested = p.options.get(p.REQUEST_IP_OPT)
+  params = p.options.get(p.PARAM_REQ_OPT)
+  return DHCP, (packet.src.toRaw(), packet.dst.toRaw(),
+                ipp.srcip.toUnsigned(), ipp.dstip.toUnsigned(),
+                p.xid, p.flags, p.chaddr.toRaw(), p.ciaddr.toUnsigned(),
+                t.type,
+                requested.addr.toUnsigned() if requested is not None else None,
+                list(params.options) if params is not None else None)
+
+
+def _work (conn):
+  '''
+  Worker process main loop. Receives batches of (seq, dpid, port, data)
+  and sends back batches of (seq, kind, fields).
+  '''
+
+  gateways = set()
+  while True:
+    try:
+      msg = conn.recv()
+    except EOFError:
+      return
+    if msg is None:
+      return
+    if msg[0] == 'gateways':
+      gateways = set(msg[1])
+      continue
+    out = []
+    for seq, dpid, port, data in msg[1]:
+      try:
+        out.append((seq,) + decode(dpid, port, data, gateways))
+      except Exception:
+        out.append((seq, OTHER, None))
+    conn.send(out)
+
+
+class _Object (object):
+  def __init__ (self, **kw):
+    self.__dict__.update(kw)
+
+
+class DecodedDHCP (pkt.dhcp):
+  '''
+  Stands in for a parsed pkt.dhcp, built from what a worker decoded. Only
+  the fields dhcp_server looks at are filled in.
+  '''
+
+  def __init__ (self, fields):
+    (_, _, _, _, xid, flags, chaddr, ciaddr, msg_type, requested,
+     params) = fields
+    self.parsed = True
+    self.op = self.BOOTREQUEST
+    self.xid = xid
+    self.flags = flags
+    self.chaddr = EthAddr(chaddr)
+    self.ciaddr = IPAddr(ciaddr)
+    self.options = {self.MSG_TYPE_OPT: _Object(type=msg_type)}
+    if requested is not None:
+      self.options[self.REQUEST_IP_OPT] = _Object(addr=IPAddr(requested))
+    if params is not None:
+      self.options[self.PARAM_REQ_OPT] = _Object(options=params)
+
+
+class DecodedPacket (object):
+  '''
+  Stands in for the parsed ethernet/ipv4/udp/dhcp chain of a packet-in.
+  '''
+
+  parsed = True
+  type = ethernet.IP_TYPE
+
+  def __init__ (self, fields):
+    self.src = EthAddr(fields[0])
+    self.dst = EthAddr(fields[1])
+    self.dhcp = DecodedDHCP(fields)
+    self.udp = _Object(srcport=pkt.dhcp.CLIENT_PORT,
+                       dstport=pkt.dhcp.SERVER_PORT, payload=self.dhcp)
+    self.ipv4 = _Object(srcip=IPAddr(fields[2]), dstip=IPAddr(fields[3]),
+                        payload=self.udp, parsed=True)
+    self.next = self.ipv4
+
+  def find (self, name):
+    return getattr(self, name, None) if name in ('ipv4', 'udp', 'dhcp') else None
+
+
+class DecodedPacketIn (object):
+  '''
+  The parts of a PacketIn event dhcp_server uses, with a decoded packet.
+  '''
+
+  def __init__ (self, event, fields):
+    self.connection = event.connection
+    self.dpid = event.dpid
+    self.port = event.port
+    self.ofp = event.ofp
+    self.data = event.data
+    self.parsed = DecodedPacket(fields)
+
+
+class WorkerPool (object):
+  '''
+  A pool of decode worker processes, sharded by dpid. Does not depend on
+  the recoco loop, so it can be driven offline too.
+  '''
+
+  def __init__ (self, workers):
+    self.pipes = []
+    self.procs = []
+    self.pending = {} # seq -> context
+    self.batches = {} # pipe -> [(seq, dpid, port, data)]
+    self.seq = 0
+    for _ in range(workers):
+      mine, theirs = multiprocessing.Pipe()
+      proc = multiprocessing.Process(target=_work, args=(theirs,))
+      proc.daemon = True
+      proc.start()
+      self.pipes.append(mine)
+      self.procs.append(proc)
+
+  def __len__ (self):
+    return len(self.pipes)
+
+  def set_gateways (self, ips):
+    ips = [IPAddr(ip).toUnsigned() for ip in ips]
+    for pipe in self.pipes:
+      pipe.send(('gateways', ips))
+
+  def submit (self, dpid, port, data, context):
+    '''
+    Queue a packet-in for the worker that owns dpid. Returns True if this
+    is the first packet queued since the last flush().
+    '''
+
+    self.seq += 1
+    self.pending[self.seq] = context
+    pipe = self.pipes[dpid % len(self.pipes)]
+    first = not self.batches
+    self.batches.setdefault(pipe, []).append((self.seq, dpid, port, data))
+    return first
+
+  def flush (self):
+    batches, self.batches = self.batches, {}
+    for pipe, batch in batches.iteritems():
+      pipe.send(('batch', batch))
+
+  def collect (self, pipe):
+    '''
+    Read one batch of results from a worker pipe, returning
+    [(context, kind, fields)].
+    '''
+
+    return [(self.pending.pop(seq), kind, fields)
+            for seq, kind, fields in pipe.recv()]
+
+  def close (self):
+    for pipe in self.pipes:
+      try:
+        pipe.send(None)
+      except (IOError, OSError):
+        pass
+    for proc in self.procs:
+      proc.join(1)
+
+
+class _Collector (Task):
+  '''
+  recoco task that waits on the worker pipes and hands results back to
+  the PacketInWorkers component.
+  '''
+
+  def __init__ (self, owner):
+    Task.__init__(self)
+    self.owner = owner
+
+  def run (self):
+    pool = self.owner.pool
+    while core.running:
+      rlist,_,_ = yield Select(pool.pipes, [], [], 5)
+      for pipe in rlist:
+        for context, kind, fields in pool.collect(pipe):
+          self.owner.handle_result(context, kind, fields)
+
+
+class PacketInWorkers (object):
+  '''
+  POX component that hands DHCP and ARP packet-ins to a WorkerPool. It
+  listens ahead of topology_tracker and halts the packet-ins it offloads;
+  anything the workers don't fully handle is raised again on core.openflow
+  so it takes the normal path.
+  '''
+
+  def __init__ (self, workers):
+    self.pool = WorkerPool(workers)
+    self.gateways = None
+    self._raw_gateways = None
+    self.offloaded = 0
+    self.passed = 0
+    core.openflow.addListeners(self, priority=2)
+    core.addListenerByName("GoingDownEvent", lambda e: self.pool.close())
+    _Collector(self).start()
+    log.info("packet-in worker pool with %i workers", workers)
+
+  def _ready (self):
+    '''
+    Only offload once dhcp_server is serving; the gateway addresses the
+    workers answer ARP for are known from then on.
+    '''
+
+    if self.gateways is None:
+      if (not core.hasComponent('dhcp_server') or
+          not core.hasComponent('topology_tracker') or
+          not core.dhcp_server.edges):
+        return False
+      self.gateways = set(core.dhcp_server.edges.itervalues())
+      self._raw_gateways = set(ip.toRaw() for ip in self.gateways)
+      self.pool.set_gateways(self.gateways)
+    return True
+
+  def _handle_PacketIn (self, event):
+    if getattr(event, '_sdmcan_pooled', False) or not self._ready():
+      return
+    data = event.data
+    if not should_offload(data, self._raw_gateways):
+      return
+    tracker = core.topology_tracker
+    if not tracker.is_edge_port(event.dpid, event.port):
+      return
+    if self.pool.submit(event.dpid, event.port, data, event):
+      core.callLater(self.pool.flush)
+    self.offloaded += 1
+    return EventHalt
+
+  def handle_result (self, event, kind, fields):
+    '''
+    Finish a packet-in the workers have decoded. Runs on the recoco thread,
+    which owns all host and lease state.
+    '''
+
+    tracker = core.topology_tracker
+    if kind == DHCP:
+      srcip = IPAddr(fields[2])
+      tracker.learn_host(event.dpid, event.port, EthAddr(fields[0]),
+                         srcip if srcip.toUnsigned() else None, False)
+      tracker.raiseEventNoErrors(topology_tracker.DHCPEvent(
+          DecodedPacketIn(event, fields), tracker.graph))
+    elif kind == GATEWAY_ARP:
+      src, protosrc, frame = fields
+      tracker.learn_host(event.dpid, event.port, EthAddr(src),
+                         IPAddr(protosrc), True)
+      msg = of.ofp_packet_out(data = frame, in_port = event.port)
+      msg.actions.append(of.ofp_action_output(port = of.OFPP_IN_PORT))
+      event.connection.send(msg)
+    else:
+      # not ours after all, send it down the normal path
+      self.passed += 1
+      event._sdmcan_pooled = True
+      event.halt = False
+      core.openflow.raiseEventNoErrors(event)
+
+
+def launch (workers = 2):
+  if not core.hasComponent("packetin_workers"):
+    core.register("packetin_workers", PacketInWorkers(int(workers)))
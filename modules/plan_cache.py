@@ -0,0 +1,154 @@
+# plan_cache.py
+# Warm start for SD-MCAN from a plan saved on disk.
+#
+# Once dhcp_server has planned the network and route_manager has labelled
+# it, the plan (core switches and edge switches in subnet order), the label
+# table and the path rules are saved to a JSON file together with a
+# fingerprint of the switches and the links between them. A restarted
+# controller loads the file and, as switches connect and discovery finds
+# their links, compares the topology it has seen with the fingerprint. As
+# soon as they match it starts serving on the saved plan, without waiting
+# out topology_tracker's stability interval or working out the core and the
+# label paths again. If the topology never matches, or the file is missing
+# or was made for a different network, the controller starts the usual way.
+
+# POX
+from pox.core import core
+
+# general
+import json
+import os
+import time
+
+import dhcp_server
+import route_manager
+from topology_tracker import fingerprint
+
+log = core.getLogger()
+
+
+class PlanCache (object):
+  '''
+  POX component that saves the plan once the controller is serving and
+  warm starts from it.
+  '''
+
+  def __init__ (self, path):
+    self.path = path
+    self.saved = self.load()
+    self.warm = False     # started from the saved plan
+    self.pending = False  # a fingerprint check is scheduled
+    self.start_time = time.time()
+    core.listen_to_dependencies(self, ['openflow', 'openflow_discovery',
+                                       'topology_tracker', 'dhcp_server'])
+
+  def _all_dependencies_met (self):
+    core.addListenerByName("ComponentRegistered", self._registered)
+
+  # file
+  def config (self):
+    '''
+    The dhcp_server settings a plan depends on.
+    '''
+
+    dhcp = core.dhcp_server
+    return dict(network = "%s/%i" % (dhcp.network, dhcp.network_size),
+                core_mode = dhcp.core_mode,
+                core_dpids = list(dhcp.core_dpids))
+
+  def load (self):
+    if not os.path.exists(self.path):
+      log.info('no saved plan in %s', self.path)
+      return None
+    try:
+      with open(self.path) as f:
+        saved = json.load(f)
+      saved['labels'] = dict(
+          (route_manager.LabelInfo(d1, d2, str(subnet)), label)
+          for d1, d2, subnet, label in saved['labels'])
+      saved['rules'] = [tuple(r) for r in saved['rules']]
+      if 'fingerprint' not in saved or 'plan' not in saved:
+        raise KeyError('fingerprint or plan missing')
+    except (IOError, ValueError, KeyError, TypeError) as e:
+      log.warn('ignoring saved plan in %s: %s', self.path, e)
+      return None
+    log.info('loaded plan for %s switches from %s', saved.get('switches'),
+             self.path)
+    return saved
+
+  def save (self, routes):
+    dhcp = core.dhcp_server
+    graph = core.topology_tracker.graph
+    labels = [[info.dpid1, info.dpid2, info.dst_subnet, label]
+              for info, label in routes.label_table.iteritems()]
+    data = dict(self.config(), fingerprint = fingerprint(graph),
+                switches = len(dhcp_server.switch_graph(graph)),
+                plan = dhcp.plan,
+                labels = labels,
+                rules = sorted(list(r) for r in routes.path_rules))
+    tmp = self.path + '.tmp'
+    try:
+      with open(tmp, 'w') as f:
+        json.dump(data, f)
+      os.rename(tmp, self.path)
+    except (IOError, OSError) as e:
+      log.warn('could not save plan to %s: %s', self.path, e)
+      return
+    log.info('saved plan with %i labels to %s', len(labels), self.path)
+
+  # topology changes
+  def _handle_openflow_ConnectionUp (self, event):
+    self._changed()
+
+  def _handle_openflow_ConnectionDown (self, event):
+    self._changed()
+
+  def _handle_openflow_discovery_LinkEvent (self, event):
+    self._changed()
+
+  def _changed (self):
+    # check once topology_tracker and the rest have seen the whole batch
+    if self.saved is None or self.pending:
+      return
+    self.pending = True
+    core.callLater(self._check)
+
+  def _check (self):
+    self.pending = False
+    dhcp = core.dhcp_server
+    if self.saved is None or dhcp.plan is not None or dhcp.passive:
+      return
+    if fingerprint(core.topology_tracker.graph) != self.saved['fingerprint']:
+      return
+    saved, self.saved = self.saved, None
+    for key, value in self.config().iteritems():
+      if saved.get(key) != value:
+        log.info('saved plan was made with %s=%s, planning from scratch',
+                 key, saved.get(key))
+        return
+    self.start(saved)
+
+  def start (self, saved):
+    '''
+    Serve on a saved plan now that the topology matches it.
+    '''
+
+    self.warm = True
+    core.dhcp_server.start(saved['plan'], routes = False)
+    route_manager.launch(labels = saved['labels'], rules = saved['rules'],
+                         **core.dhcp_server.route_options)
+    # no need to wait for the topology to settle
+    core.topology_tracker.mark_stable()
+    log.info('warm started on the saved plan %.3fs after startup',
+             time.time() - self.start_time)
+
+  def _registered (self, event):
+    if event.name == 'route_manager' and not self.warm:
+      # a fresh plan, save it for next time
+      self.saved = None
+      self.save(event.component)
+
+
+def launch (path = 'sd-mcan-plan.json'):
+  if not core.hasComponent("plan_cache"):
+    core.register("plan_cache", PlanCache(path))
@@ -0,0 +1,196 @@
+# profiler.py
+# Sampling profiler for SD-MCAN.
+#
+# Finding out where the controller spends its time used to mean restarting
+# POX under cProfile. This samples the stack of the recoco scheduler thread,
+# where every handler and timer runs, from a thread of its own at rate
+# samples a second, and can be started and stopped while the controller
+# runs. When it stops it writes what it saw as collapsed stacks, one
+# "frame;frame;frame count" line per stack, which flamegraph.pl and
+# speedscope read directly, and logs the SD-MCAN functions that took the
+# most samples. A sample counts towards the innermost SD-MCAN function on
+# the stack as its own time, so time in networkx or POX is charged to the
+# SD-MCAN code that called it.
+#
+# Nothing runs while it is stopped: the sampling thread only exists while
+# a profile is being taken.
+#
+# From the POX CLI:
+#   core.profiler.start()              - start sampling
+#   core.profiler.stop()               - stop and write the profile
+#   core.profiler.top()                - the busiest SD-MCAN functions so far
+# or send the controller SIGUSR2 to start, and again to stop.
+
+# POX
+from pox.core import core
+from pox.lib.util import str_to_bool
+
+# general
+import os
+import signal
+import sys
+import threading
+import time
+
+log = core.getLogger()
+
+# frames from files in this directory are SD-MCAN's own
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# stacks deeper than this are cut off at the root end
+MAX_DEPTH = 128
+
+# POX boots in the main thread, and so does the scheduler unless it was
+# given a thread of its own
+_main_ident = threading.current_thread().ident
+
+
+def frame_name (frame):
+  '''
+  module:function for a frame, the way it appears in the profile.
+  '''
+
+  code = frame.f_code
+  module = os.path.splitext(os.path.basename(code.co_filename))[0]
+  return '%s:%s' % (module, code.co_name)
+
+
+def is_own (frame):
+  return os.path.dirname(os.path.abspath(frame.f_code.co_filename)) == \
+      MODULE_DIR
+
+
+class Profiler (object):
+  '''
+  POX component that samples the scheduler thread's stack on demand.
+  '''
+
+  def __init__ (self, rate = 100, path = 'sd-mcan-%Y%m%d-%H%M%S.folded',
+                all_threads = False):
+    self.rate = rate          # samples a second
+    self.path = path          # strftime pattern for the output file
+    self.all_threads = all_threads
+    self.stacks = {}          # collapsed stack -> samples
+    self.own = {}             # SD-MCAN function -> (self, total) samples
+    self.samples = 0
+    self.started = None
+    self._thread = None
+    self._stop = threading.Event()
+    self._names = {}          # code object -> frame name, and whether own
+
+  @property
+  def running (self):
+    return self._thread is not None
+
+  def start (self, rate = None):
+    '''
+    Start sampling, from scratch.
+    '''
+
+    if self.running:
+      return
+    if rate is not None:
+      self.rate = float(rate)
+    self.stacks = {}
+    self.own = {}
+    self.samples = 0
+    self.started = time.time()
+    self._stop.clear()
+    self._thread = threading.Thread(target = self._run, name = 'profiler')
+    self._thread.daemon = True
+    self._thread.start()
+    log.info("profiling at %s samples/s", self.rate)
+
+  def stop (self, path = None):
+    '''
+    Stop sampling and write the profile. Returns the file written.
+    '''
+
+    if not self.running:
+      return None
+    self._stop.set()
+    self._thread.join()
+    self._thread = None
+    path = time.strftime(path or self.path)
+    self.write(path)
+    elapsed = time.time() - self.started
+    log.info("%i samples over %.1fs written to %s", self.samples, elapsed,
+             path)
+    for name, (own, total) in self.top(5):
+      log.info("  %-48s %5.1f%% self %5.1f%% total", name,
+               100.0 * own / self.samples, 100.0 * total / self.samples)
+    return path
+
+  def toggle (self):
+    if self.running:
+      self.stop()
+    else:
+      self.start()
+
+  def write (self, path):
+    with open(path, 'w') as f:
+      for stack, n in sorted(self.stacks.iteritems()):
+        f.write('%s %i\n' % (stack, n))
+
+  def top (self, n = 20):
+    '''
+    The n SD-MCAN functions most often on the stack, as (name, (samples
+    as the innermost SD-MCAN function, samples anywhere on the stack)).
+    '''
+
+    # items() copies in one go, so this is safe while sampling
+    return sorted(self.own.items(), key = lambda f: -f[1][1])[:n]
+
+  def _targets (self):
+    if self.all_threads:
+      me = threading.current_thread().ident
+      return [t for t in sys._current_frames() if t != me]
+    thread = getattr(core.scheduler, '_thread', None)
+    if thread is None or thread.ident is None:
+      return [_main_ident]
+    return [thread.ident]
+
+  def _run (self):
+    interval = 1.0 / self.rate
+    targets = self._targets()
+    while not self._stop.wait(interval):
+      frames = sys._current_frames()
+      for ident in targets:
+        frame = frames.get(ident)
+        if frame is not None:
+          self._sample(frame)
+
+  def _sample (self, frame):
+    names = self._names
+    stack = []
+    seen = set()
+    inner = 1
+    while frame is not None and len(stack) < MAX_DEPTH:
+      code = frame.f_code
+      name = names.get(code)
+      if name is None:
+        name = names[code] = (frame_name(frame), is_own(frame))
+      stack.append(name[0])
+      if name[1] and name[0] not in seen:
+        # SD-MCAN functions are counted once per sample however deep the
+        # recursion
+        seen.add(name[0])
+        own, total = self.own.get(name[0], (0, 0))
+        self.own[name[0]] = (own + inner, total + 1)
+        inner = 0
+      frame = frame.f_back
+    stack.reverse()
+    key = ';'.join(stack)
+    self.stacks[key] = self.stacks.get(key, 0) + 1
+    self.samples += 1
+
+
+def launch (rate = 100, path = 'sd-mcan-%Y%m%d-%H%M%S.folded',
+            all_threads = False, signal_toggle = True):
+  if core.hasComponent("profiler"):
+    return
+  profiler = Profiler(float(rate), path, str_to_bool(all_threads))
+  core.register("profiler", profiler)
+  if str_to_bool(signal_toggle):
+    # handled in the main thread, between bytecodes
+    signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.toggle())
@@ -0,0 +1,145 @@
+# recorder.py
+# Packet-in trace recording for SD-MCAN.
+#
+# Writes everything the switches and discovery tell the controller to a
+# compact binary trace: packet-ins, ConnectionUp/Down, port status and link
+# events, each with the time it arrived and the raw OpenFlow message. The
+# trace can be replayed against the controller modules offline, without
+# Mininet, OVS or root (see tools/replay.py).
+#
+# A trace starts with a header: MAGIC, the format version and the length of
+# a JSON blob holding the controller settings it was recorded with, then
+# the blob. Records follow, each a RECORD (arrival time, kind, dpid and
+# payload length) and the payload:
+#
+#   CONNECTION_UP   - the switch's ofp_features_reply
+#   CONNECTION_DOWN - nothing
+#   PACKET_IN       - the ofp_packet_in
+#   PORT_STATUS     - the ofp_port_status
+#   LINK_UP/DOWN    - LINK: dpid1, port1, dpid2, port2
+
+# POX
+from pox.core import core
+from pox.lib.recoco import Timer
+
+# general
+import json
+import struct
+import time
+
+log = core.getLogger()
+
+MAGIC = b'SDMT'
+VERSION = 1
+HEADER = struct.Struct('!4sHI')
+RECORD = struct.Struct('!dBQI')
+LINK = struct.Struct('!QHQH')
+
+CONNECTION_UP = 1
+CONNECTION_DOWN = 2
+PACKET_IN = 3
+PORT_STATUS = 4
+LINK_UP = 5
+LINK_DOWN = 6
+
+KINDS = {CONNECTION_UP: 'ConnectionUp', CONNECTION_DOWN: 'ConnectionDown',
+         PACKET_IN: 'PacketIn', PORT_STATUS: 'PortStatus',
+         LINK_UP: 'LinkUp', LINK_DOWN: 'LinkDown'}
+
+
+def read_trace (f):
+  '''
+  Read a trace from a file opened for binary reading. Returns the settings
+  it was recorded with and a generator of (time, kind, dpid, payload).
+  '''
+
+  head = f.read(HEADER.size)
+  if len(head) < HEADER.size:
+    raise ValueError('trace too short')
+  magic, version, size = HEADER.unpack(head)
+  if magic != MAGIC:
+    raise ValueError('not a trace')
+  if version != VERSION:
+    raise ValueError('trace version %i, expected %i' % (version, VERSION))
+  config = json.loads(f.read(size))
+
+  def records ():
+    while True:
+      head = f.read(RECORD.size)
+      if len(head) < RECORD.size:
+        # a controller that died mid-write leaves a partial record
+        return
+      when, kind, dpid, size = RECORD.unpack(head)
+      payload = f.read(size)
+      if len(payload) < size:
+        return
+      yield when, kind, dpid, payload
+
+  return config, records()
+
+
+class Recorder (object):
+  '''
+  POX component that records switch and discovery events to a trace.
+  '''
+
+  def __init__ (self, path, config = None):
+    self.path = path
+    self.records = 0
+    self.bytes = 0
+    self.f = open(path, 'wb')
+    blob = json.dumps(config or {})
+    self.f.write(HEADER.pack(MAGIC, VERSION, len(blob)) + blob)
+
+    # see every event before anyone gets a chance to halt it
+    core.openflow.addListeners(self, priority=5)
+    core.listen_to_dependencies(self, ['openflow_discovery'])
+    core.addListenerByName("GoingDownEvent", lambda e: self.close())
+    self._t = Timer(1, self.flush, recurring = True)
+    log.info("recording to %s", path)
+
+  def write (self, kind, dpid, payload = b''):
+    if self.f is None:
+      return
+    self.f.write(RECORD.pack(time.time(), kind, dpid, len(payload)) +
+                 payload)
+    self.records += 1
+    self.bytes += RECORD.size + len(payload)
+
+  def flush (self):
+    if self.f is not None:
+      self.f.flush()
+
+  def close (self):
+    if self.f is None:
+      return
+    self._t.cancel()
+    self.f.close()
+    self.f = None
+    log.info("recorded %i events, %i bytes to %s", self.records, self.bytes,
+             self.path)
+
+  def _handle_ConnectionUp (self, event):
+    self.write(CONNECTION_UP, event.dpid, event.ofp.pack())
+
+  def _handle_ConnectionDown (self, event):
+    self.write(CONNECTION_DOWN, event.dpid)
+
+  def _handle_PacketIn (self, event):
+    if getattr(event, '_sdmcan_pooled', False):
+      # packetin_workers passing one back, we have it already
+      return
+    self.write(PACKET_IN, event.dpid, event.ofp.pack())
+
+  def _handle_PortStatus (self, event):
+    self.write(PORT_STATUS, event.dpid, event.ofp.pack())
+
+  def _handle_openflow_discovery_LinkEvent (self, event):
+    link = event.link
+    self.write(LINK_UP if event.added else LINK_DOWN, link.dpid1,
+               LINK.pack(link.dpid1, link.port1, link.dpid2, link.port2))
+
+
+def launch (path = 'sd-mcan.trace', **config):
+  if not core.hasComponent("recorder"):
+    core.register("recorder", Recorder(path, config))
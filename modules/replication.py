@@ -0,0 +1,344 @@
+# replication.py
+# Hot-standby replication for SD-MCAN.
+#
+# The active controller streams an incremental log of its state to a
+# standby controller: hosts joining, leaving and moving, leases handed out
+# and expiring, labels allocated, and the core/edge plan dhcp_server serves.
+# Whenever the standby connects, or finds it missed part of the log, it is
+# sent a snapshot first. The log goes over the same line-per-message TCP
+# link the cluster uses (see cluster.py).
+#
+# The standby applies the log to a Replica and otherwise stays out of the
+# way: switches can connect to it, but it drops their packet-ins and its
+# dhcp_server neither plans nor serves. Once it hasn't heard from the active
+# controller for failover_timeout seconds it takes over: it asks every
+# switch for its flow table, brings dhcp_server up on the replicated plan and
+# leases, puts the hosts back into topology_tracker and starts route_manager
+# with the replicated labels, so the path rules already on the switches are
+# kept and only the difference is fixed up.
+
+# POX
+from pox.core import core
+from pox.lib.recoco import Timer
+from pox.lib.revent import EventHalt
+from pox.lib.addresses import EthAddr, IPAddr
+from pox.lib.util import str_to_bool
+import pox.openflow.libopenflow_01 as of
+from cluster import PeerLink, PeerService
+import route_manager
+import topology_tracker
+
+# general
+import time
+
+log = core.getLogger()
+
+# seconds between heartbeats from the active controller
+BEAT_INTERVAL = 0.1
+
+# seconds to wait for flow tables from the switches when taking over
+STATS_TIMEOUT = 0.5
+
+# log entries queued for a standby that isn't keeping up before we drop
+# them and let it ask for a snapshot instead
+MAX_BACKLOG = 100000
+
+
+class Replica (object):
+  '''
+  The state replicated from the active controller, applied from log
+  entries. Plain data, so it can be filled in and checked offline.
+  '''
+
+  def __init__ (self):
+    self.reset(0)
+
+  def reset (self, seq):
+    self.seq = seq
+    self.plan = None
+    self.hosts = {}   # MAC -> (dpid, port)
+    self.leases = {}  # MAC -> lease entry, with 'expires' in our time
+    self.labels = {}  # LabelInfo -> label
+
+  def apply (self, entry):
+    '''
+    Apply one log entry. Returns False if entries went missing before it,
+    in which case a new snapshot is needed.
+    '''
+
+    op = entry['op']
+    if op == 'snapshot':
+      self.reset(entry['seq'])
+      self.plan = entry['plan']
+      for e in entry['entries']:
+        self._apply(e)
+      return True
+    if entry['seq'] != self.seq + 1:
+      return False
+    self.seq = entry['seq']
+    self._apply(entry)
+    return True
+
+  def _apply (self, entry):
+    op = entry['op']
+    if op == 'host':
+      self.hosts[entry['mac']] = (entry['dpid'], entry['port'])
+    elif op == 'leave':
+      self.hosts.pop(entry['mac'], None)
+    elif op == 'lease':
+      lease = dict(entry)
+      lease['expires'] = time.time() + entry['remaining']
+      self.leases[entry['mac']] = lease
+    elif op == 'expire':
+      self.leases.pop(entry['mac'], None)
+    elif op == 'label':
+      info = route_manager.LabelInfo(entry['dpid1'], entry['dpid2'],
+                                     str(entry['subnet']))
+      self.labels[info] = entry['label']
+    elif op == 'plan':
+      self.plan = entry['plan']
+
+
+class Journal (object):
+  '''
+  Active side: turns what the components do into log entries, handing
+  each to send().
+  '''
+
+  def __init__ (self, send):
+    self.send = send
+    self.seq = 0
+
+  def add (self, **entry):
+    self.seq += 1
+    entry['seq'] = self.seq
+    self.send(entry)
+
+  # entries
+  def host_entry (self, host):
+    return dict(op='host', mac=str(host.macaddr), dpid=host.dpid,
+                port=host.port)
+
+  def lease_entry (self, subnet, mac, lease):
+    pool = subnet.pool
+    return dict(op='lease', mac=str(mac), ip=str(lease.ip),
+                cidr="%s/%i" % (pool.network, pool.network_size),
+                gateway=str(subnet.server.addr), home=subnet.home,
+                remaining=lease.lastTimeSeen + lease.interval - time.time())
+
+  def label_entry (self, info, label):
+    return dict(op='label', dpid1=info.dpid1, dpid2=info.dpid2,
+                subnet=info.dst_subnet, label=label)
+
+  def snapshot (self, tracker, dhcp, routes):
+    '''
+    The whole state as one entry, at the current sequence number.
+    '''
+
+    entries = [self.host_entry(h) for h in tracker.hosts]
+    for subnet, leases in dhcp.leases.iteritems():
+      for mac, lease in leases.iteritems():
+        entries.append(self.lease_entry(subnet, mac, lease))
+    if routes is not None:
+      entries.extend(self.label_entry(info, label)
+                     for info, label in routes.label_table.iteritems())
+    return dict(op='snapshot', seq=self.seq, plan=dhcp.plan, entries=entries)
+
+  # event handlers
+  def host_event (self, event):
+    if event.leave:
+      self.add(op='leave', mac=str(event.host.macaddr))
+    else:
+      self.add(**self.host_entry(event.host))
+
+  def lease_event (self, event):
+    if event.renew:
+      subnet, lease = core.dhcp_server.find_lease(event.mac)
+      if subnet is not None:
+        self.add(**self.lease_entry(subnet, event.mac, lease))
+    elif event.expire:
+      self.add(op='expire', mac=str(event.mac))
+
+  def lease_renewed (self, mac, subnet, lease):
+    self.add(**self.lease_entry(subnet, mac, lease))
+
+  def label_event (self, event):
+    self.add(**self.label_entry(event.info, event.label))
+
+  def routes_started (self, routes):
+    '''
+    route_manager allocates its first labels before anyone can listen to
+    it, so log the plan and those labels when it comes up.
+    '''
+
+    self.add(op='plan', plan=core.dhcp_server.plan)
+    for info, label in routes.label_table.items():
+      self.add(**self.label_entry(info, label))
+    routes.addListenerByName("LabelEvent", self.label_event)
+
+
+def take_over (replica, flows, idle_timeout = 10):
+  '''
+  Bring this controller's components up on replicated state. flows holds
+  the path rules found on each switch (dpid -> set of path_rule_key()s).
+  '''
+
+  dhcp = core.dhcp_server
+  tracker = core.topology_tracker
+  dhcp.passive = False
+  if replica.plan is None:
+    # never got a plan, plan from scratch on what we can see
+    dhcp._topology_tracker_stable(topology_tracker.StableEvent(True,
+                                                               tracker.graph))
+    return
+
+  dhcp.start(replica.plan, routes = False)
+  now = time.time()
+  leases = {}
+  for mac, lease in replica.leases.iteritems():
+    # every renewal is logged, so a lease that has run out here ran out at
+    # the active controller too, before it got round to expiring it
+    remaining = lease['expires'] - now
+    if remaining <= 0:
+      continue
+    dhcp.restore(EthAddr(str(mac)), str(lease['ip']), str(lease['cidr']),
+                 str(lease['gateway']), lease['home'] and str(lease['home']),
+                 remaining)
+    leases[mac] = lease
+  for mac, (dpid, port) in replica.hosts.iteritems():
+    if dpid not in tracker.graph:
+      continue
+    host = tracker.learn_host(dpid, port, EthAddr(str(mac)))
+    lease = leases.get(mac)
+    if lease is not None:
+      tracker.updateIPInfo(IPAddr(str(lease['ip'])), host, True)
+  route_manager.launch(idle_timeout, replica.labels, flows,
+                       **dhcp.route_options)
+
+
+class Replication (object):
+  '''
+  POX component for either end of the replication stream.
+  '''
+
+  def __init__ (self, listen, peer, standby = False, failover_timeout = 0.5):
+    self.link = PeerLink(listen, [peer], self._handle_message)
+    self.peer = peer
+    self.standby = standby
+    self.failover_timeout = failover_timeout
+    self.serving = not standby
+    self.journal = None
+    self.replica = None
+    if standby:
+      self.replica = Replica()
+      self.last_heard = None
+      self.syncing = True
+      self.waiting = None  # dpids we want flow tables from
+      self.flows = {}
+      self.takeover_time = None
+      self.link.send(peer, dict(op='sync'))
+    else:
+      self.journal = Journal(lambda entry: self.link.send(self.peer, entry))
+    core.openflow.addListeners(self, priority=3)
+    core.listen_to_dependencies(self, ['topology_tracker', 'dhcp_server'])
+    PeerService(self.link).start()
+    Timer(BEAT_INTERVAL, self._tick, recurring=True)
+    log.info('%s controller, replicating with %s',
+             'standby' if standby else 'active', peer)
+
+  def _all_dependencies_met (self):
+    if self.standby:
+      core.dhcp_server.passive = True
+    else:
+      core.topology_tracker.addListenerByName("HostEvent",
+                                              self.journal.host_event)
+      core.dhcp_server.addListenerByName("DHCPLease",
+                                         self.journal.lease_event)
+      core.dhcp_server.add_renewal_hook(self.journal.lease_renewed)
+      core.addListenerByName("ComponentRegistered", self._registered)
+
+  def _registered (self, event):
+    if event.name == 'route_manager':
+      self.journal.routes_started(event.component)
+
+  def _tick (self):
+    if not self.standby:
+      queue = self.link.queues[self.peer]
+      if len(queue) > MAX_BACKLOG:
+        log.warn('standby %s fell behind, dropping its backlog', self.peer)
+        del queue[:]
+      if self.link.connected():
+        self.journal.add(op='beat')
+    elif not self.serving and self.last_heard is not None:
+      if time.time() - self.last_heard > self.failover_timeout:
+        self.takeover()
+
+  def _handle_message (self, msg):
+    if not self.standby:
+      if msg.get('op') == 'sync' and core.hasComponent('dhcp_server'):
+        del self.link.queues[self.peer][:]
+        self.link.send(self.peer, self.journal.snapshot(
+            core.topology_tracker, core.dhcp_server,
+            core.components.get('route_manager')))
+      return
+    if self.serving:
+      return
+    self.last_heard = time.time()
+    if self.replica.apply(msg):
+      self.syncing = False
+    elif not self.syncing:
+      log.warn('missed replication entries, asking for a snapshot')
+      self.syncing = True
+      self.link.send(self.peer, dict(op='sync'))
+
+  # taking over
+  def takeover (self):
+    log.warn('nothing from %s for %.2fs, taking over', self.peer,
+             time.time() - self.last_heard)
+    self.serving = True
+    self._started = time.time()
+    connections = core.openflow.connections.values()
+    self.waiting = set(con.dpid for con in connections)
+    for con in connections:
+      con.send(of.ofp_stats_request(body = of.ofp_flow_stats_request()))
+    if self.waiting:
+      Timer(STATS_TIMEOUT, self._finish)
+    else:
+      self._finish()
+
+  def _handle_FlowStatsReceived (self, event):
+    if not self.waiting:
+      return
+    rules = self.flows.setdefault(event.connection.dpid, set())
+    for stats in event.stats:
+      key = route_manager.path_rule_key(stats)
+      if key is not None:
+        rules.add(key)
+    self.waiting.discard(event.connection.dpid)
+    if not self.waiting:
+      self._finish()
+
+  def _finish (self):
+    if self.waiting is None:
+      return
+    if self.waiting:
+      log.warn('no flow tables from %i switches', len(self.waiting))
+    self.waiting = None
+    take_over(self.replica, self.flows)
+    self.takeover_time = time.time() - self._started
+    log.info('took over with %i hosts and %i leases in %.3fs',
+             len(self.replica.hosts), len(self.replica.leases),
+             self.takeover_time)
+
+  def _handle_PacketIn (self, event):
+    # the active controller is still handling the switches
+    if not self.serving:
+      return EventHalt
+
+
+def launch (listen = '127.0.0.1:7100', peer = '', standby = False,
+            failover_timeout = 0.5):
+  if not core.hasComponent("replication"):
+    core.register("replication", Replication(listen, peer,
+                                             str_to_bool(standby),
+                                             float(failover_timeout)))
@@ -5,15 +5,21 @@
 # POX
 from pox.core import core
 from pox.lib.addresses import EthAddr
-from pox.lib.packet.ethernet import ethernet
+from pox.lib.revent import Event, EventMixin
+from pox.lib.recoco import Timer
+from pox.lib.util import str_to_bool
+from pox.lib.packet.ethernet import ethernet, ETHER_BROADCAST
 from pox.lib.packet.ipv4 import ipv4
 from pox.lib.packet.arp import arp
 import pox.openflow.libopenflow_01 as of
 
+import handover
+
 # networkX
 from networkx.algorithms.shortest_paths.generic import shortest_path
 
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import time
 
 log = core.getLogger()
 all_ports = of.OFPP_FLOOD
@@ -21,6 +27,63 @@ GATEWAY_DUMMY_MAC = '03:00:00:00:be:ef'
 LABEL_START = 16
 LabelInfo = namedtuple('LabelInfo', 'dpid1 dpid2 dst_subnet')
 
+# packets held for destinations we don't know yet: at most this many per
+# destination, and by default for this many destinations, for this many
+# seconds
+PENDING_PER_DEST = 4
+PENDING_DESTS = 1024
+PENDING_TIMEOUT = 3.0
+
+# every probe goes out of every host port on the edge switches, so by
+# default at most this many are sent a second, and this many a second for
+# packet-ins from any one switch port
+PROBE_RATE = 20
+PROBE_SOURCE_RATE = 2
+PROBE_WINDOW = 1.0
+
+# hosts are told the gateway's MAC this long after their DHCP ACK, once
+# they have had time to put the address on their interface
+ADVERTISE_DELAY = 1.0
+# packed gateway ARP frames kept before the cache is started over
+GATEWAY_CACHE_SIZE = 4096
+
+
+def path_rule_key (stats):
+  '''
+  Given a flow stats entry, return (inlabel, outlabel, port) if it is one
+  of the label path rules install_path_rule() puts on core switches, or
+  None.
+  '''
+
+  m, a = stats.match, stats.actions
+  if (m.dl_vlan is None or m.dl_type is not None or m.nw_dst is not None or
+      len(a) != 2 or not isinstance(a[0], of.ofp_action_vlan_vid) or
+      not isinstance(a[1], of.ofp_action_output)):
+    return None
+  return (m.dl_vlan, a[0].vlan_vid, a[1].port)
+
+
+class Pending (object):
+  '''
+  Packet-ins held for a destination IP nobody has been seen with yet.
+  '''
+
+  def __init__ (self):
+    self.created = time.time()
+    self.events = []
+    self.probed = False
+
+
+class LabelEvent (Event):
+  '''
+  Event when a label is allocated for a link and destination subnet.
+  '''
+
+  def __init__ (self, info, label):
+    super(LabelEvent, self).__init__()
+    self.info = info
+    self.label = label
+
 
 def dpid_to_mac (dpid):
   '''
@@ -30,17 +93,73 @@ def dpid_to_mac (dpid):
   return EthAddr("%012x" % (dpid & 0xffFFffFFffFF,))
 
 
-class ProactiveFlows (object):
+class ProactiveFlows (EventMixin):
   '''
   Install flow rules based on network topology. Rules are installed based on
   switch location in the network. Core switches receive broad L3 rules at the
   subnet level, while non-core switches receive IP-specific rules.
+
+  A controller taking over from another one passes the labels that one
+  allocated and the path rules found on the switches (dpid -> set of
+  path_rule_key()s); path rules already in place are then left alone and
+  ones no longer wanted are deleted, rather than reinstalling them all.
+
+  Packets to an IP no host has been seen with are held for a while rather
+  than dropped, and one ARP request goes out for the address. When
+  topology_tracker learns who has it, the held packets are handled like
+  new packet-ins, which installs the rules for them. Each of those ARP
+  requests is flooded out of every host port, so they are rate limited,
+  overall and per switch port the packet-ins come from: a host scanning
+  addresses gets a few probes a second, not one per address.
+
+  A controller warm starting from a saved plan (see plan_cache.py) passes
+  the labels and the path rules (dpid, inlabel, outlabel, port) that went
+  with it, which are installed as they are instead of working out the
+  shortest path between every pair of edge switches again.
+
+  Every host ARPs for its default gateway, so the gateway is advertised to
+  a host right after its DHCP ACK and again whenever it moves: a unicast
+  ARP request from the gateway for the host's own address, which makes
+  the host add the gateway to its ARP cache (an unsolicited reply would
+  be ignored by hosts with no entry for it). The host's answer is dropped
+  at the edge switch. The packed frames, and the replies to the gateway
+  ARP requests that still come in, are cached per gateway and requester.
   '''
 
-  def __init__ (self, idle_timeout=300):
+  _eventMixin_events = set([LabelEvent])
+
+  def __init__ (self, idle_timeout=300, labels=None, existing=None,
+                rules=None, pending_dests=PENDING_DESTS,
+                pending_timeout=PENDING_TIMEOUT, probe_rate=PROBE_RATE,
+                probe_source_rate=PROBE_SOURCE_RATE, advertise_gateway=True):
     self.idle_timeout = idle_timeout
-    self.label_table = {} # (dpid1, dpid2, dst_subnet) -> label number
-    self.label_count = LABEL_START
+    self.label_table = dict(labels or {}) # (dpid1, dpid2, dst_subnet) -> label number
+    self.label_count = max(self.label_table.values() + [LABEL_START - 1]) + 1
+    self.existing = existing
+    self.kept = {}    # dpid -> path rules in existing we still want
+    self.reused = 0   # path rules found in place
+    self.removed = 0  # stale path rules deleted
+    self.rules = rules
+    self.send_flow_removed = False # ask for FlowRemoved on host rules
+    self.pending = OrderedDict() # IP -> Pending, oldest first
+    self.pending_dests = pending_dests
+    self.pending_timeout = pending_timeout
+    # packets held, flushed, expired and not held for lack of room;
+    # destinations evicted, ARP probes sent and held back by the limits
+    self.pending_stats = dict(held = 0, flushed = 0, expired = 0,
+                              evicted = 0, overflow = 0, probes = 0,
+                              throttled = 0)
+    self.probe_rate = probe_rate # probes a second
+    self.probe_source_rate = probe_source_rate # and per switch port
+    self._probe_window = 0
+    self._probes = 0
+    self._probe_sources = {} # (dpid, port) -> probes this window
+    self.path_rules = set() # (dpid, inlabel, outlabel, port) installed
+    self.advertise = advertise_gateway
+    # (opcode, gateway IP, dpid, host MAC, host IP) -> packed ARP frame
+    self.gateway_frames = {}
+    # gateway ARP requests answered, advertisements sent and frames packed
+    self.gateway_stats = dict(answered = 0, advertised = 0, packed = 0)
     core.openflow.addListeners(self)
     core.listen_to_dependencies(self, ['topology_tracker', 'dhcp_server'], short_attrs=True)
 
@@ -49,6 +168,33 @@ class ProactiveFlows (object):
     When all modules are loaded, install base flow rules based on network.
     '''
 
+    if self.rules is not None:
+      # path rules saved with the plan, their labels are already in place
+      for dpid, inlabel, outlabel, port in self.rules:
+        self.send_path_rule(dpid, inlabel, outlabel, port)
+      self.rules = None
+    else:
+      self.install_path_rules()
+
+    if self.existing is not None:
+      self.remove_stale_rules()
+
+    self.topology_tracker.addListenerByName("HostIPEvent", self._host_ip)
+    self._t = Timer(1, self._expire_pending, recurring = True)
+
+    if self.advertise:
+      self.dhcp_server.addListenerByName("DHCPLease", self._lease)
+      self.topology_tracker.addListenerByName("HostEvent", self._host_moved)
+      for dpid in self.dhcp_server.edges:
+        self.install_advert_drop(dpid)
+    log.info("route_manager ready")
+
+  def install_path_rules (self):
+    '''
+    Label the shortest path between every pair of edge switches and
+    install path rules along it.
+    '''
+
     graph = self.topology_tracker.graph
     edge_switches = list(self.dhcp_server.edges)
 
@@ -66,8 +212,6 @@ class ProactiveFlows (object):
             self.install_path_rule(info, inlabel, outlabel)
           inlabel = outlabel
 
-    log.info("route_manager ready")
-
   def get_label (self, info):
     '''
     Given information about a link and destination subnet,
@@ -77,6 +221,7 @@ class ProactiveFlows (object):
     if info not in self.label_table:
       self.label_table[info] = self.label_count
       self.label_count += 1
+      self.raiseEventNoErrors(LabelEvent, info, self.label_table[info])
     return self.label_table[info]
 
   def _handle_PacketIn (self, event):
@@ -97,6 +242,9 @@ class ProactiveFlows (object):
       # this is the host sending a packet to its "default gateway" which doesn't
       # really exist
       dst_host = self.topology_tracker.get_host_info(ip_packet.dstip)
+      if dst_host is None:
+        self.hold(ip_packet.dstip, event)
+        return
       true_dst = dst_host.macaddr
 
       dst_info = self.dhcp_server.edge_to_tuple[dst_host.dpid]
@@ -117,11 +265,15 @@ class ProactiveFlows (object):
         actions = self.install_push_rule(push_info, self.get_label(push_info),
                                          ip_packet.dstip, true_dst, packet.dst)
         self.install_pop_rule(dst_host.dpid, dst_host.macaddr, self.get_label(pop_info))
+      handover.mark(packet.src, 'rule')
+      handover.mark(true_dst, 'rule')
 
       # forward packet
       msg = of.ofp_packet_out(data = event.ofp)
       msg.actions = actions
       event.connection.send(msg)
+      handover.mark(packet.src, 'forwarded')
+      handover.mark(true_dst, 'forwarded')
 
       log.debug("added flows for {0} --> {1}".format(ip_packet.srcip, ip_packet.dstip))
 
@@ -141,6 +293,20 @@ class ProactiveFlows (object):
           if arp_packet.protosrc != 0:
             if arp_packet.opcode == arp.REQUEST:
 
+              if self.dhcp_server.is_router(arp_packet.protodst):
+                # the same hosts ask for their gateway over and over
+                msg = of.ofp_packet_out()
+                msg.data = self.gateway_arp(arp.REPLY, arp_packet.protodst,
+                                            dpid, arp_packet.hwsrc,
+                                            arp_packet.protosrc)
+                msg.actions.append(of.ofp_action_output(port=of.OFPP_IN_PORT))
+                msg.in_port = event.port
+                event.connection.send(msg)
+                self.gateway_stats['answered'] += 1
+                log.debug("%i %i answering ARP for gateway %s" % (dpid,
+                    event.port, str(arp_packet.protodst)))
+                return
+
               # create an ARP reply header
               arp_reply = arp()
               arp_reply.hw_type = arp_packet.hwtype
@@ -152,19 +318,13 @@ class ProactiveFlows (object):
               arp_reply.protodst = arp_packet.protosrc
               arp_reply.protosrc = arp_packet.protodst
 
-              if self.dhcp_server.is_router(arp_packet.protodst):
-                arp_reply.hwsrc = EthAddr(GATEWAY_DUMMY_MAC)
-              else:
-                host = self.topology_tracker.get_host_info(arp_packet.protodst)
-                arp_reply.hwsrc = host.macaddr
-
-              if arp_reply.hwsrc is None:
-                #log.info("Host unknown, broadcasting ARP")
-                #msg = of.ofp_packet_out(data = event.ofp)
-                #msg.actions.append(of.ofp_action_output(port = all_ports))
-                #event.connection.send(msg)
-                log.warn('Host {0} unknown'.format(arp_packet.protodst))
+              host = self.topology_tracker.get_host_info(arp_packet.protodst)
+              if host is None:
+                # answer once we know who has it
+                log.debug('Host {0} unknown'.format(arp_packet.protodst))
+                self.hold(arp_packet.protodst, event)
                 return
+              arp_reply.hwsrc = host.macaddr
 
               # create an Ethernet header and encapsulate
               eth = ethernet(type=packet.type, src=dpid_to_mac(dpid),
@@ -184,6 +344,180 @@ class ProactiveFlows (object):
 
       return
 
+  # gateway advertisement
+  def gateway_arp (self, opcode, gateway, dpid, mac, ip):
+    '''
+    A packed ARP frame from a subnet's gateway to a host: a reply to the
+    host's request for the gateway, or the request that advertises it.
+    '''
+
+    key = (opcode, gateway, dpid, mac, ip)
+    data = self.gateway_frames.get(key)
+    if data is not None:
+      return data
+
+    r = arp()
+    r.opcode = opcode
+    r.hwsrc = EthAddr(GATEWAY_DUMMY_MAC)
+    r.protosrc = gateway
+    r.hwdst = mac
+    r.protodst = ip
+    e = ethernet(type=ethernet.ARP_TYPE, src=dpid_to_mac(dpid), dst=mac)
+    e.payload = r
+    data = e.pack()
+
+    if len(self.gateway_frames) >= GATEWAY_CACHE_SIZE:
+      self.gateway_frames.clear()
+    self.gateway_frames[key] = data
+    self.gateway_stats['packed'] += 1
+    return data
+
+  def advertise_gateway (self, mac):
+    '''
+    Send a host an ARP request from its gateway, out of the port it is on.
+    '''
+
+    subnet, lease = self.dhcp_server.find_lease(mac)
+    graph = self.topology_tracker.graph
+    node = graph.node.get(str(mac))
+    if subnet is None or node is None or 'info' not in node:
+      return
+    host = node['info']
+    if host.dpid not in graph:
+      return
+    msg = of.ofp_packet_out()
+    msg.data = self.gateway_arp(arp.REQUEST, subnet.server.addr, host.dpid,
+                                host.macaddr, lease.ip)
+    msg.actions.append(of.ofp_action_output(port = host.port))
+    graph.node[host.dpid]['connection'].send(msg)
+    self.gateway_stats['advertised'] += 1
+    log.debug("advertised gateway %s to %s on %s port %s", subnet.server.addr,
+              mac, host.dpid, host.port)
+
+  def install_advert_drop (self, dpid):
+    '''
+    Drop hosts' answers to the gateway advertisement at the edge switch.
+    '''
+
+    msg = of.ofp_flow_mod()
+    msg.match.dl_type = ethernet.ARP_TYPE
+    msg.match.nw_proto = arp.REPLY
+    msg.match.dl_dst = EthAddr(GATEWAY_DUMMY_MAC)
+    core.openflow.sendToDPID(dpid, msg)
+
+  def _handle_ConnectionUp (self, event):
+    if self.advertise and event.dpid in self.dhcp_server.edges:
+      self.install_advert_drop(event.dpid)
+
+  def _lease (self, event):
+    if not event.renew or event._nak:
+      return
+    Timer(ADVERTISE_DELAY, self.advertise_gateway, args = [event.mac])
+
+  def _host_moved (self, event):
+    if event.move:
+      self.advertise_gateway(event.host.macaddr)
+
+  # packets for unknown destinations
+  def hold (self, ip, event):
+    '''
+    Hold a packet-in for an IP we don't know yet. The first one for an IP
+    sends out an ARP request for it, or a later one if the rate limits
+    held that back.
+    '''
+
+    stats = self.pending_stats
+    entry = self.pending.get(ip)
+    if entry is None:
+      if len(self.pending) >= self.pending_dests:
+        self.pending.popitem(last = False)
+        stats['evicted'] += 1
+      entry = self.pending[ip] = Pending()
+    if not entry.probed:
+      if self._may_probe((event.dpid, event.port)):
+        entry.probed = True
+        self.probe(ip)
+      else:
+        stats['throttled'] += 1
+    if len(entry.events) < PENDING_PER_DEST:
+      entry.events.append(event)
+      stats['held'] += 1
+    else:
+      stats['overflow'] += 1
+
+  def _may_probe (self, source):
+    '''
+    Whether a probe for a packet-in from source, a (dpid, port), fits in
+    the rate limits. Counts it if it does.
+    '''
+
+    now = time.time()
+    if now >= self._probe_window + PROBE_WINDOW:
+      self._probe_window = now
+      self._probes = 0
+      self._probe_sources = {}
+    if self._probes >= self.probe_rate:
+      return False
+    n = self._probe_sources.get(source, 0)
+    if n >= self.probe_source_rate:
+      return False
+    self._probe_sources[source] = n + 1
+    self._probes += 1
+    return True
+
+  def probe (self, ip):
+    '''
+    Send one ARP request for ip out of every host port on the edge
+    switches. It comes from topology_tracker's ping address, so the reply
+    comes back to topology_tracker.
+    '''
+
+    tracker = self.topology_tracker
+    r = arp()
+    r.opcode = arp.REQUEST
+    r.hwdst = ETHER_BROADCAST
+    r.hwsrc = tracker.ping_src_mac
+    r.protodst = ip
+    e = ethernet(type=ethernet.ARP_TYPE, src=r.hwsrc, dst=ETHER_BROADCAST)
+    e.payload = r
+    data = e.pack()
+
+    for dpid in self.dhcp_server.edges:
+      if dpid not in tracker.graph:
+        continue
+      connection = tracker.graph.node[dpid]['connection']
+      msg = of.ofp_packet_out(data = data)
+      # the ports the switch has now, including ones added since it
+      # connected
+      for port in connection.ports.keys():
+        if port < of.OFPP_MAX and tracker.is_edge_port(dpid, port):
+          msg.actions.append(of.ofp_action_output(port = port))
+      if msg.actions:
+        connection.send(msg)
+    self.pending_stats['probes'] += 1
+
+  def _host_ip (self, event):
+    '''
+    A host turned up with an IP, handle anything held for it.
+    '''
+
+    entry = self.pending.pop(event.ip, None)
+    if entry is None:
+      return
+    self.pending_stats['flushed'] += len(entry.events)
+    for held in entry.events:
+      self._handle_PacketIn(held)
+
+  def _expire_pending (self):
+    deadline = time.time() - self.pending_timeout
+    # oldest first, so stop at the first one that is still waiting
+    while self.pending:
+      ip, entry = next(self.pending.iteritems())
+      if entry.created > deadline:
+        break
+      del self.pending[ip]
+      self.pending_stats['expired'] += len(entry.events)
+
   # flow installation functions
   def install_same_subnet_rule (self, dpid, connection, ip, raddr, dstaddr):
     '''
@@ -214,6 +548,8 @@ class ProactiveFlows (object):
 
     # set a timeout and send
     msg.idle_timeout = self.idle_timeout
+    if self.send_flow_removed:
+      msg.flags |= of.OFPFF_SEND_FLOW_REM
     connection.send(msg)
 
     return actions
@@ -280,6 +616,8 @@ class ProactiveFlows (object):
 
     # set a timeout and send
     msg.idle_timeout = self.idle_timeout
+    if self.send_flow_removed:
+      msg.flags |= of.OFPFF_SEND_FLOW_REM
     self.topology_tracker.graph.node[dpid]['connection'].send(msg)
 
   def install_path_rule (self, info, inlabel, outlabel):
@@ -287,6 +625,22 @@ class ProactiveFlows (object):
     Install a flow rule on a core switch to route based on label.
     '''
 
+    port = self.topology_tracker.get_link_port(info.dpid1, info.dpid2)
+    if port is None:
+      log.warn("No port connecting {0} --> {1}".format(info.dpid1, info.dpid2))
+      return
+    self.send_path_rule(info.dpid1, inlabel, outlabel, port)
+
+  def send_path_rule (self, dpid, inlabel, outlabel, port):
+    '''
+    Send a label path rule to a switch, unless it is already there.
+    '''
+
+    rule = (dpid, inlabel, outlabel, port)
+    if rule in self.path_rules:
+      return
+    self.path_rules.add(rule)
+
     # message for switch
     msg = of.ofp_flow_mod()
 
@@ -299,17 +653,55 @@ class ProactiveFlows (object):
     msg.actions.append(of.ofp_action_vlan_vid(vlan_vid=outlabel))
 
     # set output port action
-    port = self.topology_tracker.get_link_port(info.dpid1, info.dpid2)
-    if port is None:
-      log.warn("No port connecting {0} --> {1}".format(info.dpid1, info.dpid2))
-      return
     msg.actions.append(of.ofp_action_output(port = port))
 
+    # leave it be if the switch already has it
+    if self.existing is not None:
+      key = (inlabel, outlabel, port)
+      if key in self.existing.get(dpid, ()):
+        self.kept.setdefault(dpid, set()).add(key)
+        self.reused += 1
+        return
+
     # set a timeout and send
     #msg.idle_timeout = None # these flows are static
-    self.topology_tracker.graph.node[info.dpid1]['connection'].send(msg)
+    self.topology_tracker.graph.node[dpid]['connection'].send(msg)
 
+  def remove_stale_rules (self):
+    '''
+    Delete the path rules found on the switches that the current labels
+    no longer call for.
+    '''
 
-def launch (idle_timeout=10):
+    graph = self.topology_tracker.graph
+    # a rule sent for an inlabel has the same match as the old one and took
+    # its place, deleting the old one would delete it
+    inlabels = {}
+    for dpid, inlabel, _, _ in self.path_rules:
+      inlabels.setdefault(dpid, set()).add(inlabel)
+    for dpid, rules in self.existing.iteritems():
+      if dpid not in graph:
+        continue
+      in_use = inlabels.get(dpid, ())
+      for inlabel, outlabel, port in rules - self.kept.get(dpid, set()):
+        if inlabel in in_use:
+          continue
+        msg = of.ofp_flow_mod(command = of.OFPFC_DELETE_STRICT)
+        msg.match.dl_vlan = inlabel
+        graph.node[dpid]['connection'].send(msg)
+        self.removed += 1
+    log.info("reused %i path rules, removed %i", self.reused, self.removed)
+    self.existing = None
+    self.kept = {}
+
+
+def launch (idle_timeout=10, labels=None, existing=None, rules=None,
+            pending_dests=PENDING_DESTS, pending_timeout=PENDING_TIMEOUT,
+            probe_rate=PROBE_RATE, probe_source_rate=PROBE_SOURCE_RATE,
+            advertise_gateway=True):
   if not core.hasComponent("route_manager"):
-    core.register("route_manager", ProactiveFlows(int(idle_timeout)))
+    routes = ProactiveFlows(int(idle_timeout), labels, existing, rules,
+                            int(pending_dests), float(pending_timeout),
+                            int(probe_rate), int(probe_source_rate),
+                            str_to_bool(advertise_gateway))
+    core.register("route_manager", routes)
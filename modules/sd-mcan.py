@@ -7,19 +7,144 @@
 #       - discovery: openflow implementation that handles link up/down
 #   This thesis:
 #       - topology_tracker: dynamically tracks the entire topology, including
-#                           hosts and switches
+#                           hosts and switches. Goes stable after --settle
+#                           quiet seconds, or as soon as the fabric matches
+#                           --expected_switches, --expected_links and/or
+#                           --expected_fingerprint.
 #       - dhcp_server: handles all of the DHCP functionality of this system
-#       - route_manager: installs all flow entries into the switches
+#       - route_manager: installs all flow entries into the switches, and
+#                        tells hosts their gateway's MAC after DHCP and
+#                        after moves unless --advertise_gateway=False.
+#                        Packets to unknown IPs are held, for up to
+#                        --pending_dests IPs for --pending_timeout seconds,
+#                        while an ARP probe goes out for them; at most
+#                        --probe_rate probes a second, and
+#                        --probe_source_rate for any one switch port
+#   Optional:
+#       - packetin_workers: parses DHCP/ARP packet-ins in worker processes,
+#                           started with --workers=N
+#       - cluster: makes this controller one region of a cluster, started
+#                  with --cluster=<listen addr> --peers=<addr,addr,...>.
+#                  Give every region its own --network.
+#       - replication: streams state to a hot standby controller, started
+#                      with --replicate=<listen addr> --replica=<peer addr>
+#                      on both, plus --standby on the standby.
+#       - host_liveness: refreshes hosts from their rules' flow counters
+#                        instead of ARP pinging them, started with
+#                        --liveness=<poll seconds>
+#       - storm_guard: drops packets from sources sending more than
+#                      --storm_rate packet-ins a second, for a while
+#       - plan_cache: saves the plan to a file and warm starts from it when
+#                     the topology matches, started with --plan_cache=<file>
+#       - instrumentation: handler latency histograms, queue depths and
+#                          messages sent per switch, read with
+#                          core.instrumentation.show() on the POX CLI. On
+#                          unless --instrument=False; --instrument_log=<s>
+#                          logs the busiest handlers every s seconds
+#       - metrics: serves hosts, leases, pool use, labels, flows and handler
+#                  latency to Prometheus at http://<addr>/metrics, started
+#                  with --metrics=<listen addr>
+#       - handover: timelines of what the controller does when a host
+#                   moves, from its first packet-in at the new port to the
+#                   first packet forwarded for it, started with --handover.
+#                   Read with core.handover.snapshot(), or from
+#                   http://<metrics addr>/handover with --metrics
+#       - profiler: samples the scheduler's stack and writes collapsed
+#                   stacks for flame graphs. Idle until started with
+#                   core.profiler.start() on the POX CLI or SIGUSR2, and
+#                   stopped the same way; --profile_rate sets samples a
+#                   second, --profiler=False leaves it out
+#       - flow_stats: counts the rules in every switch by class (core, push,
+#                     pop, ...) every --flow_stats=<seconds>, read with
+#                     core.flow_stats.snapshot() or tools/get_flow_data.py
+#                     from http://<metrics addr>/flows with --metrics
+#       - recorder: records packet-ins, connections, port status and links
+#                   to a trace for tools/replay.py, started with
+#                   --record=<file>
 # 2017 Adam Calabrigo
 
 import pox.topology
 import pox.openflow.discovery
+from pox.lib.util import str_to_bool
 import topology_tracker
 import dhcp_server
+import route_manager
+import packetin_workers
+import cluster as cluster_module
+import replication
+import plan_cache as plan_cache_module
+import host_liveness
+import storm_guard
+import recorder
+import instrumentation
+import metrics as metrics_module
+import handover as handover_module
+import profiler as profiler_module
+import flow_stats as flow_stats_module
 
 
-def launch (debug="False"):
+def launch (debug="False", network="192.168.0.0/24",
+            lease_time=dhcp_server.timeoutSec['leaseInterval'],
+            lease_jitter=0.0, adaptive_leases=False, core_mode='clique',
+            core_dpids='', clique_timeout=1.0, workers=0, cluster='',
+            peers='', replicate='', replica='', standby=False,
+            failover_timeout=0.5, plan_cache='', settle=None,
+            expected_switches=None, expected_links=None,
+            expected_fingerprint=None, liveness=0, storm_rate=0,
+            advertise_gateway=True, record='', instrument=True,
+            instrument_log=0, metrics='', metrics_interval=5,
+            handover=False, handover_size=1000, profiler=True,
+            profile_rate=100, flow_stats=0,
+            pending_dests=route_manager.PENDING_DESTS,
+            pending_timeout=route_manager.PENDING_TIMEOUT,
+            probe_rate=route_manager.PROBE_RATE,
+            probe_source_rate=route_manager.PROBE_SOURCE_RATE):
+  if str_to_bool(instrument):
+    # before anything registers the handlers it wraps
+    instrumentation.launch(instrument_log)
   pox.topology.launch()
   pox.openflow.discovery.launch()
-  dhcp_server.launch()
-  topology_tracker.launch(debug)
+  route_options = dict(pending_dests=pending_dests,
+                       pending_timeout=pending_timeout,
+                       probe_rate=probe_rate,
+                       probe_source_rate=probe_source_rate,
+                       advertise_gateway=advertise_gateway)
+  if record:
+    # what replay needs to bring the modules up the same way
+    recorder.launch(record, network=network, lease_time=lease_time,
+                    lease_jitter=lease_jitter,
+                    adaptive_leases=adaptive_leases, core_mode=core_mode,
+                    core_dpids=core_dpids, clique_timeout=clique_timeout,
+                    settle=settle, expected_switches=expected_switches,
+                    expected_links=expected_links,
+                    expected_fingerprint=expected_fingerprint,
+                    **route_options)
+  dhcp_server.launch(network=network, lease_time=lease_time,
+                     lease_jitter=lease_jitter,
+                     adaptive_leases=adaptive_leases, core_mode=core_mode,
+                     core_dpids=core_dpids, clique_timeout=clique_timeout,
+                     route_options=route_options)
+  topology_tracker.launch(debug, settle=settle,
+                          expected_switches=expected_switches,
+                          expected_links=expected_links,
+                          expected_fingerprint=expected_fingerprint)
+  if str_to_bool(handover):
+    handover_module.launch(handover_size)
+  if int(workers) > 0:
+    packetin_workers.launch(workers)
+  if cluster:
+    cluster_module.launch(cluster, peers)
+  if replicate:
+    replication.launch(replicate, replica, standby, failover_timeout)
+  if plan_cache:
+    plan_cache_module.launch(plan_cache)
+  if float(liveness) > 0:
+    host_liveness.launch(liveness)
+  if int(storm_rate) > 0:
+    storm_guard.launch(storm_rate)
+  if metrics:
+    metrics_module.launch(metrics, metrics_interval)
+  if float(flow_stats) > 0:
+    flow_stats_module.launch(flow_stats)
+  if str_to_bool(profiler):
+    profiler_module.launch(profile_rate)
@@ -0,0 +1,172 @@
+# storm_guard.py
+# Packet-in storm protection for SD-MCAN.
+#
+# Every packet-in costs the controller a parse and a trip through
+# topology_tracker, dhcp_server and route_manager, and a host spraying
+# packets at unknown or unroutable addresses gets one for each packet. This
+# counts packet-ins per switch port, and per source MAC on each port, over
+# one-second windows. A source that goes over its rate gets a drop rule
+# with a hard timeout on the port it comes in on, and its packet-ins are
+# thrown away before anyone else sees them until the rule runs out. Each
+# time a source trips again soon after, the block is twice as long, up to
+# max_block.
+#
+# Counts are read straight from the raw frame, so a packet-in costs this
+# module a couple of dictionary updates and no parsing.
+
+# POX
+from pox.core import core
+from pox.lib.revent import EventHalt
+from pox.lib.addresses import EthAddr
+import pox.openflow.libopenflow_01 as of
+from pox.lib.packet.ethernet import ethernet
+
+# general
+import struct
+import time
+
+log = core.getLogger()
+
+# window packet-ins are counted over, in seconds
+WINDOW = 1.0
+
+# drop rules go above everything route_manager and dhcp_server install
+DROP_PRIORITY = of.OFP_DEFAULT_PRIORITY + 100
+
+
+class Block (object):
+  '''
+  A source that is being dropped: a port, or a MAC on a port.
+  '''
+
+  def __init__ (self, dpid, port, mac, level, until):
+    self.dpid = dpid
+    self.port = port
+    self.mac = mac     # EthAddr, or None when the whole port is blocked
+    self.level = level # how many times it tripped in a row
+    self.until = until
+
+  def to_dict (self, now):
+    return dict(dpid = self.dpid, port = self.port,
+                mac = self.mac and str(self.mac), level = self.level,
+                remaining = max(0.0, self.until - now))
+
+
+class StormGuard (object):
+  '''
+  POX component that rate limits packet-ins per port and per source MAC.
+  '''
+
+  def __init__ (self, mac_rate = 100, port_rate = 200, block = 5.0,
+                max_block = 300.0):
+    self.mac_rate = mac_rate   # packet-ins per second from one MAC
+    self.port_rate = port_rate # packet-ins per second from one port
+    self.block = block         # seconds a first offender is dropped for
+    self.max_block = max_block
+
+    self.window = 0
+    self.macs = {}    # (dpid, port, raw source MAC) -> packet-ins this window
+    self.ports = {}   # (dpid, port) -> packet-ins this window
+    self.blocks = {}  # (dpid, port) or (dpid, port, raw MAC) -> Block
+
+    # counters
+    self.packet_ins = 0
+    self.dropped = 0  # packet-ins thrown away from blocked sources
+    self.trips = 0    # drop rules installed
+
+    # see packet-ins before everyone else
+    core.openflow.addListeners(self, priority=4)
+    log.info("limiting packet-ins to %s/s per MAC and %s/s per port",
+             mac_rate, port_rate)
+
+  def _handle_PacketIn (self, event):
+    if getattr(event, '_sdmcan_pooled', False):
+      # packetin_workers passing one back, it was counted the first time
+      return
+    data = event.data
+    if data is None or len(data) < 14:
+      return
+    if struct.unpack_from('!H', data, 12)[0] == ethernet.LLDP_TYPE:
+      return
+    self.packet_ins += 1
+
+    now = time.time()
+    if now >= self.window + WINDOW:
+      # a new window, and the old counts are dropped with it
+      self.window = now
+      self.macs = {}
+      self.ports = {}
+
+    port = (event.dpid, event.port)
+    # a MAC is blocked on the port it came in on, as is its drop rule
+    mac = (event.dpid, event.port, data[6:12])
+    if self.blocks:
+      for key in (port, mac):
+        blocked = self.blocks.get(key)
+        if blocked is not None and blocked.until > now:
+          self.dropped += 1
+          return EventHalt
+
+    n = self.macs[mac] = self.macs.get(mac, 0) + 1
+    if n > self.mac_rate:
+      if self.trip(mac, event.dpid, event.port, EthAddr(mac[2]), now):
+        return EventHalt
+    n = self.ports[port] = self.ports.get(port, 0) + 1
+    if n > self.port_rate:
+      if self.trip(port, event.dpid, event.port, None, now):
+        return EventHalt
+
+  def trip (self, key, dpid, port, mac, now):
+    '''
+    Start dropping a source that went over its rate. Returns False if it
+    can't be.
+    '''
+
+    if core.hasComponent('topology_tracker'):
+      if not core.topology_tracker.is_edge_port(dpid, port):
+        # never cut a link between switches
+        return False
+
+    # trip again soon after the last block ran out and it lasts longer
+    level = 0
+    last = self.blocks.get(key)
+    if last is not None and now - last.until < self.max_block:
+      level = last.level + 1
+    timeout = min(self.block * 2 ** level, self.max_block)
+    self.blocks[key] = Block(dpid, port, mac, level, now + timeout)
+    self.trips += 1
+
+    msg = of.ofp_flow_mod()
+    msg.priority = DROP_PRIORITY
+    msg.match.in_port = port
+    if mac is not None:
+      msg.match.dl_src = mac
+    msg.hard_timeout = int(round(timeout))
+    core.openflow.sendToDPID(dpid, msg)
+    log.warn("dropping packets from %s on %s port %s for %is",
+             mac or 'everything', dpid, port, msg.hard_timeout)
+
+    # forget blocks that ran out long enough ago not to count
+    for k in [k for k, b in self.blocks.iteritems()
+              if now - b.until > self.max_block]:
+      del self.blocks[k]
+    return True
+
+  def snapshot (self):
+    '''
+    Counters and the sources being dropped right now.
+    '''
+
+    now = time.time()
+    return dict(packet_ins = self.packet_ins, dropped = self.dropped,
+                trips = self.trips,
+                blocked = [b.to_dict(now) for b in self.blocks.itervalues()
+                           if b.until > now])
+
+
+def launch (mac_rate = 100, port_rate = None, block = 5, max_block = 300):
+  mac_rate = int(mac_rate)
+  port_rate = 2 * mac_rate if port_rate is None else int(port_rate)
+  if not core.hasComponent("storm_guard"):
+    core.register("storm_guard", StormGuard(mac_rate, port_rate,
+                                            float(block), float(max_block)))
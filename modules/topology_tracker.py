@@ -19,6 +19,7 @@ from pox.lib.util import str_to_bool
 import networkx as nx
 
 from collections import namedtuple
+import hashlib
 import time
 
 log = core.getLogger()
@@ -37,6 +38,38 @@ timeoutSec = dict(
 DEFAULT_ARP_PING_SRC_MAC = '02:00:00:00:be:ef'
 New = namedtuple('New', 'dpid port')
 
+
+def _element_hash (element):
+  return int(hashlib.sha1(repr(element)).hexdigest()[:16], 16)
+
+def switch_hash (dpid):
+  return _element_hash(('switch', dpid))
+
+def link_hash (link):
+  '''
+  Hash of a discovery Link, the same whichever way round it was seen.
+  '''
+
+  ends = sorted([(link.dpid1, link.port1), (link.dpid2, link.port2)])
+  return _element_hash(('link', ends[0], ends[1]))
+
+def fingerprint (graph):
+  '''
+  A fingerprint of the switches of a graph and the links between them,
+  with their ports. It is the XOR of a hash of every switch and link, so
+  DynamicTopology can keep it up to date as they come and go.
+  '''
+
+  fp = 0
+  for n in graph:
+    if not isinstance(n, basestring):
+      fp ^= switch_hash(n)
+  for _, _, data in graph.edges_iter(data = True):
+    link = data.get('link')
+    if link is not None:
+      fp ^= link_hash(link)
+  return '%016x' % (fp,)
+
 # from host_tracker.py
 class Alive (object):
   """
@@ -50,8 +83,11 @@ class Alive (object):
   def expired (self):
     return time.time() > self.lastTimeSeen + self.interval
 
-  def refresh (self):
-    self.lastTimeSeen = time.time()
+  def refresh (self, when = None):
+    if when is None:
+      self.lastTimeSeen = time.time()
+    else:
+      self.lastTimeSeen = max(self.lastTimeSeen, when)
 
 
 class PingCtrl (Alive):
@@ -142,8 +178,8 @@ class Host (Alive):
 
 class StableEvent (Event):
   '''
-  Event when the topology has not experienced any changes in a
-  predetermined interval of time.
+  Event when the topology first settles: it has not changed for the settle
+  interval, or it matches the expected fabric.
   '''
 
   def __init__ (self, stable, graph):
@@ -152,6 +188,22 @@ class StableEvent (Event):
     self.graph = graph
 
 
+class TopologyChangeEvent (Event):
+  '''
+  Event when switches or links change once the topology is stable. Changes
+  are collected until the topology settles again and raised together.
+  '''
+
+  def __init__ (self, graph, switches_up, switches_down, links_up,
+                links_down):
+    super(TopologyChangeEvent, self).__init__();
+    self.graph = graph
+    self.switches_up = switches_up     # dpids
+    self.switches_down = switches_down # dpids
+    self.links_up = links_up           # discovery Links
+    self.links_down = links_down       # discovery Links
+
+
 class DHCPEvent (Event):
   '''
   Event when the topology receives a DHCP packet.
@@ -165,15 +217,41 @@ class DHCPEvent (Event):
 
 class FlowDeleteEvent (Event):
   '''
-  Event when the topology needs to delete a flow.
+  Event when the topology needs to delete the flows to one or more IPs.
+  ips has them all, ip is the first.
   '''
 
-  def __init__ (self,  ip, graph):
+  def __init__ (self,  ip = None, graph = None, ips = None):
     super(FlowDeleteEvent, self).__init__();
-    self.ip = ip
+    self.ips = list(ips) if ips is not None else [ip]
+    self.ip = self.ips[0]
     self.graph = graph
 
 
+class HostEvent (Event):
+  '''
+  Event when a host joins, leaves or moves around the network.
+  '''
+
+  def __init__ (self, host, join = False, leave = False, move = False):
+    super(HostEvent, self).__init__();
+    self.host = host
+    self.join = join
+    self.leave = leave
+    self.move = move
+
+
+class HostIPEvent (Event):
+  '''
+  Event when we learn the IP address of a host.
+  '''
+
+  def __init__ (self, host, ip):
+    super(HostIPEvent, self).__init__();
+    self.host = host
+    self.ip = ip
+
+
 class DynamicTopology (EventMixin):
   '''
   POX module that creates a dynamic adjacency list representation of the
@@ -181,14 +259,18 @@ class DynamicTopology (EventMixin):
   and the host_tracker module to track host locations and MAC/IPs.
   '''
 
-  _eventMixin_events = set([StableEvent, DHCPEvent, FlowDeleteEvent])
+  _eventMixin_events = set([StableEvent, TopologyChangeEvent, DHCPEvent,
+                             FlowDeleteEvent, HostEvent, HostIPEvent])
 
   # constructor
   def __init__ (self, debug = False, check_interval = 5.0, ping_src_mac = None,
-                eat_packets = True):
+                eat_packets = True, settle = None, expected_switches = None,
+                expected_links = None, expected_fingerprint = None):
     # the graph of the network
     self.graph = nx.Graph()
     self.hosts = []
+    self.host_ports = {} # dpid -> {port -> set of Hosts}
+    self.pings_sent = 0
 
     # send pings from dummy address to check liveliness
     if ping_src_mac is None:
@@ -210,60 +292,122 @@ class DynamicTopology (EventMixin):
     self.got_link = False
     self.waiting_links = []
 
-    # stability information
+    # stability information: the topology is stable once it has gone
+    # settle seconds without a change, or as soon as it matches what we
+    # were told to expect. After that changes are raised as
+    # TopologyChangeEvents instead.
     self.stable = False
-    self.last_stable = self.stable
-
-    # timer to check liveliness and stability
-    self.last_check = time.time()
+    self.settle = check_interval if settle is None else settle
+    self.expected_switches = expected_switches
+    self.expected_links = expected_links
+    self.expected_fingerprint = expected_fingerprint
+    self.num_switches = 0
+    self.num_links = 0
+    self._fp = 0 # fingerprint() of the graph, kept up to date
+    self.last_change = time.time()
+    self._settle_timer = None
+    self._changes = ([], [], [], []) # switches up/down, links up/down
+
+    # timer to check liveliness
     self.check_interval = check_interval
     self._t = Timer(self.check_interval, self._run_checks, recurring=True)
 
   # Timer functions
   def _run_checks (self):
     '''
-    At every interval, check the stability of the network (switches)
-    and the status of hosts on the network.
+    At every interval, check the status of hosts on the network.
     '''
 
-    self._check_stability()
     self._check_host_timeouts()
 
-  def _check_stability (self):
+  # stability
+  def fingerprint (self):
+    return '%016x' % (self._fp,)
+
+  def expecting (self):
+    return (self.expected_switches is not None or
+            self.expected_links is not None or
+            self.expected_fingerprint is not None)
+
+  def is_expected (self):
     '''
-    Checks for network topology changes.
+    True if we were told what fabric to expect and it is all here.
     '''
 
-    # don't raise events if we haven't seen any links yet
-    if self.got_link is False:
-      self.stable = self.last_stable
-      self.last_check = time.time()
+    if not self.expecting():
+      return False
+    if (self.expected_switches is not None and
+        self.num_switches != self.expected_switches):
+      return False
+    if (self.expected_links is not None and
+        self.num_links != self.expected_links):
+      return False
+    if (self.expected_fingerprint is not None and
+        self.fingerprint() != self.expected_fingerprint):
+      return False
+    return True
+
+  def _topology_changed (self, switch_up = None, switch_down = None,
+                         link_up = None, link_down = None):
+    '''
+    Called for every switch and link change. Before the topology is stable
+    this (re)starts the settle interval; after, the change is kept for the
+    next TopologyChangeEvent.
+    '''
+
+    self.last_change = time.time()
+    if self.stable:
+      for changes, item in zip(self._changes,
+                               (switch_up, switch_down, link_up, link_down)):
+        if item is not None:
+          changes.append(item)
+    elif self.is_expected():
+      self.mark_stable()
+      return
+    if self._settle_timer is None:
+      self._settle_timer = Timer(self.settle, self._settled)
+
+  def _settled (self):
+    '''
+    The settle timer went off. Unless something changed since it was set,
+    the topology has settled.
+    '''
+
+    self._settle_timer = None
+    wait = self.last_change + self.settle - time.time()
+    if wait > 0:
+      self._settle_timer = Timer(wait, self._settled)
       return
 
-    # see if we have links waiting for switches
-    while self.waiting_links != []:
-      for link in self.waiting_links[:]:
-        core.openflow_discovery.raiseEvent(link)
+    if not self.stable:
+      # don't go stable before we have seen any links
+      if self.got_link:
+        self.mark_stable()
+      return
 
-    # if the network status has changed, raise event
-    if self.stable != self.last_stable:
-      self.raiseEventNoErrors(StableEvent, stable = self.stable, graph = self.graph)
-      self.last_stable, self.last_check = self.stable, time.time()
+    changes, self._changes = self._changes, ([], [], [], [])
+    if any(changes):
+      self.raiseEventNoErrors(TopologyChangeEvent, self.graph, *changes)
 
-    # if the network has gone interval seconds without a change, we assume it is
-    # now stable and raise an event
-    else:
-      if time.time() > self.last_check + self.check_interval:
-        if self.stable is False:
-          self.stable = True
-          self.last_stable, self.last_check = self.stable, time.time()
-          self.raiseEventNoErrors(StableEvent, stable = self.stable, graph = self.graph)
+  def mark_stable (self):
+    '''
+    Declare the topology stable and raise the StableEvent.
+    '''
+
+    if self.stable:
+      return
+    self.stable = True
+    log.info("topology stable with %i switches and %i links, fingerprint %s",
+             self.num_switches, self.num_links, self.fingerprint())
+    self.raiseEventNoErrors(StableEvent, stable = self.stable,
+                            graph = self.graph)
 
   def _check_host_timeouts (self):
     """
     Checks for timed out hosts
     """
 
+    expired = []
     for host in self.hosts[:]:
       entry_pinged = False
       if host.ipaddr is not None:
@@ -287,7 +431,8 @@ class DynamicTopology (EventMixin):
           log.warning("Entry %s expired but still had IP address %s",
                       str(host), str(ip_addr) )
           host.ipaddr = None
-        self.update_host(host, leave=True)
+        expired.append(host)
+    self.remove_hosts(expired)
 
   # verification that component is ready
   def _all_dependencies_met (self):
@@ -304,7 +449,14 @@ class DynamicTopology (EventMixin):
     dpid = event.dpid
     if dpid not in self.graph:
       self.graph.add_node(dpid, connection=event.connection)
-      self.stable, self.last_check = False, time.time()
+      self.num_switches += 1
+      self._fp ^= switch_hash(dpid)
+      self._topology_changed(switch_up = dpid)
+
+      # links we saw before this switch connected
+      for link_event in self.waiting_links[:]:
+        if dpid in (link_event.link.dpid1, link_event.link.dpid2):
+          self._handle_openflow_discovery_LinkEvent(link_event)
 
     log.debug("Installing flow for ARP ping responses")
 
@@ -322,9 +474,44 @@ class DynamicTopology (EventMixin):
     '''
 
     dpid = event.dpid
+    hosts = [h for on_port in self.host_ports.get(dpid, {}).itervalues()
+             for h in on_port]
+    if hosts:
+      log.info("%i hosts left with switch %s", len(hosts), dpid)
+      self.remove_hosts(hosts)
     if dpid in self.graph:
+      links = [self._remove_link(dpid, n) for n in self.graph.neighbors(dpid)]
       self.graph.remove_node(dpid)
-      self.stable, self.last_check = False, time.time()
+      self.num_switches -= 1
+      self._fp ^= switch_hash(dpid)
+      self._topology_changed(switch_down = dpid)
+      for link in links:
+        if link is not None:
+          self._topology_changed(link_down = link)
+
+  def _handle_openflow_PortStatus (self, event):
+    '''
+    When a port goes down or away, the hosts behind it have left.
+    '''
+
+    desc = event.ofp.desc
+    down = (desc.config & of.OFPPC_PORT_DOWN or
+            desc.state & of.OFPPS_LINK_DOWN)
+    if event.deleted or (event.modified and down):
+      hosts = list(self.hosts_on(event.dpid, event.port))
+      if hosts:
+        log.info("%s left, port %s down",
+                 ", ".join(str(h.macaddr) for h in hosts), event.port)
+        self.remove_hosts(hosts)
+
+  def _remove_link (self, s1, s2):
+    link = self.graph[s1][s2].get('link')
+    if link is None:
+      return None
+    self.graph.remove_edge(s1, s2)
+    self.num_links -= 1
+    self._fp ^= link_hash(link)
+    return link
 
   def _handle_openflow_discovery_LinkEvent (self, event):
     '''
@@ -343,16 +530,28 @@ class DynamicTopology (EventMixin):
         self.waiting_links.append(event)
       return
 
+    if event in self.waiting_links:
+      self.waiting_links.remove(event)
+
     if event.added:
+      link = None
+      if self.graph.has_edge(s1, s2):
+        link = self.graph[s1][s2].get('link')
+      if link is not None and link_hash(link) == link_hash(event.link):
+        # the other direction of a link we already have
+        self.graph[s1][s2]['link'] = event.link
+        return
+      if link is not None:
+        self._topology_changed(link_down = self._remove_link(s1, s2))
       self.graph.add_edge(s1, s2, link=event.link)
+      self.num_links += 1
+      self._fp ^= link_hash(event.link)
+      self._topology_changed(link_up = event.link)
     elif event.removed:
       if self.graph.has_edge(s1, s2):
-        self.graph.remove_edge(s1, s2)
-
-    if event in self.waiting_links:
-      self.waiting_links.remove(event)
-
-    self.stable, self.last_check = False, time.time()
+        link = self._remove_link(s1, s2)
+        if link is not None:
+          self._topology_changed(link_down = link)
 
   def is_edge_port (self, dpid, inport):
     '''
@@ -405,19 +604,14 @@ class DynamicTopology (EventMixin):
     assert sum(1 for x in [join,leave,move] if x) == 1
     m = str(host.macaddr)
     if leave:
-      if str(host.macaddr) in self.graph:
-        if host.ipaddr is not None:
-          self.raiseEventNoErrors(FlowDeleteEvent, ip = host.ipaddr.ip, graph = self.graph)
-          #self.delete_host_flows(host.ipaddr.ip, host.dpid)
-        log.debug('{0} left'.format(str(host)))
-        self.hosts.remove(host)
-        self.graph.remove_node(m)
+      self.remove_hosts([host])
 
     elif move:
       assert new is not None
       # NOTE: this would need to be changed if multiple interfaces
       #       per host was supported
-      self.raiseEventNoErrors(FlowDeleteEvent, ip = host.ipaddr.ip, graph = self.graph)
+      if host.ipaddr is not None:
+        self.raiseEventNoErrors(FlowDeleteEvent, ip = host.ipaddr.ip, graph = self.graph)
       #self.delete_host_flows(host.ipaddr.ip, host.dpid)
       #for n in self.graph.neighbors(str(host.macaddr))[:]:
         #self.graph.remove_edge(str(host.macaddr), n)
@@ -428,9 +622,12 @@ class DynamicTopology (EventMixin):
       self.graph.add_edge(new.dpid, m, port=new.port)
       log.debug('{0} moved from {1} port {2} --> {3} port {4}'.format(
         host.macaddr, host.dpid, host.port, new.dpid, new.port))
+      self._unindex(host)
       host.dpid = new.dpid
       host.port = new.port
+      self._index(host)
       host.refresh()
+      self.raiseEventNoErrors(HostEvent, host, move = True)
 
     else: # join
       self.graph.add_node(m)
@@ -438,17 +635,64 @@ class DynamicTopology (EventMixin):
       self.graph.node[m]['info'] = host
       host.refresh()
       self.hosts.append(host)
+      self._index(host)
       log.debug('{0} joined on {1} port {2}'.format(host.macaddr, host.dpid, host.port))
+      self.raiseEventNoErrors(HostEvent, host, join = True)
+
+  def remove_hosts (self, hosts):
+    '''
+    Remove hosts that have left, all at once: one FlowDeleteEvent covers
+    the flows to every one of them.
+    '''
+
+    hosts = [h for h in hosts if str(h.macaddr) in self.graph]
+    if not hosts:
+      return
+    ips = [h.ipaddr.ip for h in hosts if h.ipaddr is not None]
+    if ips:
+      self.raiseEventNoErrors(FlowDeleteEvent, ips = ips, graph = self.graph)
+    gone = set(id(h) for h in hosts)
+    self.hosts = [h for h in self.hosts if id(h) not in gone]
+    for host in hosts:
+      log.debug('{0} left'.format(str(host)))
+      self._unindex(host)
+      self.graph.remove_node(str(host.macaddr))
+      self.raiseEventNoErrors(HostEvent, host, leave = True)
+
+  def hosts_on (self, dpid, port):
+    '''
+    The hosts attached to a switch port: more than one behind a hub or an
+    access switch. Don't change the set returned.
+    '''
+
+    return self.host_ports.get(dpid, {}).get(port, ())
+
+  def _index (self, host):
+    ports = self.host_ports.setdefault(host.dpid, {})
+    ports.setdefault(host.port, set()).add(host)
+
+  def _unindex (self, host):
+    ports = self.host_ports.get(host.dpid)
+    if ports is None:
+      return
+    on_port = ports.get(host.port)
+    if on_port is not None:
+      on_port.discard(host)
+      if not on_port:
+        del ports[host.port]
+    if not ports:
+      del self.host_ports[host.dpid]
 
   def get_host_info (self, ip):
     '''
     Allows us to look up host MAC addresses by IP address, like
-    what ARP does.
+    what ARP does. Returns None if no host has that IP.
     '''
 
-    hosts = [host for host in self.hosts if host.ipaddr is not None and
-            host.ipaddr.ip == ip]
-    return hosts[0]
+    for host in self.hosts:
+      if host.ipaddr is not None and host.ipaddr.ip == ip:
+        return host
+    return None
 
   def _handle_openflow_PacketIn (self, event):
     """
@@ -475,33 +719,41 @@ class DynamicTopology (EventMixin):
     log.debug("PacketIn: %i %i ETH %s => %s",
               dpid, inport, str(packet.src), str(packet.dst))
 
-    # Learn or update dpid/port/MAC info
-    host = (str(packet.src) in self.graph)
+    (pckt_srcip, hasARP) = self.getSrcIPandARP(packet.next)
+    self.learn_host(dpid, inport, packet.src, pckt_srcip, hasARP)
+
+    # if this is DHCP, raise event for DHCP server and halt event
+    if self.is_dhcp(event):
+      self.raiseEventNoErrors(DHCPEvent(event, self.graph))
+      return EventHalt
+
+    if self.eat_packets and packet.dst == self.ping_src_mac:
+      return EventHalt
+
+  def learn_host (self, dpid, inport, mac, srcip = None, hasARP = False):
+    '''
+    Learn or update dpid/port/MAC info and the IP of a host from a packet
+    it sent in on an edge port. Returns the Host.
+    '''
+
+    host = (str(mac) in self.graph)
 
     if host:
-      host = self.graph.node[str(packet.src)]['info']
+      host = self.graph.node[str(mac)]['info']
       host.refresh()
 
     if not host:
-      host = Host(dpid,inport,packet.src)
+      host = Host(dpid,inport,mac)
       self.update_host(host, join = True)
 
-    elif host != (dpid, inport, packet.src):
+    elif host != (dpid, inport, mac):
       self.update_host(host, move = True, new = New(dpid, inport))
 
-    (pckt_srcip, hasARP) = self.getSrcIPandARP(packet.next)
-    if pckt_srcip is not None and pckt_srcip != '0.0.0.0':
-      self.updateIPInfo(pckt_srcip, host, hasARP)
+    if srcip is not None and srcip != '0.0.0.0':
+      self.updateIPInfo(srcip, host, hasARP)
 
     host.refresh()
-
-    # if this is DHCP, raise event for DHCP server and halt event
-    if self.is_dhcp(event):
-      self.raiseEventNoErrors(DHCPEvent(event, self.graph))
-      return EventHalt
-
-    if self.eat_packets and packet.dst == self.ping_src_mac:
-      return EventHalt
+    return host
 
   def _dhcp_lease (self, event):
     '''
@@ -602,6 +854,7 @@ class DynamicTopology (EventMixin):
       ipEntry = IPAddress(hasARP, pckt_srcip)
       host.ipaddr = ipEntry
       log.info("learned %s got IP %s", str(host.macaddr), str(pckt_srcip))
+      self.raiseEventNoErrors(HostIPEvent, host, pckt_srcip)
     if hasARP:
       ipEntry.pings.received()
 
@@ -625,6 +878,7 @@ class DynamicTopology (EventMixin):
     if core.openflow.sendToDPID(host.dpid, msg.pack()):
       ipEntry = host.ipaddr
       ipEntry.pings.sent()
+      self.pings_sent += 1
     else:
       # host is stale, remove it.
       log.debug("%i %i ERROR sending ARP REQ to %s %s",
@@ -634,6 +888,13 @@ class DynamicTopology (EventMixin):
 
 
 # launch DynamicTopology
-def launch (debug="False"):
+def launch (debug="False", settle=None, expected_switches=None,
+            expected_links=None, expected_fingerprint=None):
+    def opt (value, kind):
+        return None if value in (None, '') else kind(value)
     if not core.hasComponent("topology_tracker"):
-        core.register("topology_tracker", DynamicTopology(str_to_bool(debug)))
+        core.register("topology_tracker", DynamicTopology(str_to_bool(debug),
+            settle = opt(settle, float),
+            expected_switches = opt(expected_switches, int),
+            expected_links = opt(expected_links, int),
+            expected_fingerprint = opt(expected_fingerprint, str)))
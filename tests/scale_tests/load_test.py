@@ -4,10 +4,20 @@
 # Tests how the mobility interval impacts the controller load. Creates a 35 switch
 # Mininet topology and connects a given number of hosts. Then all those hosts are
 # moved around the network for 1 minute.  The interval in which hosts are moved
-# is specified. The get_flow_data_with_percent.py script is used to collect flow
-# table statistics using ovs-ofctl.
-
-# Usage: sudo python load_test.py <num_hosts> <move interval>
+# is specified. Flow table statistics are collected from the controller every
+# <stats interval> seconds while the hosts come up and move (see
+# get_flow_data.py), so run it with --flow_stats=<seconds> and --metrics. Every
+# ARP request a host sends for its default gateway is a packet-in at the
+# controller, so each host counts them with tcpdump and the total is reported
+# at the end; run the controller with and without --advertise_gateway=False to
+# compare.
+#
+# Hosts are brought up <batch size> at a time: the batch is attached, dhclient
+# is started in the background on all of them at once and their interfaces are
+# polled until every one has an address, so 1000 hosts come up in minutes.
+
+# Usage: sudo python load_test.py <num_hosts> <move interval> [batch size]
+#                                 [stats interval]
 
 from mininet.topo import Topo
 
@@ -19,6 +29,7 @@ from mininet.net import Mininet
 from mininet.node import Node
 
 import mobility_switch
+from get_flow_data import get_flows
 from select import poll, POLLIN
 from random import randint, SystemRandom
 import time
@@ -26,11 +37,20 @@ from math import log
 from threading import Thread, Event
 import os
 import sys
-import subprocess
 
 NUM_SWITCHES = 35
 NUM_CORE = 5
 
+# switches s1 to s10 are SD-MCAN's, the ones whose flows are collected
+NUM_SDMCAN = 10
+
+BATCH_SIZE = 50
+STATS_INTERVAL = 10
+
+# seconds a batch of hosts gets to lease addresses, and between checks
+LEASE_TIMEOUT = 60
+LEASE_POLL = 0.5
+
 def int2dpid(dpid):
         try:
             dpid = hex(dpid)[2:]
@@ -62,6 +82,90 @@ def startpings(host, targetip):
             (host.name, host.IP(), targetip))
     host.cmd(cmd)
 
+def dhclient(host, wait=True):
+    "Run dhclient on host, in the background unless wait"
+    # each host has pid and lease files of its own, so the clients don't
+    # trip over each other and a new one replaces the host's old one
+    intf = host.defaultIntf().name
+    host.cmd('dhclient%s -pf /tmp/%s.dhclient.pid -lf /tmp/%s.dhclient.leases '
+             '%s' % ('' if wait else ' -nw', host.name, host.name, intf))
+
+def stopdhclient(host):
+    "Stop the host's dhclient and remove its files"
+    host.cmd('kill `cat /tmp/%s.dhclient.pid` 2> /dev/null' % host.name)
+    host.cmd('rm -f /tmp/%s.dhclient.pid /tmp/%s.dhclient.leases' %
+             (host.name, host.name))
+
+def waitforleases(hosts, timeout=LEASE_TIMEOUT):
+    "Poll hosts until each has an address, and return the ones that don't"
+    pending = list(hosts)
+    deadline = time.time() + timeout
+    while pending and time.time() < deadline:
+        # updateIP() also tells Mininet about the address
+        pending = [h for h in pending if not h.defaultIntf().updateIP()]
+        if pending:
+            time.sleep(LEASE_POLL)
+    return pending
+
+class FlowStats(Thread):
+    """Append a line of flow counts to a file every interval seconds: the flows
+       in switches 1 to NUM_SDMCAN, the total, the average and the hosts up,
+       as get_flow_data_with_percent.py writes them"""
+
+    def __init__(self, filename, interval, hosts):
+        Thread.__init__(self, name='flowstats')
+        self.daemon = True
+        self.filename = filename
+        self.interval = interval
+        self.hosts = hosts
+        self.done = Event()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.collect()
+
+    def collect(self):
+        try:
+            switches, _ = get_flows()
+        except Exception as e:
+            warn('*** could not get flow stats: %s\n' % e)
+            return
+        flows = [switches.get(i, {}).get('flows', 0)
+                 for i in range(1, NUM_SDMCAN + 1)]
+        total = sum(flows)
+        with open(self.filename, 'a') as f:
+            f.write(','.join(str(n) for n in flows + [total,
+                             total // NUM_SDMCAN, len(self.hosts)]) + '\n')
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        self.collect()
+
+def countgatewayarps(host):
+    "Count the ARP requests host sends for its default gateway"
+    gateway = host.cmd("ip route | awk '/default/ {print $3}'").strip()
+    if not gateway:
+        warn('*** %s has no default gateway\n' % host.name)
+        return
+    host.cmd('tcpdump -l -n -i %s "arp[6:2] == 1 and arp dst host %s" '
+             '> %s_gwarp 2> /dev/null &' % (host.defaultIntf().name,
+                                             gateway, host.name))
+
+def gatewayarps(hosts):
+    "Total the gateway ARP requests counted by countgatewayarps"
+    total = 0
+    for host in hosts:
+        counts = '%s_gwarp' % host.name
+        if not os.path.exists(counts):
+            continue
+        with open(counts) as f:
+            n = sum(1 for _ in f)
+        os.remove(counts)
+        output('%s: %i gateway ARP requests\n' % (host.name, n))
+        total += n
+    return total
+
 
 class SupportTopo(Topo):
     def build(self, **_opts):
@@ -101,7 +205,8 @@ class SupportTopo(Topo):
                 offset += 1
 
 
-def run(num_hosts, move_interval):
+def run(num_hosts, move_interval, batch_size=BATCH_SIZE,
+        stats_interval=STATS_INTERVAL):
     # 2 controllers - c0 for SD-MCAN core, c1 for LANs
     c0 = RemoteController('c0', ip='127.0.0.1', port=6633)
     c1 = RemoteController('c1', ip='127.0.0.1', port=6634)
@@ -140,13 +245,6 @@ def run(num_hosts, move_interval):
     # good random number generator
     secure_rand = SystemRandom()
 
-    def getstats(percent):
-        info('\ncalling script\n')
-        p = subprocess.Popen(["sudo", "python", "get_flow_data_with_percent.py",
-                              str(10), "flow_data_{0}_{1}".format(
-                              num_hosts, move_interval), str(percent)],
-                             stdout=subprocess.PIPE)
-
     # use this to move hosts
     def movehosts():
         h_list = hosts[:]
@@ -171,7 +269,7 @@ def run(num_hosts, move_interval):
                 # move the host
                 info('\n* Moving', host[0], 'from', host[1], 'to', new, 'port', port, '\n')
                 hintf, sintf = mobility_switch.moveHost(host[0], host[1], new, newPort=port)
-                host[0].cmd('dhclient ' + host[0].defaultIntf().name)
+                dhclient(host[0])
                 startpings(host[0], ping[host[0]])
                 hi = hosts.index(host)
                 if hi is not None:
@@ -180,12 +278,8 @@ def run(num_hosts, move_interval):
                     warn('\nTHIS SHOULD NOT HAPPEN\n')
             time.sleep(move_interval)
 
-    info('*** Adding hosts...\n')
-    # add hosts
-    s = 0
-    ns = 5
-    for h in range(1, num_hosts + 1):
-        # create the host
+    def addhost(h, s):
+        "Create host h and attach it to a switch in subnet s"
         host = net.addHost('h{0}'.format(h))
         added = False
 
@@ -199,49 +293,75 @@ def run(num_hosts, move_interval):
                 added = True
             except:
                 added = False
+        return host, switch
+
+    stats = FlowStats('flow_data_{0}_{1}'.format(num_hosts, move_interval),
+                      stats_interval, hosts)
+    stats.start()
 
-        # get an IP for the host
-        host.cmd("sysctl -w net.ipv6.conf.all.disable_ipv6=1")
-        host.cmd("sysctl -w net.ipv6.conf.default.disable_ipv6=1")
-        host.cmd("sysctl -w net.ipv6.conf.lo.disable_ipv6=1")
-        host.cmd('dhclient ' + host.defaultIntf().name)
-
-        # make sure Mininet recognizes the assigned IP - this is silly and shouldn't
-        # be needed, but oh well
-        script = '{0}_start'.format(host.name)
-        with open(script, 'w') as f:
-            f.write('{0} ping -c 1 -W 1 {0}\n'.format(host.name))
-        CLI(net, script=script)
-        os.remove(script)
-
-        # ping another host if there is one
-        other_hosts = [h for h in not_pinged if h[0] is not host]
-        if other_hosts != []:
-            other_host = secure_rand.choice(other_hosts)
-            ip = other_host[0].IP()
-            if ip is not None:
-                startpings(host, ip)
-                not_pinged.remove(other_host)
-                ping[host] = ip
-        hosts.append((host,switch))
-        not_pinged.append((host,switch))
-        getstats(host.name)
-        s += 1
+    info('*** Adding hosts...\n')
+    # add hosts, a batch at a time
+    ns = 5
+    start = time.time()
+    for first in range(1, num_hosts + 1, batch_size):
+        batch = [addhost(h, h - 1)
+                 for h in range(first, min(first + batch_size, num_hosts + 1))]
+
+        # get IPs for the whole batch at once
+        for host, _ in batch:
+            host.cmd("sysctl -w net.ipv6.conf.all.disable_ipv6=1 "
+                     "net.ipv6.conf.default.disable_ipv6=1 "
+                     "net.ipv6.conf.lo.disable_ipv6=1")
+            dhclient(host, wait=False)
+        failed = waitforleases([host for host, _ in batch])
+        for host in failed:
+            warn('*** {0} got no lease in {1}s\n'.format(host.name,
+                                                       LEASE_TIMEOUT))
+
+        for host, switch in batch:
+            countgatewayarps(host)
+
+            # ping another host if there is one
+            other_hosts = [h for h in not_pinged if h[0] is not host]
+            if other_hosts != []:
+                other_host = secure_rand.choice(other_hosts)
+                ip = other_host[0].IP()
+                if ip is not None:
+                    startpings(host, ip)
+                    not_pinged.remove(other_host)
+                    ping[host] = ip
+            hosts.append((host,switch))
+            not_pinged.append((host,switch))
+        info('\n*** {0} hosts up after {1:.1f}s\n'.format(len(hosts),
+                                                       time.time() - start))
+    output('*** %i hosts up in %.1fs\n' % (len(hosts), time.time() - start))
 
     # move
     CLI(net)
     movehosts()
+    stats.stop()
+
+    # report the gateway ARP packet-ins the controller got
+    for host, _ in hosts:
+        host.cmd('kill %tcpdump')
+        stopdhclient(host)
+    total = gatewayarps([host for host, _ in hosts])
+    output('*** %i gateway ARP requests from %i hosts\n' % (total, len(hosts)))
 
     # stop the network
     net.stop()
 
 if __name__ == '__main__':
 
-    if len(sys.argv) != 3:
-        print('usage: load_test.py <num hosts> <move interval>')
+    if len(sys.argv) not in (3, 4, 5):
+        print('usage: load_test.py <num hosts> <move interval> [batch size] '
+              '[stats interval]')
         exit()
     setLogLevel('info')
 
     num_hosts = int(sys.argv[1])
     move_interval = int(sys.argv[2])
-    run(num_hosts, move_interval)
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else BATCH_SIZE
+    stats_interval = (float(sys.argv[4]) if len(sys.argv) > 4
+                      else STATS_INTERVAL)
+    run(num_hosts, move_interval, batch_size, stats_interval)
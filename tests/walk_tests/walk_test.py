@@ -4,8 +4,13 @@
 # This test walks a mobile host around the mobility_topo.py topology for one
 # minute. The user can select the mobility interval and whether they want iperf
 # to collect TCP or UDP data.
+#
+# If the controller runs with --handover --metrics=<addr>, its handover
+# timelines are pulled from http://<addr>/handover at the end and written
+# with the time of every move to <proto><interval>_<run>_handover.json, to
+# line up with the gaps in the iperf output.
 
-# usage: sudo python walk_test.py <udp/tcp> <interval>
+# usage: sudo python walk_test.py <udp/tcp> <interval> [handover URL]
 
 from mininet.log import setLogLevel, info
 from mininet.cli import CLI
@@ -18,21 +23,44 @@ import iperf
 import mobility_switch
 
 from random import randint
+import json
 import time
 import sys
+import urllib2
 
 # these parameters can be tweaked to change the test
 PATH = [8, 9, 10, 7]
 TEST_TIME = 60
 RUNS = 1
+HANDOVER_URL = 'http://127.0.0.1:9105/handover'
+
+def pull_handovers(url, moves, filename):
+    '''
+    Fetch the controller's handover timelines and save them with the moves
+    made, printing how long the moved host took to be forwarded again.
+    '''
+    try:
+        handovers = json.load(urllib2.urlopen(url, timeout=10))
+    except Exception as e:
+        info('*** No handover timelines from %s: %s\n' % (url, e))
+        return
+    with open(filename + '_handover.json', 'w') as f:
+        json.dump(dict(moves=moves, handovers=handovers), f, indent=2)
+    for step, s in sorted(handovers['summary'].items(),
+                          key=lambda s: s[1]['p50']):
+        info('*** %-12s %3i moves  p50 %7.1fms  p90 %7.1fms  max %7.1fms\n' %
+             (step, s['count'], s['p50'] * 1e3, s['p90'] * 1e3,
+              s['max'] * 1e3))
 
 def run():
     # get parameters
-    if len(sys.argv) != 3:
-        print("usage: sudo python walk_test.py <TCP/UDP> <move interval>")
+    if len(sys.argv) not in (3, 4):
+        print("usage: sudo python walk_test.py <TCP/UDP> <move interval> "
+              "[handover URL]")
         return
     proto = sys.argv[1]
     interval = float(sys.argv[2])
+    url = sys.argv[3] if len(sys.argv) == 4 else HANDOVER_URL
     num_walks = TEST_TIME // interval
 
     # load topology
@@ -75,11 +103,14 @@ def run():
 
         time.sleep(interval)
 
+        moves = []
         for i in range(0, int(num_walks - 1)):
             s = PATH[i % len(PATH)]
             new = net[ 's%d' % s ]
             port = randint( 10, 20 )
             info( '* Moving', h2, 'from', old, 'to', new, 'port', port, '\n' )
+            moves.append(dict(time=time.time(), host=str(h2.MAC()),
+                              old=str(old), new=str(new), port=port))
             hintf, sintf = mobility_switch.moveHost( h2, old, new, newPort=port )
             h2.cmd('dhclient ' + h2.defaultIntf().name)
             old = new
@@ -89,6 +120,7 @@ def run():
         info("Shutting down...")
         for host in [h1, h2]:
             host.cmd('pkill iperf')
+        pull_handovers(url, moves, filename)
     net.stop()
 
 if __name__ == '__main__':
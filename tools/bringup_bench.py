@@ -0,0 +1,196 @@
+#!/usr/bin/python
+
+# Offline bring-up benchmark for topology_tracker's stability detection.
+# Replays a campus coming up in simulated time (offline.SimClock): switches
+# connect over --connect-spread seconds and discovery finds each direction of
+# every link within one --lldp-cycle of both ends being up. Reports when the
+# tracker declares the topology stable, counted from the start and from the
+# last link found, for:
+#
+#   poll        - the old recurring check_interval poll, worked out from the
+#                 same event times
+#   settle      - debounced, stable after --settle quiet seconds
+#   counts      - told to expect the switch and link counts
+#   fingerprint - told to expect the fabric's fingerprint
+#
+# After bring-up a link flaps and a switch restarts. Stable tracker modes
+# should report those as TopologyChangeEvents and raise no more
+# StableEvents.
+
+# Usage: python bringup_bench.py [--core N] [--edges N] [--runs N]
+
+import offline
+from offline import core, percentiles
+
+import dhcp_server
+import topology_tracker as tt
+from pox.openflow.discovery import Link, LinkEvent
+
+import argparse
+import json
+import random
+import sys
+
+
+class ConnectionEvent(object):
+    "ConnectionUp/ConnectionDown, as far as topology_tracker looks."
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.dpid = connection.dpid
+
+
+def schedule(args, rng, graph):
+    '''
+    Times at which switches connect and link directions are discovered.
+    Returns a sorted list of (time, kind, item).
+    '''
+
+    up = dict((n, rng.uniform(0, args.connect_spread)) for n in graph)
+    events = [(t, 'switch', n) for n, t in up.iteritems()]
+    for a, b, d in graph.edges(data=True):
+        link = d['link']
+        for l in (link, Link(link.dpid2, link.port2, link.dpid1, link.port1)):
+            t = max(up[a], up[b]) + rng.uniform(0, args.lldp_cycle)
+            events.append((t, 'link', l))
+    events.sort()
+    return events
+
+
+def poll_stable(events, interval):
+    '''
+    When the old polling check would have gone stable: at the first timer
+    tick, every interval seconds, more than interval after the last change
+    (and after the first link).
+    '''
+
+    changes = [t for t, _, _ in events]
+    first_link = min(t for t, kind, _ in events if kind == 'link')
+    last_check = 0.0
+    tick = interval
+    while True:
+        if tick < first_link:
+            last_check = tick
+        else:
+            last = max([last_check] + [t for t in changes if t <= tick])
+            if tick > last + interval:
+                return tick
+        tick += interval
+
+
+def run(args, mode, seed):
+    rng = random.Random(seed)
+    nexus = offline.install_core()
+    nexus.connections.clear()
+    graph, _, _ = offline.campus_graph(args.core, args.edges, nexus)
+    offline.add_links(graph)
+    events = schedule(args, rng, graph)
+    last_link = events[-1][0]
+    if mode == 'poll':
+        stable = poll_stable(events, args.check_interval)
+        # the old tracker toggled stability on churn, nothing to count
+        return dict(mode=mode, stable=stable, after_last=stable - last_link,
+                    stable_events=None, changes=None)
+
+    clock = offline.SimClock()
+    clock.patch(tt)
+    hints = {}
+    if mode == 'counts':
+        hints = dict(expected_switches=graph.number_of_nodes(),
+                     expected_links=graph.number_of_edges())
+    elif mode == 'fingerprint':
+        hints = dict(expected_fingerprint=tt.fingerprint(graph))
+    dhcp = dhcp_server.DHCPDMulti(args.network)
+    core.register('dhcp_server', dhcp)
+    tracker = tt.DynamicTopology(check_interval=args.check_interval,
+                                 settle=args.settle, **hints)
+    stable, changes = [], []
+    tracker.addListenerByName('StableEvent',
+                              lambda e: stable.append(clock.now))
+    tracker.addListenerByName('TopologyChangeEvent',
+                              lambda e: changes.append(e))
+
+    def deliver(kind, item):
+        if kind == 'switch':
+            tracker._handle_openflow_ConnectionUp(
+                ConnectionEvent(graph.node[item]['connection']))
+        elif kind == 'down':
+            tracker._handle_openflow_ConnectionDown(
+                ConnectionEvent(graph.node[item]['connection']))
+        else:
+            tracker._handle_openflow_discovery_LinkEvent(
+                LinkEvent(kind == 'link', item))
+
+    for t, kind, item in events:
+        clock.call_at(t, deliver, kind, item)
+    clock.run(last_link + 3 * args.settle + args.check_interval)
+    if not stable:
+        raise RuntimeError('%s never went stable' % mode)
+
+    # churn: a link flaps, an edge switch restarts
+    start = clock.now
+    a, b, d = sorted(graph.edges(data=True))[0]
+    clock.call_at(start + 1.0, deliver, 'unlink', d['link'])
+    clock.call_at(start + 1.5, deliver, 'link', d['link'])
+    edge = max(graph.nodes())
+    clock.call_at(start + 2.0, deliver, 'down', edge)
+    clock.call_at(start + 2.5, deliver, 'switch', edge)
+    for n in graph.neighbors(edge):
+        clock.call_at(start + 3.0, deliver, 'link', graph[edge][n]['link'])
+    clock.run(start + 3.0 + 3 * args.settle)
+
+    tracker._t.cancel()
+    core.components.pop('dhcp_server', None)
+    return dict(mode=mode, stable=stable[0], after_last=stable[0] - last_link,
+                stable_events=len(stable), changes=len(changes))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Offline topology '
+                                     'bring-up benchmark')
+    parser.add_argument('--core', type=int, default=4,
+                        help='core mesh size')
+    parser.add_argument('--edges', type=int, default=10,
+                        help='edge switches per core switch')
+    parser.add_argument('--network', default='10.0.0.0/24')
+    parser.add_argument('--connect-spread', type=float, default=2.0,
+                        help='switches connect within this many seconds')
+    parser.add_argument('--lldp-cycle', type=float, default=5.0,
+                        help='discovery finds a link within this many '
+                        'seconds of both ends connecting')
+    parser.add_argument('--check-interval', type=float, default=5.0)
+    parser.add_argument('--settle', type=float, default=5.0,
+                        help='quiet seconds before the topology is stable')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--modes', default='poll,settle,counts,fingerprint')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv)
+
+    offline.quiet()
+    results = []
+    print('%-12s %10s %10s %10s %10s %8s %8s' % (
+        'mode', 'p50 start', 'p99 start', 'p50 last', 'p99 last',
+        'stables', 'changes'))
+    for mode in args.modes.split(','):
+        runs = [run(args, mode, seed) for seed in range(args.runs)]
+        start = percentiles([r['stable'] for r in runs])
+        last = percentiles([r['after_last'] for r in runs])
+        stables = max(r['stable_events'] for r in runs)
+        changes = max(r['changes'] for r in runs)
+        print('%-12s %9.2fs %9.2fs %9.2fs %9.2fs %8s %8s' % (
+            mode, start[50], start[99], last[50], last[99],
+            '-' if stables is None else stables,
+            '-' if changes is None else changes))
+        results.append(dict(mode=mode, since_start=start, since_last=last,
+                            stable_events=stables, change_events=changes,
+                            runs=runs))
+    print('start: seconds from the first switch connecting; last: seconds '
+          'after the last link was found')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(args=vars(args), results=results), f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+
+# Multi-process test of the cluster host directory. Starts --members
+# processes on this machine, each one a cluster member with the PeerLink
+# and Directory from modules/cluster.py and a stand-in for its dhcp_server
+# that just keeps track of leases. Each member registers --hosts hosts
+# homed in its own region, then --moves of the next member's hosts move
+# into its region: it looks them up in the directory, adopts their leases
+# and the old region is told to hold their addresses.
+
+# Checks that every host is kept by exactly one member's directory, that
+# every lookup found the host where it was, and that every moved host was
+# handed back to its old region. Reports directory records per member
+# (which should stay near hosts as members are added), lookup latency
+# percentiles and lookups per second.
+
+# Usage: python cluster_test.py [--members N] [--hosts N] [--moves N]
+
+import offline
+from offline import int2mac, percentiles
+
+import cluster
+
+import argparse
+import json
+import select
+import subprocess
+import sys
+from timeit import default_timer as timer
+
+# lease time the test hosts register with, in seconds
+LEASE_TIME = 3600
+
+
+class Region(object):
+    "Stands in for dhcp_server: leases are just MAC -> record."
+
+    def __init__(self, me):
+        self.me = me
+        self.leases = {}
+        self.held = set()
+        self.moved_in = 0
+
+    def adopt(self, record):
+        self.leases[record['mac']] = dict(record)
+        self.moved_in += 1
+
+    def moved(self, mac):
+        if self.leases.pop(mac, None) is not None:
+            self.held.add(mac)
+
+    def released(self, mac):
+        self.held.discard(mac)
+
+
+class Member(object):
+    "One cluster member, driven by a plain select loop."
+
+    def __init__(self, index, addrs):
+        self.index = index
+        self.me = addrs[index]
+        self.link = cluster.PeerLink(self.me, addrs, self.handle)
+        self.region = Region(self.me)
+        self.directory = cluster.Directory(self.link, self.region,
+                                           self.resolve)
+        self.answers = {}  # MAC -> record, or None if not found
+        self.ready = {}    # barrier phase -> peers that reached it
+
+    def handle(self, msg):
+        if msg.get('op') == 'ready':
+            self.ready.setdefault(msg['phase'], set()).add(msg['src'])
+        else:
+            self.directory.handle(msg)
+
+    def resolve(self, mac, record):
+        self.answers[mac] = record
+
+    def poll(self, timeout=0.01):
+        link = self.link
+        link.connect()
+        r, w, _ = select.select(link.readers(), link.writers(), [], timeout)
+        link.service(r, w)
+
+    def wait(self, done, limit=30.0):
+        deadline = timer() + limit
+        while not done():
+            if timer() > deadline:
+                raise RuntimeError('%s timed out' % self.me)
+            self.poll()
+
+    def barrier(self, phase):
+        self.link.broadcast(dict(op='ready', phase=phase))
+        self.wait(lambda: len(self.ready.get(phase, ())) ==
+                  len(self.link.peers) and self.flushed())
+
+    def flushed(self):
+        return not any(self.link.queues.values())
+
+    def register(self, mac, n, home_index):
+        record = dict(mac=mac, ip='10.%i.%i.%i' % (home_index, n >> 8,
+                                                   n & 0xff),
+                      cidr='10.%i.0.0/16' % home_index,
+                      gateway='10.%i.0.1' % home_index,
+                      home=self.link.members[home_index],
+                      remaining=LEASE_TIME)
+        self.region.leases[mac] = dict(record, owner=self.me)
+        self.directory.register(record)
+
+
+def host_mac(member, i):
+    return str(int2mac((member << 24) | i))
+
+
+def run_member(args):
+    addrs = ['127.0.0.1:%i' % (args.port + i) for i in range(args.members)]
+    m = Member(args.node, addrs)
+    # member indexes follow the sorted member list
+    index = m.link.members.index(m.me)
+    m.wait(m.link.connected)
+    m.barrier(0)
+
+    for i in range(args.hosts):
+        m.register(host_mac(index, i), i, index)
+    m.wait(m.flushed)
+    m.barrier(1)
+
+    # the first --moves hosts of the next member move here
+    prev = (index + 1) % args.members
+    latencies = []
+    wrong = 0
+    start = timer()
+    for i in range(args.moves):
+        mac = host_mac(prev, i)
+        t = timer()
+        if m.directory.keeps(mac):
+            record = m.directory.record(mac)
+        else:
+            m.directory.lookup(mac)
+            m.wait(lambda: mac in m.answers)
+            record = m.answers[mac]
+        latencies.append(timer() - t)
+        if record is None or record['owner'] != m.link.members[prev]:
+            wrong += 1
+            continue
+        m.directory.adopt(record)
+        m.directory.register(dict((k, record[k]) for k in
+                                  ('mac', 'ip', 'cidr', 'gateway', 'home',
+                                   'remaining')))
+    elapsed = timer() - start
+    m.wait(m.flushed)
+    m.barrier(2)
+    m.barrier(3)
+
+    ms = [l * 1000 for l in latencies]
+    print(json.dumps(dict(
+        member=m.me,
+        records=len(m.directory.records),
+        owned=sum(1 for r in m.directory.records.itervalues()
+                  if r['owner'] == m.me),
+        lookups=m.directory.lookups,
+        wrong=wrong,
+        moved_in=m.region.moved_in,
+        held=len(m.region.held),
+        lookups_per_sec=len(latencies) / elapsed if elapsed else 0,
+        latency_ms=percentiles(ms),
+        sent=m.link.sent,
+        received=m.link.received)))
+    sys.stdout.flush()
+    m.link.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Multi-process test of '
+                                     'the cluster host directory')
+    parser.add_argument('--members', type=int, default=3)
+    parser.add_argument('--hosts', type=int, default=2000,
+                        help='hosts homed in each region')
+    parser.add_argument('--moves', type=int, default=500,
+                        help='hosts that move into each region')
+    parser.add_argument('--port', type=int, default=17000,
+                        help='first member listens here, the rest follow')
+    parser.add_argument('--node', type=int, default=None,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv)
+    args.moves = min(args.moves, args.hosts)
+
+    if args.node is not None:
+        run_member(args)
+        return
+
+    offline.quiet()
+    procs = [subprocess.Popen([sys.executable, __file__,
+                               '--node', str(i)] + argv,
+                              stdout=subprocess.PIPE)
+             for i in range(args.members)]
+    results = []
+    failed = False
+    for p in procs:
+        out, _ = p.communicate()
+        if p.returncode:
+            failed = True
+            continue
+        results.append(json.loads(out.strip().splitlines()[-1]))
+    if failed:
+        sys.exit('a cluster member failed')
+
+    total = args.members * args.hosts
+    records = sum(r['records'] for r in results)
+    print('%i members, %i hosts each, %i moves each' % (
+        args.members, args.hosts, args.moves))
+    print('%-16s %8s %8s %8s %8s %10s %8s %8s' % (
+        'member', 'records', 'moved in', 'held', 'wrong', 'lookups/s',
+        'p50 ms', 'p99 ms'))
+    for r in sorted(results, key=lambda r: r['member']):
+        print('%-16s %8i %8i %8i %8i %10.0f %8.3f %8.3f' % (
+            r['member'], r['records'], r['moved_in'], r['held'], r['wrong'],
+            r['lookups_per_sec'], r['latency_ms']['50'],
+            r['latency_ms']['99']))
+
+    problems = []
+    if records != total:
+        problems.append('directory holds %i records for %i hosts' % (
+            records, total))
+    for r in results:
+        if r['wrong']:
+            problems.append('%s: %i lookups missed' % (r['member'],
+                                                       r['wrong']))
+        if r['held'] != args.moves or r['moved_in'] != args.moves:
+            problems.append('%s: %i moved in, %i held, expected %i' % (
+                r['member'], r['moved_in'], r['held'], args.moves))
+    for p in problems:
+        print('FAIL: ' + p)
+    if not problems:
+        print('OK: each member keeps %.0f%% of the directory' % (
+            100.0 * max(r['records'] for r in results) / total))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(members=args.members, hosts=args.hosts,
+                           moves=args.moves, results=results,
+                           problems=problems), f, indent=2)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+# Times how long the dhcp_server takes to go from the topology's stable
+# event to serving DHCP, for each way of finding the core mesh, on a
+# generated campus (see offline.pod_campus_graph). With --baseline the old
+# approach, an unbounded find_cliques over the whole graph including hosts,
+# is timed as well. --spec times a topology from topology_spec.py instead.
+
+# Usage: python core_bench.py [--switches 1000] [--core 10] [--hosts 2]
+#                             [--spec FILE]
+
+import offline
+import topology_spec
+
+import dhcp_server
+import topology_tracker as tt
+from networkx.algorithms.clique import find_cliques
+
+import argparse
+import sys
+from timeit import default_timer as timer
+
+
+def campus(switches, num_core, access_per_pod, hosts):
+    "Pick a pod count that gets close to the wanted number of switches."
+    pods = max(1, (switches - num_core) // (access_per_pod + 2))
+    return offline.pod_campus_graph(num_core, pods, access_per_pod, hosts)
+
+
+def time_mode(graph, mode, core_dpids, timeout):
+    server = dhcp_server.DHCPDMulti('10.0.0.0/24', None, core_mode=mode,
+                                    core_dpids=core_dpids,
+                                    clique_timeout=timeout)
+    t0 = timer()
+    server._topology_tracker_stable(tt.StableEvent(True, graph))
+    elapsed = timer() - t0
+    if server._t is not None:
+        server._t.cancel()
+    return elapsed, server
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Time core detection and '
+                                     'DHCP start-up on a generated campus')
+    parser.add_argument('--switches', type=int, default=1000)
+    parser.add_argument('--core', type=int, default=10,
+                        help='core mesh size')
+    parser.add_argument('--access', type=int, default=8,
+                        help='access switches per pod')
+    parser.add_argument('--hosts', type=int, default=2,
+                        help='hosts already attached to each access switch')
+    parser.add_argument('--timeout', type=float, default=1.0,
+                        help='clique search timeout in seconds')
+    parser.add_argument('--baseline', action='store_true',
+                        help='also time find_cliques over the whole graph')
+    parser.add_argument('--spec', help='topology or spec file from '
+                        'topology_spec.py, instead of the generated campus')
+    args = parser.parse_args(argv)
+
+    offline.quiet()
+    offline.install_core()
+    if args.spec:
+        topology = topology_spec.load(args.spec)
+        graph = topology.graph(hosts=True)
+        core, dist, access = (topology.core, topology.distribution,
+                              topology.leaves)
+    else:
+        graph, core, dist, access = campus(args.switches, args.core,
+                                           args.access, args.hosts)
+    print('%i switches (%i core, %i distribution, %i access), %i nodes, '
+          '%i links' % (len(core) + len(dist) + len(access), len(core),
+                        len(dist), len(access), graph.number_of_nodes(),
+                        graph.number_of_edges()))
+
+    if args.baseline:
+        t0 = timer()
+        found = max(find_cliques(graph), key=len)
+        print('%-8s %8.3fs  core of %i' % ('baseline', timer() - t0,
+                                           len(found)))
+
+    for mode in dhcp_server.CORE_MODES:
+        elapsed, server = time_mode(graph, mode, core, args.timeout)
+        right = sorted(server.core) == sorted(core)
+        print('%-8s %8.3fs  core of %i (%s), %i subnets' % (
+            mode, elapsed, len(server.core),
+            'correct' if right else 'WRONG', len(server.subnets)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,468 @@
+#!/usr/bin/python
+
+# Offline DHCP storm benchmark. Builds a synthetic campus, starts the
+# dhcp_server on it and feeds DHCPDMulti._dhcp_PacketIn with DISCOVER,
+# REQUEST, renew and RELEASE packet-ins for many hosts spread over the
+# edge switches, the same way topology_tracker would. Nothing is sent
+# anywhere: POX's core is stubbed and switch connections just count what
+# they are given. Reports transactions per second, handler latency
+# percentiles and the state of the address pools.
+
+# Scenarios (run in the order given):
+#   boot    - every host boots inside --window seconds and does DORA
+#   renew   - every host renews its lease
+#   roam    - --roam of the hosts move to another subnet and DHCP again;
+#             each leaves its old port as if it went down, the way
+#             Mininet and fake_fabric move hosts, and should keep its
+#             address (those that don't are counted as renumbered, and
+#             the run exits 1 if there are any)
+#   renewals - hosts renew at the T1 they were given for --periods lease
+#             periods; prints a histogram of the renew rate
+#   release - every host releases its lease
+#   pool    - every host sends a DISCOVER, handed to the server through a
+#             packetin_workers pool of each size in --workers (0 parses on
+#             the main thread); prints packet-ins per second per pool size
+
+# Usage: python dhcp_storm.py [--hosts N] [--core N] [--edges N]
+#                             [--scenarios boot,renew,roam,release]
+
+import offline
+from offline import core, pkt
+
+import dhcp_server
+import packetin_workers
+import topology_tracker as tt
+
+import argparse
+import cProfile
+import heapq
+import json
+import pstats
+import random
+import select
+import sys
+from timeit import default_timer as timer
+
+
+class Client(object):
+    "One simulated DHCP client."
+
+    def __init__(self, n, dpid, port):
+        self.mac = offline.int2mac(n)
+        self.dpid = dpid
+        self.port = port
+        self.ip = None
+        self.server = None
+        self.xid = n << 8
+        self.acked = 0.0  # simulated time of the last ACK
+        self.t1 = None
+
+
+class Storm(object):
+    '''
+    A dhcp_server running on a synthetic campus, with a topology_tracker
+    keeping host IPs up to date from its DHCPLease events. Host nodes are
+    put in the graph here.
+    '''
+
+    def __init__(self, num_core, edges_per_core, network, seed=None,
+                 lease_time=dhcp_server.timeoutSec['leaseInterval'],
+                 jitter=0.0, adaptive=False):
+        self.rand = random.Random(seed)
+        random.seed(seed)  # dhcp_server's lease jitter
+        self.now = 0.0
+        self.nexus = offline.install_core()
+        self.graph, self.core, self.edges = offline.campus_graph(
+            num_core, edges_per_core, self.nexus)
+
+        self.server = dhcp_server.DHCPDMulti(network, None, lease_time, jitter,
+                                             adaptive)
+        # the tracker listens to core.dhcp_server; it is not registered
+        # itself, so route_manager never comes up
+        core.components.pop('dhcp_server', None)
+        core.register('dhcp_server', self.server)
+        self.tracker = tt.DynamicTopology()
+        self.tracker._t.cancel()
+        self.tracker.graph = self.graph
+        self.server._topology_tracker_stable(tt.StableEvent(True, self.graph))
+        if self.server._t is not None:
+            self.server._t.cancel()
+        self.edges = list(self.server.edges)
+        self.clients = []
+        self.reset()
+
+    def reset(self):
+        self.latency = []
+        self.busy = 0.0
+        self.transactions = 0
+        self.naks = 0
+        self.lost = 0
+        self.renumbered = 0
+        self.renew_times = []
+
+    def add_clients(self, count):
+        start = len(self.clients)
+        for n in range(start, start + count):
+            dpid = self.edges[n % len(self.edges)]
+            c = Client(n + 1, dpid, 10 + n // len(self.edges))
+            self.tracker.learn_host(c.dpid, c.port, c.mac)
+            self.clients.append(c)
+
+    def move(self, c, dpid):
+        '''
+        Move a client the way a port going down and a packet at the new
+        switch reach topology_tracker: it leaves, then joins with no IP.
+        '''
+
+        self.tracker.remove_hosts([self.graph.node[str(c.mac)]['info']])
+        c.dpid = dpid
+        c.port = 10 + self.rand.randint(0, 1000)
+        self.tracker.learn_host(c.dpid, c.port, c.mac)
+
+    def packet_in(self, c, packet):
+        "Hand one DHCP packet-in to the server, return the reply type and IP."
+        con = self.graph.node[c.dpid]['connection']
+        event = tt.DHCPEvent(offline.FakePacketIn(con, c.port, packet),
+                             self.graph)
+        con.last = None
+        t0 = timer()
+        self.server._dhcp_PacketIn(event)
+        dt = timer() - t0
+        self.latency.append(dt)
+        self.busy += dt
+        self.last_reply = con.last
+        if con.last is None:
+            return None, None
+        return offline.parse_reply(con.last)
+
+    # client side of the DHCP exchanges
+    def discover(self, c):
+        c.xid += 1
+        t, ip = self.packet_in(c, offline.dhcp_packet(
+            c.mac, pkt.dhcp.DISCOVER_MSG, c.xid, requested=c.ip))
+        if t == pkt.dhcp.OFFER_MSG:
+            c.offer = ip
+            return True
+        self._failed(t)
+        return False
+
+    def request(self, c, ip, renew=False):
+        if renew:
+            packet = offline.dhcp_packet(c.mac, pkt.dhcp.REQUEST_MSG, c.xid,
+                                         requested=ip, ciaddr=ip,
+                                         server=c.server, broadcast=False)
+        else:
+            packet = offline.dhcp_packet(c.mac, pkt.dhcp.REQUEST_MSG, c.xid,
+                                         requested=ip)
+        t, got = self.packet_in(c, packet)
+        if t == pkt.dhcp.ACK_MSG:
+            c.ip = got
+            c.server = self.server.edges[c.dpid]
+            c.acked = self.now
+            c.t1 = offline.reply_times(self.last_reply)[1]
+            self.transactions += 1
+            return True
+        self._failed(t)
+        return False
+
+    def release(self, c):
+        d = offline.dhcp_packet(c.mac, pkt.dhcp.RELEASE_MSG, c.xid,
+                                ciaddr=c.ip, server=c.server,
+                                broadcast=False)
+        self.packet_in(c, d)
+        c.ip = None
+        self.transactions += 1
+
+    def _failed(self, t):
+        if t == pkt.dhcp.NAK_MSG:
+            self.naks += 1
+        else:
+            self.lost += 1
+
+    # scenarios
+    def run_events(self, events):
+        '''
+        Run (time, seq, action, client) events in simulated time order.
+        Actions may return further events to schedule.
+        '''
+
+        heapq.heapify(events)
+        seq = len(events)
+        while events:
+            when, _, action, c = heapq.heappop(events)
+            self.now = when
+            for delay, follow in (action(c) or ()):
+                seq += 1
+                heapq.heappush(events, (when + delay, seq, follow, c))
+
+    def _dora(self, c):
+        if self.discover(c):
+            return [(self.rand.uniform(0.001, 0.05),
+                     lambda c: self.request(c, c.offer) and None)]
+
+    def boot(self, window):
+        "Morning boot storm: every client does DORA within window seconds."
+        events = [(self.rand.uniform(0, window), i, self._dora, c)
+                  for i, c in enumerate(self.clients) if c.ip is None]
+        self.run_events(events)
+
+    def renew(self, window):
+        events = [(self.rand.uniform(0, window), i,
+                   lambda c: self.request(c, c.ip, renew=True) and None, c)
+                  for i, c in enumerate(self.clients) if c.ip is not None]
+        self.run_events(events)
+
+    def renewals(self, periods):
+        '''
+        Let every client renew at its T1 for the given number of lease
+        periods, recording when each renewal happened.
+        '''
+
+        end = self.now + periods * self.server.lease_time
+
+        def renew(c):
+            self.renew_times.append(self.now)
+            if self.request(c, c.ip, renew=True) and self.now + c.t1 < end:
+                return [(c.t1, renew)]
+
+        events = [(c.acked + c.t1, i, renew, c)
+                  for i, c in enumerate(self.clients)
+                  if c.ip is not None and c.t1]
+        self.run_events(events)
+
+    def histogram(self, bucket):
+        "Renewals per bucket seconds, from the first renewal on."
+        if not self.renew_times:
+            return []
+        start = min(self.renew_times)
+        counts = [0] * (int((max(self.renew_times) - start) // bucket) + 1)
+        for t in self.renew_times:
+            counts[int((t - start) // bucket)] += 1
+        return counts
+
+    def roam(self, window, fraction):
+        "Mass roaming: fraction of the clients move subnet and DHCP again."
+        movers = self.rand.sample(self.clients,
+                                  int(len(self.clients) * fraction))
+        before = dict((c.mac, c.ip) for c in movers)
+
+        def moved(c):
+            # every edge switch serves its own subnet
+            dpid = self.rand.choice(self.edges)
+            while dpid == c.dpid and len(self.edges) > 1:
+                dpid = self.rand.choice(self.edges)
+            self.move(c, dpid)
+            return self._dora(c)
+
+        events = [(self.rand.uniform(0, window), i, moved, c)
+                  for i, c in enumerate(movers)]
+        self.run_events(events)
+        self.renumbered += sum(1 for c in movers
+                               if before[c.mac] is not None and
+                               c.ip != before[c.mac])
+
+    def pool(self, workers, batch=256):
+        '''
+        Push a DISCOVER from every client through a WorkerPool with the
+        given number of workers and hand the decoded results to the server,
+        as PacketInWorkers does. Returns packet-ins per second, wall clock.
+        '''
+
+        frames = []
+        for c in self.clients:
+            c.xid += 1
+            con = self.graph.node[c.dpid]['connection']
+            frame = offline.dhcp_frame(c.mac, pkt.dhcp.DISCOVER_MSG, c.xid)
+            frames.append((offline.FakePacketIn(con, c.port, None, frame),
+                           frame))
+
+        def handle(event, fields):
+            self.server._dhcp_PacketIn(tt.DHCPEvent(
+                packetin_workers.DecodedPacketIn(event, fields), self.graph))
+
+        if workers == 0:
+            t0 = timer()
+            for event, frame in frames:
+                event.parsed = pkt.ethernet(frame)
+                self.server._dhcp_PacketIn(tt.DHCPEvent(event, self.graph))
+            return len(frames) / (timer() - t0)
+
+        pool = packetin_workers.WorkerPool(workers)
+        try:
+            t0 = timer()
+            for i, (event, frame) in enumerate(frames):
+                pool.submit(event.dpid, event.port, frame, event)
+                if i % batch == batch - 1:
+                    pool.flush()
+                    for pipe in pool.pipes:
+                        while pipe.poll():
+                            for event, kind, fields in pool.collect(pipe):
+                                handle(event, fields)
+            pool.flush()
+            while pool.pending:
+                ready, _, _ = select.select(pool.pipes, [], [], 5)
+                for pipe in ready:
+                    for event, kind, fields in pool.collect(pipe):
+                        handle(event, fields)
+            return len(frames) / (timer() - t0)
+        finally:
+            pool.close()
+
+    def release_all(self, window):
+        events = [(self.rand.uniform(0, window), i,
+                   lambda c: self.release(c), c)
+                  for i, c in enumerate(self.clients) if c.ip is not None]
+        self.run_events(events)
+
+    # reporting
+    def stats(self):
+        lat = offline.percentiles(self.latency)
+        busy = self.busy or 1e-9
+        return {
+            'packet_ins': len(self.latency),
+            'transactions': self.transactions,
+            'naks': self.naks,
+            'lost': self.lost,
+            'renumbered': self.renumbered,
+            'handler_seconds': self.busy,
+            'transactions_per_sec': self.transactions / busy,
+            'packet_ins_per_sec': len(self.latency) / busy,
+            'latency_us': dict(('p%s' % p, v * 1e6)
+                               for p, v in lat.items()),
+        }
+
+    def pool_state(self):
+        s = self.server
+        leased = sum(len(l) for l in s.leases.values())
+        offered = sum(len(o) for o in s.offers.values())
+        free = sum(len(sub.pool) for sub in s.subnets.values())
+        return {
+            'subnets': len(s.subnets),
+            'leased': leased,
+            'offered': offered,
+            'free': free,
+            'mobile_hosts': len(s.mobile_hosts),
+        }
+
+
+def print_stats(name, stats, pools):
+    lat = stats['latency_us']
+    print('%-8s %7i pkt-ins %7i txns %5i naks %5i lost %5i renumbered  '
+          '%9.0f txn/s  %9.0f pkt-in/s  p50 %6.1fus p90 %6.1fus '
+          'p99 %6.1fus' % (
+              name, stats['packet_ins'], stats['transactions'],
+              stats['naks'], stats['lost'], stats['renumbered'],
+              stats['transactions_per_sec'],
+              stats['packet_ins_per_sec'], lat['p50'], lat['p90'],
+              lat['p99']))
+    print('         pools: %(subnets)i subnets, %(leased)i leased, '
+          '%(offered)i offered, %(free)i free, %(mobile_hosts)i mobile'
+          % pools)
+
+
+def print_histogram(counts, bucket, width=60):
+    if not counts:
+        return
+    peak = max(counts)
+    mean = float(sum(counts)) / len(counts)
+    print('         renew rate per %gs: peak %i, mean %.1f, peak/mean %.1f'
+          % (bucket, peak, mean, peak / mean))
+    for i, n in enumerate(counts):
+        print('         %8gs %6i %s' % (i * bucket, n,
+                                        '#' * int(width * n / peak)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Offline DHCP storm '
+                                     'benchmark for dhcp_server')
+    parser.add_argument('--hosts', type=int, default=5000)
+    parser.add_argument('--core', type=int, default=5,
+                        help='core mesh size')
+    parser.add_argument('--edges', type=int, default=20,
+                        help='edge switches per core switch')
+    parser.add_argument('--network', default='10.0.0.0/24')
+    parser.add_argument('--window', type=float, default=60.0,
+                        help='simulated seconds each storm is spread over')
+    parser.add_argument('--roam', type=float, default=0.3,
+                        help='fraction of hosts that roam')
+    parser.add_argument('--lease', type=int,
+                        default=dhcp_server.timeoutSec['leaseInterval'],
+                        help='lease time in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='lease jitter as a fraction of the lease time')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='adapt lease times to how much hosts roam')
+    parser.add_argument('--periods', type=float, default=3,
+                        help='lease periods to run renewals for')
+    parser.add_argument('--bucket', type=float, default=60.0,
+                        help='renew histogram bucket in seconds')
+    parser.add_argument('--workers', default='0,1,2,4',
+                        help='worker pool sizes for the pool scenario')
+    parser.add_argument('--scenarios', default='boot,renew,roam,release')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--profile', type=int, metavar='N', default=0,
+                        help='profile each scenario and print the top N '
+                        'functions by cumulative time')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv)
+
+    offline.quiet()
+    storm = Storm(args.core, args.edges, args.network, args.seed, args.lease,
+                  args.jitter, args.adaptive)
+    storm.add_clients(args.hosts)
+    print('%i hosts on %i edge switches, %i subnets' % (
+        args.hosts, len(storm.edges), len(storm.server.subnets)))
+
+    results = {}
+    for name in args.scenarios.split(','):
+        storm.reset()
+        if name == 'pool':
+            results[name] = {}
+            for n in [int(w) for w in args.workers.split(',')]:
+                s = Storm(args.core, args.edges, args.network, args.seed)
+                s.add_clients(args.hosts)
+                rate = s.pool(n)
+                results[name][n] = rate
+                print('pool     %2i workers %9.0f pkt-in/s' % (n, rate))
+            continue
+        profiler = cProfile.Profile() if args.profile else None
+        if profiler is not None:
+            profiler.enable()
+        if name == 'boot':
+            storm.boot(args.window)
+        elif name == 'renew':
+            storm.renew(args.window)
+        elif name == 'roam':
+            storm.roam(args.window, args.roam)
+        elif name == 'renewals':
+            storm.renewals(args.periods)
+        elif name == 'release':
+            storm.release_all(args.window)
+        else:
+            print('unknown scenario %s' % name)
+            continue
+        if profiler is not None:
+            profiler.disable()
+        results[name] = dict(storm.stats(), pools=storm.pool_state())
+        print_stats(name, results[name], results[name]['pools'])
+        if name == 'renewals':
+            results[name]['renew_histogram'] = storm.histogram(args.bucket)
+            print_histogram(results[name]['renew_histogram'], args.bucket)
+        if profiler is not None:
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(
+                args.profile)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    # hosts that roam keep their address
+    renumbered = results.get('roam', {}).get('renumbered')
+    if renumbered:
+        print('%i roaming hosts were given a new address' % renumbered)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
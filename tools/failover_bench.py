@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+# Offline controller failover benchmark. Runs dhcp_server, topology_tracker
+# and route_manager on a synthetic campus whose switches keep flow tables
+# (offline.FlowTableConnection), boots --hosts hosts through DHCP and
+# streams the replication log (replication.Journal) into a Replica through
+# JSON, the way the standby would see it. Then the controller "dies": its
+# components are thrown away, the switches keep their flow tables, and a
+# new controller comes up on the same switches in one of two ways:
+#
+#   cold - plans from scratch, as a restarted controller would once LLDP
+#          discovery and the check_interval stability timer have run
+#   warm - takes over from the replica the way a hot standby does, reading
+#          the switches' flow tables and reconciling path rules
+#
+# Every host then renews its lease. Reports the takeover time, flow_mods
+# sent to the switches (flow churn), path rules kept and replaced, and how
+# many renewals were NAKed.
+
+# Usage: python failover_bench.py [--hosts N] [--core N] [--edges N]
+
+import offline
+from offline import core, of, pkt
+
+import dhcp_server
+import replication
+import route_manager
+
+import argparse
+import json
+import sys
+from timeit import default_timer as timer
+
+def path_rules(nexus):
+    "(dpid, path_rule_key()) -> the flow_mod that put it on the switch."
+    rules = {}
+    for dpid, con in nexus.connections.items():
+        for m in con.table.itervalues():
+            key = route_manager.path_rule_key(m)
+            if key is not None:
+                rules[dpid, key] = m
+    return rules
+
+
+def run(args, mode):
+    '''
+    Bring up a controller, boot the hosts, fail it over in the given mode
+    and renew every lease. Returns a result dict.
+    '''
+
+    nexus = offline.install_core(tables=True)
+    nexus.connections.clear()
+    graph, _, edges = offline.campus_graph(args.core, args.edges, nexus)
+    offline.add_links(graph)
+
+    # the active controller, with the standby following its log
+    active = offline.Controller(graph, args.network, args.lease)
+    replica = replication.Replica()
+    wire = [0]
+
+    def send(entry):
+        line = json.dumps(entry)
+        wire[0] += len(line) + 1
+        replica.apply(json.loads(line))
+
+    journal = replication.Journal(send)
+    active.tracker.addListenerByName('HostEvent', journal.host_event)
+    active.dhcp.addListenerByName('DHCPLease', journal.lease_event)
+    active.dhcp.add_renewal_hook(journal.lease_renewed)
+    t = timer()
+    active.stable()
+    plan_time = timer() - t
+    journal.routes_started(core.route_manager)
+    edges = sorted(active.dhcp.edges)
+
+    hosts = []
+    for i in range(args.hosts):
+        dpid = edges[i % len(edges)]
+        port = 100 + i // len(edges)
+        mac = offline.int2mac(i + 1)
+        _, offer = active.dhcp_packet(dpid, port, mac,
+                                      pkt.dhcp.DISCOVER_MSG, 1)
+        _, ip = active.dhcp_packet(dpid, port, mac, pkt.dhcp.REQUEST_MSG, 2,
+                                   requested=offer)
+        hosts.append((dpid, port, mac, ip, active.dhcp.edges[dpid]))
+    before = path_rules(nexus)
+    active.stop()
+
+    # the switches stay up, a new controller takes them over
+    for con in nexus.connections.values():
+        con.flow_mods = 0
+    standby = offline.Controller(offline.switches_of(graph), args.network,
+                                 args.lease, passive=(mode == 'warm'))
+    t = timer()
+    if mode == 'warm':
+        flows = {}
+
+        def stats(event):
+            flows[event.connection.dpid] = set(
+                k for k in map(route_manager.path_rule_key, event.stats)
+                if k is not None)
+        listener = nexus.addListenerByName('FlowStatsReceived', stats)
+        for con in nexus.connections.values():
+            con.send(of.ofp_stats_request(body=of.ofp_flow_stats_request()))
+        nexus.removeListener(listener)
+        replication.take_over(replica, flows)
+    else:
+        standby.stable()
+    takeover = timer() - t
+    routes = core.route_manager
+    churn = sum(con.flow_mods for con in nexus.connections.values())
+    known = len(standby.tracker.hosts)
+
+    # every host renews
+    naks = moved = 0
+    t = timer()
+    for dpid, port, mac, ip, server in hosts:
+        kind, got = standby.dhcp_packet(dpid, port, mac,
+                                        pkt.dhcp.REQUEST_MSG, 3,
+                                        requested=ip, ciaddr=ip,
+                                        server=server)
+        if kind != pkt.dhcp.ACK_MSG:
+            naks += 1
+        elif got != ip:
+            moved += 1
+    renew_time = timer() - t
+    after = path_rules(nexus)
+    # path rules the new controller didn't have to touch
+    kept = sum(1 for k, m in before.iteritems() if after.get(k) is m)
+    total = len(before)
+    standby.stop()
+
+    return dict(mode=mode, hosts=args.hosts, switches=len(nexus.connections),
+                plan_ms=plan_time * 1000, takeover_ms=takeover * 1000,
+                renew_ms=renew_time * 1000, flow_mods=churn,
+                path_rules=total, kept=kept,
+                reused=routes.reused, removed=routes.removed,
+                hosts_known=known, leases=len(replica.leases),
+                naks=naks, readdressed=moved, log_bytes=wire[0])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Offline controller '
+                                     'failover benchmark')
+    parser.add_argument('--hosts', type=int, default=2000)
+    parser.add_argument('--core', type=int, default=4,
+                        help='core mesh size')
+    parser.add_argument('--edges', type=int, default=10,
+                        help='edge switches per core switch')
+    parser.add_argument('--network', default='10.0.0.0/24')
+    parser.add_argument('--lease', type=int,
+                        default=dhcp_server.timeoutSec['leaseInterval'])
+    parser.add_argument('--modes', default='cold,warm')
+    parser.add_argument('--failover-timeout', type=float, default=0.5,
+                        help='standby failover_timeout, added to the warm '
+                        'takeover time')
+    parser.add_argument('--check-interval', type=float, default=5.0,
+                        help='topology_tracker check_interval; a cold '
+                        'controller waits at least this long for a stable '
+                        'topology')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv)
+
+    offline.quiet()
+    results = [run(args, mode) for mode in args.modes.split(',')]
+
+    print('%i hosts, %i switches' % (args.hosts, results[0]['switches']))
+    print('%-5s %10s %10s %10s %9s %9s %9s %6s %6s' % (
+        'mode', 'takeover', 'failover', 'flow_mods', 'rules', 'kept',
+        'hosts', 'naks', 'moved'))
+    for r in results:
+        wait = (args.failover_timeout if r['mode'] == 'warm'
+                else args.check_interval)
+        r['failover_ms'] = r['takeover_ms'] + wait * 1000
+        print('%-5s %8.1fms %8.0fms %10i %9i %9i %9i %6i %6i' % (
+            r['mode'], r['takeover_ms'], r['failover_ms'], r['flow_mods'],
+            r['path_rules'], r['kept'], r['hosts_known'], r['naks'],
+            r['readdressed']))
+    print('failover adds --failover-timeout to warm takeovers and '
+          '--check-interval to cold ones; cold also waits for LLDP '
+          'discovery, which is not counted')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(args=vars(args), results=results), f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,948 @@
+#!/usr/bin/python
+
+# A fake OpenFlow 1.0 switch fabric for scale tests without Mininet, OVS or
+# root. Every switch of a synthetic campus (offline.campus_graph) connects
+# to the controller over its own TCP connection and behaves like a plain
+# OpenFlow 1.0 datapath: it answers the handshake, echo, barrier and stats
+# requests, keeps a flow table with priorities, idle and hard timeouts and
+# FlowRemoved messages, runs packet_outs and matching flows, and sends
+# anything that misses the table to the controller. Frames output on a
+# switch-to-switch port arrive on the other switch, so discovery's LLDP
+# finds the links.
+#
+# Hosts hang off the edge switches. Each one gets an address with DHCP,
+# answers ARP and pings, and pings a random other host every
+# --ping-interval seconds, resolving its next hop with ARP first. Once the
+# hosts are up, --move-rate hosts a second move to another edge switch: the
+# old switch reports their port deleted, the new one reports a port added,
+# and the host DHCPs again for its address, the way load_test.py moves
+# Mininet hosts.
+#
+# Everything runs on one thread. Reports how long hosts took to get an
+# ACK, ping round trips, how long a moved host took to get an ACK and its
+# first ping reply, and the OpenFlow messages exchanged.
+
+# Usage: python fake_fabric.py [--controller HOST:PORT] [--core N]
+#                              [--edges N] [--hosts N] [--duration S]
+
+import offline
+from offline import of, pkt, percentiles
+from pox.lib.addresses import EthAddr, IPAddr
+
+import argparse
+import bisect
+import collections
+import errno
+import heapq
+import json
+import random
+import select
+import socket
+import struct
+import sys
+import time
+
+OFP_VERSION = 1
+OFP_HEADER = struct.Struct('!BBHI')
+PHY_PORT = struct.Struct('!H6s16sIIIIII')
+PACKET_IN = struct.Struct('!IHHBx')
+FLOW_REMOVED = struct.Struct('!QHBxIIHxxQQ')
+FLOW_STATS = struct.Struct('!IIHHH6xQQQ')
+NO_BUFFER = 0xffffffff
+
+# OpenFlow 1.0 message types
+OFPT_HELLO = 0
+OFPT_ECHO_REQUEST = 2
+OFPT_ECHO_REPLY = 3
+OFPT_FEATURES_REQUEST = 5
+OFPT_FEATURES_REPLY = 6
+OFPT_GET_CONFIG_REQUEST = 7
+OFPT_GET_CONFIG_REPLY = 8
+OFPT_PACKET_IN = 10
+OFPT_FLOW_REMOVED = 11
+OFPT_PORT_STATUS = 12
+OFPT_PACKET_OUT = 13
+OFPT_FLOW_MOD = 14
+OFPT_STATS_REQUEST = 16
+OFPT_STATS_REPLY = 17
+OFPT_BARRIER_REQUEST = 18
+OFPT_BARRIER_REPLY = 19
+MESSAGES = {OFPT_HELLO: 'hello', OFPT_ECHO_REQUEST: 'echo_request',
+            OFPT_FEATURES_REQUEST: 'features_request',
+            OFPT_GET_CONFIG_REQUEST: 'get_config_request',
+            OFPT_PACKET_OUT: 'packet_out', OFPT_FLOW_MOD: 'flow_mod',
+            OFPT_STATS_REQUEST: 'stats_request',
+            OFPT_BARRIER_REQUEST: 'barrier_request'}
+
+# flow table capabilities and the actions this fabric runs
+CAPABILITIES = 0x7  # flow, table and port stats
+ACTIONS = ((1 << of.OFPAT_OUTPUT) | (1 << of.OFPAT_SET_VLAN_VID) |
+           (1 << of.OFPAT_STRIP_VLAN) | (1 << of.OFPAT_SET_DL_SRC) |
+           (1 << of.OFPAT_SET_DL_DST))
+PORT_1GB_FD = 1 << 5
+
+HOST_PORT_START = 100  # host ports are numbered from here on every switch
+MAX_HOPS = 32          # frames going round longer than this are dropped
+STATS_PER_REPLY = 400  # flow stats per reply, keeps replies under 64KB
+
+BROADCAST = b'\xff' * 6
+ETH_IP = b'\x08\x00'
+ETH_ARP = b'\x08\x06'
+ETH_VLAN = b'\x81\x00'
+DHCP_CLIENT_PORT = struct.pack('!H', pkt.dhcp.CLIENT_PORT)
+
+
+def checksum(data):
+    "The Internet checksum of data."
+    if len(data) % 2:
+        data += b'\0'
+    s = sum(struct.unpack('!%iH' % (len(data) // 2), data))
+    s = (s >> 16) + (s & 0xffff)
+    s += s >> 16
+    return ~s & 0xffff
+
+
+def ipv4_frame(src, dst, srcip, dstip, proto, payload):
+    "An Ethernet frame holding an IPv4 packet. Addresses are raw."
+    header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(payload), 0, 0,
+                         64, proto, 0, srcip, dstip)
+    header = header[:10] + struct.pack('!H', checksum(header)) + header[12:]
+    return dst + src + ETH_IP + header + payload
+
+
+def icmp_echo(kind, ident, seq, data=b''):
+    "An ICMP echo request (kind 8) or reply (kind 0)."
+    body = struct.pack('!BBHHH', kind, 0, 0, ident, seq) + data
+    return body[:2] + struct.pack('!H', checksum(body)) + body[4:]
+
+
+def arp_frame(dst, opcode, sha, spa, tha, tpa):
+    "An Ethernet frame holding an ARP packet. Addresses are raw."
+    return dst + sha + ETH_ARP + struct.pack(
+        '!HHBBH6s4s6s4s', 1, 0x0800, 6, 4, opcode, sha, spa, tha, tpa)
+
+
+def ofp(kind, xid, body=b''):
+    "Pack an OpenFlow message."
+    return OFP_HEADER.pack(OFP_VERSION, kind, OFP_HEADER.size + len(body),
+                           xid) + body
+
+
+class Stats(object):
+    "Counters and latency samples for the whole fabric."
+
+    def __init__(self):
+        self.counts = collections.defaultdict(int)
+        self.samples = collections.defaultdict(list)
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def sample(self, name, value):
+        self.samples[name].append(value)
+
+
+class FlowEntry(object):
+    "One flow table entry."
+
+    __slots__ = ('match', 'key', 'priority', 'actions', 'idle_timeout',
+                 'hard_timeout', 'flags', 'cookie', 'created', 'used',
+                 'packets', 'bytes')
+
+    def __init__(self, msg, now):
+        self.match = msg.match
+        self.key = (msg.match.pack(), msg.priority)
+        self.priority = msg.priority
+        self.actions = msg.actions
+        self.idle_timeout = msg.idle_timeout
+        self.hard_timeout = msg.hard_timeout
+        self.flags = msg.flags
+        self.cookie = msg.cookie
+        self.created = now
+        self.used = now
+        self.packets = 0
+        self.bytes = 0
+
+    def expired(self, now):
+        "The reason the entry has expired, or None."
+        if self.hard_timeout and now - self.created >= self.hard_timeout:
+            return of.OFPRR_HARD_TIMEOUT
+        if self.idle_timeout and now - self.used >= self.idle_timeout:
+            return of.OFPRR_IDLE_TIMEOUT
+        return None
+
+
+class FlowTable(object):
+    "Flow entries, highest priority first."
+
+    def __init__(self):
+        self.entries = []
+        self._order = []  # -priority of each entry, for bisect
+        self.by_key = {}  # (packed match, priority) -> FlowEntry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        old = self.by_key.get(entry.key)
+        if old is not None:
+            self.remove([old])
+        i = bisect.bisect_right(self._order, -entry.priority)
+        self.entries.insert(i, entry)
+        self._order.insert(i, -entry.priority)
+        self.by_key[entry.key] = entry
+
+    def remove(self, entries):
+        gone = set(id(e) for e in entries)
+        self.entries = [e for e in self.entries if id(e) not in gone]
+        self._order = [-e.priority for e in self.entries]
+        for e in entries:
+            self.by_key.pop(e.key, None)
+
+    def lookup(self, match):
+        for e in self.entries:
+            if e.match.matches_with_wildcards(match,
+                                              consider_other_wildcards=False):
+                return e
+        return None
+
+    def covered(self, match, priority=None, strict=False):
+        "Entries a flow_mod or stats request with this match applies to."
+        if strict:
+            e = self.by_key.get((match.pack(), priority))
+            return [] if e is None else [e]
+        return [e for e in self.entries
+                if match.matches_with_wildcards(e.match)]
+
+
+class Datapath(object):
+    '''
+    One emulated OpenFlow 1.0 switch and its connection to the controller.
+    '''
+
+    def __init__(self, fabric, dpid):
+        self.fabric = fabric
+        self.dpid = dpid
+        self.ports = {}  # port -> (Datapath, port) or Host
+        self.table = FlowTable()
+        self.sock = None
+        self.inbuf = b''
+        self.outbuf = []
+        self.connected = False
+        self.next_host_port = HOST_PORT_START
+        self.free_ports = []
+
+    # the controller connection
+    def connect(self, address):
+        self.sock = socket.create_connection(address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(0)
+        self.fabric.register(self)
+        self.send(ofp(OFPT_HELLO, 0))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, data):
+        if self.sock is None:
+            return
+        if self.outbuf:
+            self.outbuf.append(data)
+            return
+        try:
+            sent = self.sock.send(data)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.fabric.disconnected(self, e)
+                return
+            sent = 0
+        if sent < len(data):
+            self.outbuf.append(data[sent:])
+            self.fabric.want_write(self, True)
+
+    def writable(self):
+        data = b''.join(self.outbuf)
+        self.outbuf = []
+        try:
+            sent = self.sock.send(data)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.fabric.disconnected(self, e)
+                return
+            sent = 0
+        if sent < len(data):
+            self.outbuf.append(data[sent:])
+        else:
+            self.fabric.want_write(self, False)
+
+    def readable(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.fabric.disconnected(self, e)
+            return
+        if not data:
+            self.fabric.disconnected(self, 'connection closed')
+            return
+        buf = self.inbuf + data
+        i = 0
+        while len(buf) - i >= OFP_HEADER.size:
+            _, kind, length, xid = OFP_HEADER.unpack_from(buf, i)
+            if length < OFP_HEADER.size:
+                self.fabric.disconnected(self, 'bad message length')
+                return
+            if len(buf) - i < length:
+                break
+            self.handle(kind, xid, buf[i:i + length])
+            i += length
+        self.inbuf = buf[i:]
+
+    # messages from the controller
+    def handle(self, kind, xid, data):
+        stats = self.fabric.stats
+        stats.count('rx %s' % MESSAGES.get(kind, 'type %i' % kind))
+        if kind == OFPT_ECHO_REQUEST:
+            self.send(ofp(OFPT_ECHO_REPLY, xid, data[8:]))
+        elif kind == OFPT_FEATURES_REQUEST:
+            self.send(ofp(OFPT_FEATURES_REPLY, xid, self.features()))
+        elif kind == OFPT_GET_CONFIG_REQUEST:
+            self.send(ofp(OFPT_GET_CONFIG_REPLY, xid,
+                          struct.pack('!HH', 0, 0xffff)))
+        elif kind == OFPT_BARRIER_REQUEST:
+            # everything before it has been done already
+            self.send(ofp(OFPT_BARRIER_REPLY, xid))
+            if not self.connected:
+                self.connected = True
+                self.fabric.switch_up(self)
+        elif kind == OFPT_FLOW_MOD:
+            msg = of.ofp_flow_mod()
+            msg.unpack(data)
+            self.flow_mod(msg)
+        elif kind == OFPT_PACKET_OUT:
+            msg = of.ofp_packet_out()
+            msg.unpack(data)
+            if msg.data:
+                self.execute(msg.actions, msg.data, msg.in_port, 0)
+        elif kind == OFPT_STATS_REQUEST:
+            self.stats_request(xid, data)
+
+    def features(self):
+        ports = b''.join(self.phy_port(p) for p in sorted(self.ports))
+        return struct.pack('!QIB3xII', self.dpid, 0, 1, CAPABILITIES,
+                           ACTIONS) + ports
+
+    def phy_port(self, port):
+        mac = struct.pack('!HI', port, self.dpid & 0xffffffff)
+        name = 's%i-eth%i' % (self.dpid, port)
+        return PHY_PORT.pack(port, mac, name, 0, 0, PORT_1GB_FD, 0, 0, 0)
+
+    def port_status(self, reason, port):
+        if self.connected:
+            self.send(ofp(OFPT_PORT_STATUS, 0, struct.pack('!B7x', reason) +
+                          self.phy_port(port)))
+
+    def flow_mod(self, msg):
+        table = self.table
+        now = self.fabric.now
+        command = msg.command
+        before = len(table)
+        if command == of.OFPFC_ADD:
+            table.add(FlowEntry(msg, now))
+        elif command in (of.OFPFC_MODIFY, of.OFPFC_MODIFY_STRICT):
+            entries = table.covered(msg.match, msg.priority,
+                                    command == of.OFPFC_MODIFY_STRICT)
+            for e in entries:
+                e.actions = msg.actions
+            if not entries:
+                table.add(FlowEntry(msg, now))
+        elif command in (of.OFPFC_DELETE, of.OFPFC_DELETE_STRICT):
+            entries = table.covered(msg.match, msg.priority,
+                                    command == of.OFPFC_DELETE_STRICT)
+            if msg.out_port != of.OFPP_NONE:
+                entries = [e for e in entries if any(
+                    isinstance(a, of.ofp_action_output) and
+                    a.port == msg.out_port for a in e.actions)]
+            self.remove(entries, of.OFPRR_DELETE)
+            return
+        self.fabric.flows_changed(len(table) - before)
+
+    def remove(self, entries, reason):
+        if not entries:
+            return
+        self.table.remove(entries)
+        now = self.fabric.now
+        for e in entries:
+            if e.flags & of.OFPFF_SEND_FLOW_REM:
+                age = now - e.created
+                self.send(ofp(OFPT_FLOW_REMOVED, 0, e.match.pack() +
+                              FLOW_REMOVED.pack(e.cookie, e.priority, reason,
+                                                int(age),
+                                                int(age % 1 * 1e9),
+                                                e.idle_timeout, e.packets,
+                                                e.bytes)))
+                self.fabric.stats.count('flow removed')
+        self.fabric.flows_changed(-len(entries))
+
+    def expire(self, now):
+        gone = {}
+        for e in self.table.entries:
+            reason = e.expired(now)
+            if reason is not None:
+                gone.setdefault(reason, []).append(e)
+        for reason, entries in gone.iteritems():
+            self.remove(entries, reason)
+
+    def stats_request(self, xid, data):
+        kind = struct.unpack_from('!H', data, 8)[0]
+        if kind == of.OFPST_FLOW or kind == of.OFPST_AGGREGATE:
+            match = of.ofp_match()
+            match.unpack(data, 12)
+            entries = self.table.covered(match)
+            if kind == of.OFPST_AGGREGATE:
+                body = struct.pack('!QQI4x', sum(e.packets for e in entries),
+                                   sum(e.bytes for e in entries),
+                                   len(entries))
+                self.send(ofp(OFPT_STATS_REPLY, xid,
+                              struct.pack('!HH', kind, 0) + body))
+                return
+            now = self.fabric.now
+            for i in range(0, max(len(entries), 1), STATS_PER_REPLY):
+                chunk = entries[i:i + STATS_PER_REPLY]
+                more = i + STATS_PER_REPLY < len(entries)
+                body = b''.join(self.flow_stats(e, now) for e in chunk)
+                self.send(ofp(OFPT_STATS_REPLY, xid,
+                              struct.pack('!HH', kind, 1 if more else 0) +
+                              body))
+        elif kind == of.OFPST_DESC:
+            body = struct.pack('!256s256s256s32s256s', 'SD-MCAN',
+                               'fake fabric', 'fake_fabric.py',
+                               str(self.dpid), 's%i' % self.dpid)
+            self.send(ofp(OFPT_STATS_REPLY, xid,
+                          struct.pack('!HH', kind, 0) + body))
+        else:
+            # no port, table or queue statistics kept
+            self.send(ofp(OFPT_STATS_REPLY, xid, struct.pack('!HH', kind, 0)))
+
+    def flow_stats(self, e, now):
+        actions = b''.join(a.pack() for a in e.actions)
+        age = now - e.created
+        return (struct.pack('!HBx', 88 + len(actions), 0) + e.match.pack() +
+                FLOW_STATS.pack(int(age), int(age % 1 * 1e9), e.priority,
+                                e.idle_timeout, e.hard_timeout, e.cookie,
+                                e.packets, e.bytes) + actions)
+
+    # the data plane
+    def receive(self, in_port, frame, hops):
+        match = of.ofp_match.from_packet(pkt.ethernet(frame), in_port)
+        entry = self.table.lookup(match)
+        if entry is None:
+            self.packet_in(in_port, frame, of.OFPR_NO_MATCH)
+            return
+        entry.used = self.fabric.now
+        entry.packets += 1
+        entry.bytes += len(frame)
+        self.execute(entry.actions, frame, in_port, hops)
+
+    def packet_in(self, in_port, frame, reason):
+        self.fabric.stats.count('packet-ins')
+        self.send(ofp(OFPT_PACKET_IN, 0, PACKET_IN.pack(
+            NO_BUFFER, len(frame), in_port, reason) + frame))
+
+    def execute(self, actions, frame, in_port, hops):
+        for a in actions:
+            if isinstance(a, of.ofp_action_output):
+                self.output(a.port, frame, in_port, hops)
+            elif isinstance(a, of.ofp_action_vlan_vid):
+                if frame[12:14] == ETH_VLAN:
+                    tci = struct.unpack_from('!H', frame, 14)[0]
+                    tci = (tci & 0xf000) | (a.vlan_vid & 0xfff)
+                    frame = frame[:14] + struct.pack('!H', tci) + frame[16:]
+                else:
+                    frame = (frame[:12] + ETH_VLAN +
+                             struct.pack('!H', a.vlan_vid & 0xfff) +
+                             frame[12:])
+            elif isinstance(a, of.ofp_action_strip_vlan):
+                if frame[12:14] == ETH_VLAN:
+                    frame = frame[:12] + frame[16:]
+            elif isinstance(a, of.ofp_action_dl_addr):
+                mac = a.dl_addr.toRaw()
+                if a.type == of.OFPAT_SET_DL_DST:
+                    frame = mac + frame[6:]
+                else:
+                    frame = frame[:6] + mac + frame[12:]
+            else:
+                self.fabric.stats.count('unsupported actions')
+
+    def output(self, port, frame, in_port, hops):
+        if port == of.OFPP_IN_PORT:
+            port = in_port
+        if port in (of.OFPP_FLOOD, of.OFPP_ALL):
+            for p in self.ports:
+                if p != in_port:
+                    self.fabric.transmit(self, p, frame, hops)
+        elif port == of.OFPP_CONTROLLER:
+            self.packet_in(in_port, frame, of.OFPR_ACTION)
+        elif port == of.OFPP_TABLE:
+            self.receive(in_port, frame, hops)
+        elif port < of.OFPP_MAX:
+            self.fabric.transmit(self, port, frame, hops)
+
+    # hosts
+    def attach(self, host):
+        port = (self.free_ports.pop() if self.free_ports
+                else self.next_host_port)
+        if port == self.next_host_port:
+            self.next_host_port += 1
+        self.ports[port] = host
+        host.switch, host.port = self, port
+        self.port_status(of.OFPPR_ADD, port)
+
+    def detach(self, host):
+        del self.ports[host.port]
+        self.free_ports.append(host.port)
+        self.port_status(of.OFPPR_DELETE, host.port)
+        host.switch = host.port = None
+
+
+class Host(object):
+    '''
+    An emulated host: gets an address with DHCP, answers ARP and pings and
+    pings other hosts.
+    '''
+
+    def __init__(self, fabric, n):
+        self.fabric = fabric
+        self.n = n
+        self.mac = offline.int2mac(n).toRaw()
+        self.switch = None
+        self.port = None
+        self.ip = None        # raw address once bound
+        self.gateway = None
+        self.mask = 0
+        self.xid = n << 8
+        self.dhcp_state = None  # 'discover', 'request' or None when bound
+        self.dhcp_started = None
+        self.arp_cache = {}   # raw IP -> raw MAC
+        self.arp_waiting = {}  # raw IP -> frames waiting for its MAC
+        self.pings = {}       # seq -> (time sent, moved at)
+        self.seq = 0
+        self.moved = None     # when the host last moved, until it gets a reply
+
+    def send(self, frame):
+        if self.switch is not None:
+            self.fabric.transmit_to(self.switch, self.port, frame)
+
+    # DHCP
+    def dhcp_start(self, rebind=False):
+        self.dhcp_started = self.fabric.now
+        if rebind and self.ip is not None:
+            self.dhcp_send('request', pkt.dhcp.REQUEST_MSG, IPAddr(self.ip))
+        else:
+            self.dhcp_send('discover', pkt.dhcp.DISCOVER_MSG)
+
+    def dhcp_send(self, state, msg_type, requested=None):
+        self.dhcp_state = state
+        self.xid += 1
+        self.send(offline.dhcp_frame(EthAddr(self.mac), msg_type, self.xid,
+                                     requested))
+        self.fabric.stats.count('dhcp sent')
+        xid = self.xid
+        self.fabric.after(self.fabric.args.dhcp_retry, self._dhcp_retry, xid)
+
+    def _dhcp_retry(self, xid):
+        if self.dhcp_state is not None and xid == self.xid:
+            self.fabric.stats.count('dhcp retries')
+            self.dhcp_send('discover', pkt.dhcp.DISCOVER_MSG)
+
+    def dhcp(self, frame):
+        if frame[70:76] != self.mac or self.dhcp_state is None:
+            return
+        opts = offline.reply_options(frame)
+        kind = ord(opts.get(pkt.dhcp.MSG_TYPE_OPT, b'\0')[:1])
+        yiaddr = frame[58:62]
+        if kind == pkt.dhcp.OFFER_MSG and self.dhcp_state == 'discover':
+            self.dhcp_send('request', pkt.dhcp.REQUEST_MSG, IPAddr(yiaddr))
+        elif kind == pkt.dhcp.ACK_MSG and self.dhcp_state == 'request':
+            self.bound(yiaddr, opts)
+        elif kind == pkt.dhcp.NAK_MSG:
+            self.fabric.stats.count('dhcp naks')
+            self.dhcp_send('discover', pkt.dhcp.DISCOVER_MSG)
+
+    def bound(self, ip, opts):
+        fabric = self.fabric
+        first = self.ip is None
+        self.dhcp_state = None
+        if self.ip != ip:
+            self.arp_cache.clear()
+        self.ip = ip
+        self.gateway = opts.get(pkt.dhcp.ROUTERS_OPT, b'')[:4] or None
+        mask = opts.get(pkt.dhcp.SUBNET_MASK_OPT, b'\xff\xff\xff\xff')
+        self.mask = struct.unpack('!I', mask[:4])[0]
+        took = fabric.now - self.dhcp_started
+        if first:
+            fabric.stats.sample('dhcp boot', took)
+            fabric.host_bound(self)
+        elif self.moved is not None:
+            fabric.stats.sample('handover ack', took)
+
+    # ARP and ping
+    def resolve(self, ip, frame):
+        "Send frame (without its destination MAC) to the next hop for ip."
+        hop = ip
+        mine = struct.unpack('!I', self.ip)[0]
+        if (mine ^ struct.unpack('!I', ip)[0]) & self.mask:
+            hop = self.gateway
+        if hop is None:
+            return
+        mac = self.arp_cache.get(hop)
+        if mac is not None:
+            self.send(mac + frame)
+            return
+        waiting = self.arp_waiting.setdefault(hop, [])
+        waiting.append(frame)
+        if len(waiting) == 1:
+            self.fabric.stats.count('arp requests')
+            self.send(arp_frame(BROADCAST, 1, self.mac, self.ip,
+                                b'\0' * 6, hop))
+            self.fabric.after(1.0, self._arp_timeout, hop)
+
+    def _arp_timeout(self, hop):
+        if self.arp_waiting.pop(hop, None):
+            self.fabric.stats.count('arp timeouts')
+
+    def arp(self, frame):
+        opcode, sha, spa, tha, tpa = struct.unpack_from('!H6s4s6s4s', frame,
+                                                        20)
+        if self.ip is None:
+            return
+        if opcode == 1 and tpa == self.ip:
+            # like Linux, a request for us teaches us the sender
+            self.learn(spa, sha)
+            self.send(arp_frame(sha, 2, self.mac, self.ip, sha, spa))
+        elif opcode == 2 and tha == self.mac:
+            self.learn(spa, sha)
+
+    def learn(self, ip, mac):
+        self.arp_cache[ip] = mac
+        for frame in self.arp_waiting.pop(ip, ()):
+            self.send(mac + frame)
+
+    def ping(self, target):
+        if self.ip is None or self.switch is None:
+            return
+        self.seq = (self.seq + 1) & 0xffff
+        self.pings[self.seq] = (self.fabric.now, self.moved)
+        self.fabric.stats.count('pings sent')
+        frame = ipv4_frame(self.mac, b'', self.ip, target, 1,
+                           icmp_echo(8, self.n & 0xffff, self.seq))
+        self.resolve(target, frame)
+
+    def icmp(self, frame):
+        ihl = (ord(frame[14:15]) & 0xf) * 4
+        kind, _, _, ident, seq = struct.unpack_from('!BBHHH', frame, 14 + ihl)
+        srcip, dstip = frame[26:30], frame[30:34]
+        if dstip != self.ip:
+            return
+        if kind == 8:
+            self.send(ipv4_frame(self.mac, frame[6:12], self.ip, srcip, 1,
+                                 icmp_echo(0, ident, seq,
+                                           frame[14 + ihl + 8:])))
+        elif kind == 0 and ident == self.n & 0xffff:
+            sent = self.pings.pop(seq, None)
+            if sent is None:
+                return
+            now = self.fabric.now
+            self.fabric.stats.count('pings answered')
+            self.fabric.stats.sample('ping rtt', now - sent[0])
+            if self.moved is not None and sent[1] == self.moved:
+                self.fabric.stats.sample('handover ping', now - self.moved)
+                self.moved = None
+
+    def receive(self, frame):
+        dst = frame[:6]
+        if dst != self.mac and dst != BROADCAST:
+            return
+        kind = frame[12:14]
+        if kind == ETH_ARP:
+            self.arp(frame)
+        elif kind == ETH_IP:
+            proto = ord(frame[23:24])
+            if proto == 17 and frame[36:38] == DHCP_CLIENT_PORT:
+                self.dhcp(frame)
+            elif proto == 1:
+                self.icmp(frame)
+
+
+class Fabric(object):
+    '''
+    The switches and hosts, the frames in flight between them and the
+    event loop that drives it all.
+    '''
+
+    def __init__(self, args):
+        self.args = args
+        self.address = (args.controller.rpartition(':')[0],
+                        int(args.controller.rpartition(':')[2]))
+        self.rng = random.Random(args.seed)
+        self.stats = Stats()
+        self.now = time.time()
+        self.start = self.now
+        self._timers = []
+        self._seq = 0
+        self._frames = collections.deque()
+        self._poll = select.poll()
+        self._fds = {}
+        self.running = True
+        self.flows = 0
+
+        graph, self.core, self.edges = offline.campus_graph(args.core,
+                                                           args.edges)
+        self.switches = dict((n, Datapath(self, n)) for n in graph)
+        offline.add_links(graph)
+        for a, b, d in graph.edges(data=True):
+            link = d['link']
+            s1, s2 = self.switches[link.dpid1], self.switches[link.dpid2]
+            s1.ports[link.port1] = (s2, link.port2)
+            s2.ports[link.port2] = (s1, link.port1)
+        self.links = graph.number_of_edges()
+        self.hosts = [Host(self, n) for n in range(1, args.hosts + 1)]
+        self.bound = []  # hosts with an address, in the order they got it
+        self.up = 0
+
+    # timers
+    def at(self, when, callback, *args):
+        heapq.heappush(self._timers, (when, self._seq, callback, args))
+        self._seq += 1
+
+    def after(self, delay, callback, *args):
+        self.at(self.now + delay, callback, *args)
+
+    # frames
+    def transmit(self, switch, port, frame, hops):
+        peer = switch.ports.get(port)
+        if peer is None:
+            return
+        if hops >= MAX_HOPS:
+            self.stats.count('frames dropped looping')
+            return
+        if isinstance(peer, Host):
+            self._frames.append((peer.receive, (frame,)))
+        else:
+            self._frames.append((peer[0].receive, (peer[1], frame, hops + 1)))
+
+    def transmit_to(self, switch, port, frame):
+        self._frames.append((switch.receive, (port, frame, 0)))
+
+    def _deliver(self):
+        frames = self._frames
+        while frames:
+            callback, args = frames.popleft()
+            callback(*args)
+
+    # connections
+    def register(self, switch):
+        self._fds[switch.fileno()] = switch
+        self._poll.register(switch.fileno(), select.POLLIN)
+
+    def want_write(self, switch, on):
+        mask = select.POLLIN | (select.POLLOUT if on else 0)
+        self._poll.modify(switch.fileno(), mask)
+
+    def disconnected(self, switch, why):
+        if switch.sock is None:
+            return
+        print('switch %i disconnected: %s' % (switch.dpid, why))
+        self.stats.count('disconnects')
+        self._poll.unregister(switch.fileno())
+        del self._fds[switch.fileno()]
+        switch.sock.close()
+        switch.sock = None
+        switch.connected = False
+        if not self._fds:
+            self.running = False
+
+    def switch_up(self, switch):
+        self.up += 1
+        if self.up == len(self.switches):
+            print('%.1fs: %i switches connected' % (self.now - self.start,
+                                                   self.up))
+            self.after(self.args.host_delay, self.boot_hosts, 0)
+
+    def flows_changed(self, delta):
+        self.flows += delta
+        if self.flows > self.stats.counts['peak flows']:
+            self.stats.counts['peak flows'] = self.flows
+
+    # the scenario
+    def connect_switches(self, dpids):
+        batch = max(1, int(self.args.connect_rate / 10.0))
+        for dpid in dpids[:batch]:
+            try:
+                self.switches[dpid].connect(self.address)
+            except socket.error as e:
+                print('switch %i could not connect to %s:%i: %s' % (
+                    dpid, self.address[0], self.address[1], e))
+                self.running = False
+                return
+        if dpids[batch:]:
+            self.after(0.1, self.connect_switches, dpids[batch:])
+
+    def boot_hosts(self, i):
+        args = self.args
+        if i == 0:
+            print('%.1fs: booting %i hosts' % (self.now - self.start,
+                                               len(self.hosts)))
+        batch = max(1, int(args.host_rate / 10.0))
+        for host in self.hosts[i:i + batch]:
+            self.switches[self.edges[host.n % len(self.edges)]].attach(host)
+            host.dhcp_start()
+        if i + batch < len(self.hosts):
+            self.after(0.1, self.boot_hosts, i + batch)
+
+    def host_bound(self, host):
+        self.bound.append(host)
+        interval = self.args.ping_interval
+        if interval > 0:
+            self.after(self.rng.uniform(0, interval), self.ping, host)
+        if len(self.bound) == len(self.hosts):
+            print('%.1fs: all hosts bound' % (self.now - self.start))
+            if self.args.move_rate > 0:
+                self.after(1.0 / self.args.move_rate, self.move)
+            self.after(self.args.duration, self.stop)
+
+    def ping(self, host):
+        if len(self.bound) > 1:
+            target = host
+            while target is host:
+                target = self.rng.choice(self.bound)
+            if target.ip is not None:
+                host.ping(target.ip)
+        self.after(self.args.ping_interval, self.ping, host)
+
+    def move(self):
+        host = self.rng.choice(self.bound)
+        if host.switch is not None and host.dhcp_state is None:
+            edges = [d for d in self.edges if d != host.switch.dpid]
+            new = self.switches[self.rng.choice(edges)]
+            host.switch.detach(host)
+            new.attach(host)
+            host.moved = self.now
+            host.dhcp_start(rebind=True)
+            self.stats.count('moves')
+        self.after(1.0 / self.args.move_rate, self.move)
+
+    def expire_flows(self):
+        for switch in self.switches.itervalues():
+            if switch.table.entries:
+                switch.expire(self.now)
+        self.after(1.0, self.expire_flows)
+
+    def stop(self):
+        self.running = False
+
+    def report(self, every):
+        counts = self.stats.counts
+        print('%6.1fs: %i/%i switches, %i/%i hosts bound, %i packet-ins, '
+              '%i flow_mods, %i flows, %i/%i pings answered' % (
+                  self.now - self.start, self.up, len(self.switches),
+                  len(self.bound), len(self.hosts), counts['packet-ins'],
+                  counts['rx flow_mod'], self.flows,
+                  counts['pings answered'], counts['pings sent']))
+        self.after(every, self.report, every)
+
+    def run(self):
+        self.connect_switches(sorted(self.switches))
+        self.after(1.0, self.expire_flows)
+        self.after(5.0, self.report, 5.0)
+        while self.running:
+            self.now = time.time()
+            while self._timers and self._timers[0][0] <= self.now:
+                _, _, callback, args = heapq.heappop(self._timers)
+                callback(*args)
+                self._deliver()
+            wait = 100
+            if self._timers:
+                wait = max(0, min(wait, int((self._timers[0][0] -
+                                             time.time()) * 1000)))
+            for fd, event in self._poll.poll(wait):
+                switch = self._fds.get(fd)
+                if switch is None:
+                    continue
+                self.now = time.time()
+                if event & select.POLLOUT:
+                    switch.writable()
+                if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                    if switch.sock is not None:
+                        switch.readable()
+                self._deliver()
+
+    def results(self):
+        samples = dict((name, percentiles(s))
+                       for name, s in self.stats.samples.iteritems())
+        return dict(switches=len(self.switches), links=self.links,
+                    hosts=len(self.hosts), bound=len(self.bound),
+                    seconds=self.now - self.start,
+                    counts=dict(self.stats.counts), percentiles=samples)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Fake OpenFlow 1.0 switch '
+                                     'fabric for scale tests')
+    parser.add_argument('--controller', default='127.0.0.1:6633')
+    parser.add_argument('--core', type=int, default=4,
+                        help='core mesh size')
+    parser.add_argument('--edges', type=int, default=10,
+                        help='edge switches per core switch')
+    parser.add_argument('--hosts', type=int, default=100)
+    parser.add_argument('--connect-rate', type=float, default=200.0,
+                        help='switches connecting per second')
+    parser.add_argument('--host-delay', type=float, default=15.0,
+                        help='seconds between the last switch connecting '
+                        'and the first host booting, enough for discovery '
+                        'and the controller to go stable')
+    parser.add_argument('--host-rate', type=float, default=100.0,
+                        help='hosts booting per second')
+    parser.add_argument('--dhcp-retry', type=float, default=4.0,
+                        help='seconds before a host starts DHCP over')
+    parser.add_argument('--ping-interval', type=float, default=5.0,
+                        help='seconds between each host\'s pings, 0 for '
+                        'none')
+    parser.add_argument('--move-rate', type=float, default=1.0,
+                        help='host moves per second once all hosts are '
+                        'bound, 0 for none')
+    parser.add_argument('--duration', type=float, default=60.0,
+                        help='seconds to run after all hosts are bound')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv)
+
+    fabric = Fabric(args)
+    print('%i switches, %i links, %i hosts; connecting to %s:%i' % (
+        len(fabric.switches), fabric.links, len(fabric.hosts),
+        fabric.address[0], fabric.address[1]))
+    try:
+        fabric.run()
+    except KeyboardInterrupt:
+        pass
+    results = fabric.results()
+
+    print('')
+    for name in sorted(results['counts']):
+        print('%-28s %10i' % (name, results['counts'][name]))
+    print('')
+    print('%-16s %10s %10s %10s %10s' % ('seconds', 'p50', 'p90', 'p99',
+                                         'samples'))
+    for name in sorted(fabric.stats.samples):
+        p = results['percentiles'][name]
+        print('%-16s %10.4f %10.4f %10.4f %10i' % (
+            name, p[50], p[90], p[99], len(fabric.stats.samples[name])))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(args=vars(args), results=results), f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
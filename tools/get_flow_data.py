@@ -3,24 +3,56 @@
 
 # Script to get the average number of flow table entries
 # in switches.
+#
+# The counts come from the controller's flow_stats module, which polls every
+# switch's flow table over OpenFlow, so run the controller with
+# --flow_stats=<seconds> --metrics=<addr>. Counts are broken down by rule
+# class (core, push, pop, same_subnet, dhcp, arp, other). The controller
+# polls on its own interval, so each switch's counts are as of its last
+# reply; how long ago that was is printed next to them.
 
+# Usage: ./get_flow_data.py <num switches> [flows URL]
 
+import json
 import sys
-import subprocess
+import urllib2
 
-if len(sys.argv) > 1:
+FLOWS_URL = 'http://127.0.0.1:9105/flows'
+
+
+def str_to_dpid(s):
+    "Inverse of POX's dpid_to_str."
+    return int(s.split('|')[0].replace('-', ''), 16)
+
+
+def get_flows(url=FLOWS_URL):
+    '''
+    The controller's last flow counts: {dpid: counts}, and the whole
+    snapshot.
+    '''
+    snapshot = json.load(urllib2.urlopen(url, timeout=10))
+    return (dict((str_to_dpid(c['dpid']), c) for c in snapshot['switches']),
+            snapshot)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3) or not sys.argv[1].isdigit():
+        print("Usage: ./get_flow_data.py <num switches> [flows URL]")
+        exit()
     num_switches = int(sys.argv[1])
-    num_flows = {}
+    switches, snapshot = get_flows(*sys.argv[2:])
     total_flows = 0
-    for i in range(0, num_switches + 1):
-        p = subprocess.Popen(["sudo", "ovs-ofctl", "dump-flows", "s{0}".format(i)],
-                             stdout=subprocess.PIPE)
-        out = p.communicate()[0]
-        flows = len([f for f in out.split('\n') if 'cookie' in f])
-        print('switch {0}: {1} flows'.format(i, flows))
-        num_flows[i] = flows
-        total_flows += flows
-    print('Avg. flows per switch: {0}'.format(total_flows / (num_switches + 1)))
-else:
-    print("Usage: ./get_flow_data.py <num switches>")
-    exit()
+    for i in range(1, num_switches + 1):
+        c = switches.get(i)
+        if c is None:
+            print('switch {0}: no counts yet'.format(i))
+            continue
+        total_flows += c['flows']
+        print('switch {0}: {1} flows ({2}), {3:.1f}s old'.format(
+            i, c['flows'], ', '.join(
+                '{0} {1}'.format(k, c[k]) for k in ('core', 'push', 'pop',
+                                                     'same_subnet', 'dhcp',
+                                                     'arp', 'other')),
+            snapshot['time'] - c['time']))
+    print('Avg. flows per switch: {0}'.format(
+        float(total_flows) / num_switches if num_switches else 0.0))
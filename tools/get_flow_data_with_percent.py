@@ -3,31 +3,31 @@
 
 # Script to get the average number of flow table entries
 # in switches, with flows logged by percent mobility.
+#
+# Appends one line to <file>: the flows in switches 1 to <num switches>,
+# the total, the average and <% move>. The counts come from the
+# controller's flow_stats module (see get_flow_data.py).
 
 # 2017 Adam Calabrigo
 
 import sys
-import subprocess
-import os
 
-if len(sys.argv) == 4:
+from get_flow_data import get_flows, FLOWS_URL
+
+if len(sys.argv) in (4, 5):
     num_switches = int(sys.argv[1])
     filename = sys.argv[2]
-    num_flows = {}
+    url = sys.argv[4] if len(sys.argv) == 5 else FLOWS_URL
+    switches, _ = get_flows(url)
     total_flows = 0
 
-    print('Made it to script')
     with open(filename, 'a') as f:
         for i in range(1, num_switches + 1):
-            p = subprocess.Popen(["sudo", "ovs-ofctl", "dump-flows", "s{0}".format(i)],
-                                 stdout=subprocess.PIPE)
-            out = p.communicate()[0]
-            flows = len([x for x in out.split('\n') if 'cookie' in x])
-            num_flows[i] = flows
+            flows = switches.get(i, {}).get('flows', 0)
             total_flows += flows
             f.write(str(flows) + ',')
         avg_flows = total_flows // (num_switches)
         f.write(str(total_flows) + ',' + str(avg_flows) + ',' + str(sys.argv[3]) + '\n')
 else:
-    print("Usage: ./get_flow_data_with_percent.py <num switches> <% move>")
+    print("Usage: ./get_flow_data_with_percent.py <num switches> <file> <% move> [flows URL]")
     exit()
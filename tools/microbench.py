@@ -0,0 +1,402 @@
+#!/usr/bin/python
+
+# Microbenchmarks for the SD-MCAN hot paths, run offline (see offline.py):
+#
+#   get_host_info      - topology_tracker's IP -> host lookup, every leased
+#                        host and one miss
+#   is_edge_port       - every switch port and one host port per leaf
+#   get_link_port      - every link, both ways
+#   host_join          - topology_tracker.update_host(join=True) for every
+#   host_move            host, then moving each to the next leaf, then
+#   host_leave           taking each away again
+#   pool_allocate      - taking hosts addresses out of a SimpleAddressPool
+#   pool_release         the way a DISCOVER does, and putting them back
+#   get_event_subnet   - dhcp_server's dpid -> subnet lookup, every leaf
+#   get_home_subnet    - dhcp_server's IP -> home subnet lookup, every lease
+#   get_label          - route_manager's label lookup, every label in use
+#   path_install       - route_manager labelling every edge to edge path and
+#                        sending its path rules, as at start-up
+#
+# Each case runs on a campus generated by topology_spec.py for every
+# combination of --switches and --hosts (or on --spec), --repeat times,
+# and reports the best and median time per operation. The tracker cases
+# use a tracker of their own that nothing listens to, so they time
+# topology_tracker and not what dhcp_server and route_manager do about its
+# events.
+#
+# compare reads two --json results and flags every case that got more than
+# --threshold slower, exiting 1 if any did.
+
+# Usage:
+#   python microbench.py run [--switches 20,100] [--hosts 50,500]
+#                            [--cases NAME,...] [--json FILE]
+#   python microbench.py compare OLD NEW [--threshold 0.1]
+
+import offline
+from offline import core, pkt
+from pox.lib.addresses import IPAddr
+
+import dhcp_server
+import route_manager
+import topology_spec
+import topology_tracker as tt
+
+import argparse
+import json
+import platform
+import sys
+import time
+from timeit import default_timer as timer
+
+VERSION = 1
+
+CASES = ('get_host_info', 'is_edge_port', 'get_link_port', 'host_join',
+         'host_move', 'host_leave', 'pool_allocate', 'pool_release',
+         'get_event_subnet', 'get_home_subnet', 'get_label', 'path_install')
+
+
+def spec_for(switches, hosts):
+    '''
+    A campus of about this many switches: a mesh of four core switches,
+    two distribution switches on each and edge switches dual-homed to them
+    in fours, with the hosts spread over the edge switches.
+    '''
+    lans = max(1, (switches - 12) // 4)
+    return {'core': {'switches': 4},
+            'distribution': {'per_core': 2, 'uplinks': 2, 'pairs': True},
+            'edge': {'lans': lans, 'shape': 'dual', 'size': 4},
+            'hosts': {'count': hosts}}
+
+
+class Bench(object):
+    '''
+    A controller brought up on a topology, with every host holding a lease.
+    '''
+
+    def __init__(self, topology, network, lease):
+        self.topology = topology
+        nexus = offline.install_core()
+        nexus.connections.clear()
+        self.graph = topology.graph(nexus)
+        offline.add_links(self.graph)
+        self.controller = offline.Controller(self.graph, network, lease)
+        self.controller.stable()
+        if self.controller.dhcp.plan is None:
+            self.controller.stop()
+            raise RuntimeError('dhcp_server did not start serving')
+        self.dhcp = self.controller.dhcp
+        self.tracker = self.controller.tracker
+        self.routes = core.route_manager
+
+        # hosts on ports past the switch ports, as topology_spec numbers them
+        self.hosts = []
+        ports = {}
+        for i, (name, mac, dpid, _) in enumerate(topology.hosts):
+            port = ports[dpid] = ports.get(dpid, self.graph.degree(dpid)) + 1
+            self.hosts.append((offline.int2mac(i + 1), dpid, port))
+        self.ips = []
+        for i, (mac, dpid, port) in enumerate(self.hosts):
+            _, offer = self.controller.dhcp_packet(
+                dpid, port, mac, pkt.dhcp.DISCOVER_MSG, 2 * i + 1)
+            kind, ip = self.controller.dhcp_packet(
+                dpid, port, mac, pkt.dhcp.REQUEST_MSG, 2 * i + 2,
+                requested=offer)
+            if kind != pkt.dhcp.ACK_MSG:
+                raise RuntimeError('%s was not given a lease' % mac)
+            self.ips.append(ip)
+
+    def stop(self):
+        self.controller.stop()
+
+    # each case returns a function running it once, and the operations it
+    # does per run
+    def get_host_info(self):
+        ips = self.ips + [IPAddr('192.0.2.1')]
+        lookup = self.tracker.get_host_info
+
+        def run():
+            for ip in ips:
+                lookup(ip)
+        return run, len(ips)
+
+    def is_edge_port(self):
+        ports = []
+        for a, b in self.graph.edges():
+            link = self.graph[a][b].get('link')
+            if link is not None:
+                ports.append((link.dpid1, link.port1))
+                ports.append((link.dpid2, link.port2))
+        for dpid in self.topology.leaves:
+            ports.append((dpid, self.graph.degree(dpid) + 1))
+        check = self.tracker.is_edge_port
+
+        def run():
+            for dpid, port in ports:
+                check(dpid, port)
+        return run, len(ports)
+
+    def get_link_port(self):
+        pairs = [(a, b) for a, b in self.graph.edges()
+                 if not isinstance(a, str) and not isinstance(b, str)]
+        pairs += [(b, a) for a, b in pairs]
+        get = self.tracker.get_link_port
+
+        def run():
+            for a, b in pairs:
+                get(a, b)
+        return run, len(pairs)
+
+    def _hosts_case(self, step):
+        '''
+        Join, move or leave every host on a tracker of our own. Each run
+        goes through all three so the next one starts from the same graph;
+        only step is timed.
+        '''
+        tracker = tt.DynamicTopology()
+        tracker._t.cancel()
+        self.dhcp.removeListener(tracker._dhcp_lease)
+        tracker.graph = offline.switches_of(self.graph)
+        leaves = self.topology.leaves
+        nxt = dict(zip(leaves, leaves[1:] + leaves[:1]))
+        hosts = self.hosts
+        timed = [0.0]
+
+        def run():
+            made = [tt.Host(dpid, port, mac) for mac, dpid, port in hosts]
+            moves = [tt.Host(nxt[dpid], port, mac)
+                     for mac, dpid, port in hosts]
+            t = timer()
+            for host in made:
+                tracker.update_host(host, join=True)
+            joined = timer()
+            for host, new in zip(made, moves):
+                tracker.update_host(host, move=True, new=new)
+            moved = timer()
+            for host in made:
+                tracker.update_host(host, leave=True)
+            left = timer()
+            timed[0] = {'join': joined - t, 'move': moved - joined,
+                        'leave': left - moved}[step]
+        run.timed = timed
+        return run, len(hosts)
+
+    def host_join(self):
+        return self._hosts_case('join')
+
+    def host_move(self):
+        return self._hosts_case('move')
+
+    def host_leave(self):
+        return self._hosts_case('leave')
+
+    def _pool_case(self, step):
+        n = max(1, len(self.hosts))
+        size = 16
+        while (1 << size) - 2 < n:
+            size += 1
+        pool = dhcp_server.SimpleAddressPool('10.0.0.0/%i' % (32 - size))
+        timed = [0.0]
+
+        def run():
+            t = timer()
+            taken = []
+            for _ in xrange(n):
+                ip = pool[0]
+                pool.remove(ip)
+                taken.append(ip)
+            allocated = timer()
+            for ip in taken:
+                pool.append(ip)
+            released = timer()
+            timed[0] = (allocated - t if step == 'allocate'
+                        else released - allocated)
+        run.timed = timed
+        return run, n
+
+    def pool_allocate(self):
+        return self._pool_case('allocate')
+
+    def pool_release(self):
+        return self._pool_case('release')
+
+    def get_event_subnet(self):
+        dpids = list(self.dhcp.edges)
+        get = self.dhcp.get_event_subnet
+
+        def run():
+            for dpid in dpids:
+                get(dpid)
+        return run, len(dpids)
+
+    def get_home_subnet(self):
+        ips = list(self.ips)
+        get = self.dhcp.get_home_subnet
+
+        def run():
+            for ip in ips:
+                get(ip)
+        return run, len(ips)
+
+    def get_label(self):
+        infos = list(self.routes.label_table)
+        get = self.routes.get_label
+
+        def run():
+            for info in infos:
+                get(info)
+        return run, len(infos)
+
+    def path_install(self):
+        routes = self.routes
+        edges = len(self.dhcp.edges)
+
+        def run():
+            routes.label_table.clear()
+            routes.label_count = route_manager.LABEL_START
+            routes.path_rules.clear()
+            routes.install_path_rules()
+        return run, max(1, edges * (edges - 1))
+
+
+def measure(bench, case, repeat):
+    '''
+    Run a case repeat times and return its seconds per operation, best
+    first.
+    '''
+    run, ops = getattr(bench, case)()
+    times = []
+    for _ in range(repeat):
+        t = timer()
+        run()
+        elapsed = timer() - t
+        timed = getattr(run, 'timed', None)
+        times.append((timed[0] if timed else elapsed) / ops)
+    return sorted(times), ops
+
+
+def run_benchmarks(args):
+    offline.quiet()
+    cases = args.cases.split(',') if args.cases else list(CASES)
+    for case in cases:
+        if case not in CASES:
+            raise SystemExit('unknown case %r, expected one of %s' %
+                             (case, ', '.join(CASES)))
+    if args.spec:
+        base = topology_spec.load(args.spec)
+        sizes = [(len(base.switches), h) for h in args.hosts]
+    else:
+        sizes = [(s, h) for s in args.switches for h in args.hosts]
+
+    results = []
+    for switches, hosts in sizes:
+        if args.spec:
+            spec = topology_spec.merge(base.spec, {'hosts': {
+                'per_switch': 0, 'count': hosts}})
+        else:
+            spec = spec_for(switches, hosts)
+        topology = topology_spec.generate(spec)
+        t = timer()
+        bench = Bench(topology, args.network, args.lease)
+        print('%s (up in %.2fs)' % (topology.summary(), timer() - t))
+        try:
+            for case in cases:
+                times, ops = measure(bench, case, args.repeat)
+                best, median = times[0], times[len(times) // 2]
+                print('  %-18s %10.2fus %10.2fus  x%i' % (
+                    case, best * 1e6, median * 1e6, ops))
+                results.append(dict(case=case, switches=switches,
+                                    hosts=hosts, ops=ops,
+                                    repeat=args.repeat,
+                                    best_us=best * 1e6,
+                                    median_us=median * 1e6))
+        finally:
+            bench.stop()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(version=VERSION, time=time.time(),
+                           python=platform.python_version(),
+                           machine=platform.node(), results=results),
+                      f, indent=2)
+        print('wrote %s' % args.json)
+
+
+def compare(args):
+    runs = []
+    for path in (args.old, args.new):
+        with open(path) as f:
+            data = json.load(f)
+        if data.get('version') != VERSION:
+            raise SystemExit('%s is version %s, expected %i' %
+                             (path, data.get('version'), VERSION))
+        runs.append(dict(((r['case'], r['switches'], r['hosts']), r)
+                         for r in data['results']))
+    old, new = runs
+
+    regressions = 0
+    print('%-18s %8s %8s %10s %10s %7s' % ('case', 'switches', 'hosts',
+                                         'old us', 'new us', 'change'))
+    for key in sorted(set(old) & set(new), key=lambda k: (CASES.index(k[0])
+                                                          if k[0] in CASES
+                                                          else len(CASES),
+                                                          k)):
+        a, b = old[key][args.stat], new[key][args.stat]
+        change = (b - a) / a if a else 0.0
+        flag = ''
+        if change > args.threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        elif change < -args.threshold:
+            flag = '  faster'
+        print('%-18s %8i %8i %10.2f %10.2f %+6.1f%%%s' % (
+            key + (a, b, change * 100, flag)))
+    for key in sorted(set(old) ^ set(new)):
+        print('%-18s %8i %8i only in %s' % (key + (
+            args.old if key in old else args.new,)))
+    print('%i regression%s over %.0f%%' % (
+        regressions, '' if regressions == 1 else 's', args.threshold * 100))
+    return 1 if regressions else 0
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Microbenchmarks for the '
+                                     'SD-MCAN hot paths')
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('run', help='run the benchmarks')
+    p.add_argument('--switches', type=int_list, default=[20, 100],
+                   help='comma separated switch counts')
+    p.add_argument('--hosts', type=int_list, default=[50, 500],
+                   help='comma separated host counts')
+    p.add_argument('--spec', help='topology or spec file from '
+                   'topology_spec.py, instead of generated campuses')
+    p.add_argument('--cases', help='comma separated cases to run (default: '
+                   'all of %s)' % ', '.join(CASES))
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--network', default='10.0.0.0/24')
+    p.add_argument('--lease', type=int,
+                   default=dhcp_server.timeoutSec['leaseInterval'])
+    p.add_argument('--json', help='write results to this file')
+
+    p = sub.add_parser('compare', help='compare two runs')
+    p.add_argument('old')
+    p.add_argument('new')
+    p.add_argument('--threshold', type=float, default=0.1,
+                   help='slow down, as a fraction, that counts as a '
+                   'regression')
+    p.add_argument('--stat', choices=('best_us', 'median_us'),
+                   default='median_us')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        run_benchmarks(args)
+        return 0
+    return compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
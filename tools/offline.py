@@ -0,0 +1,452 @@
+#!/usr/bin/python
+
+# Helpers for driving the SD-MCAN modules offline, without Mininet, OVS or
+# real switches. POX itself still has to be importable: run the tools from
+# the POX directory or point POX_HOME at it. The SD-MCAN modules are picked
+# up from ../modules.
+
+import heapq
+import os
+import struct
+import sys
+
+_here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(_here, '..', 'modules'))
+if 'POX_HOME' in os.environ:
+    sys.path.insert(0, os.environ['POX_HOME'])
+
+import logging
+import pox.core
+if pox.core.core is None:
+    pox.core.initialize()
+from pox.core import core
+import pox.openflow.libopenflow_01 as of
+import pox.lib.packet as pkt
+from pox.lib.addresses import EthAddr, IPAddr, IP_ANY, IP_BROADCAST
+from pox.lib.revent import EventMixin
+from pox.openflow import FlowStatsReceived
+from pox.openflow.discovery import Link
+
+import networkx as nx
+
+import dhcp_server
+import topology_tracker as tt
+
+
+def quiet(level=logging.WARNING):
+    "Keep the controller modules from logging every packet."
+    logging.getLogger().setLevel(level)
+
+
+def int2mac(n):
+    "Locally administered MAC address for host number n."
+    return EthAddr('02:%02x:%02x:%02x:%02x:%02x' % (
+        (n >> 32) & 0xff, (n >> 24) & 0xff, (n >> 16) & 0xff,
+        (n >> 8) & 0xff, n & 0xff))
+
+
+def percentiles(samples, points=(50, 90, 99, 99.9)):
+    "Return {point: value} for the given percentiles of samples."
+    if not samples:
+        return dict((p, 0.0) for p in points)
+    s = sorted(samples)
+    out = {}
+    for p in points:
+        i = min(len(s) - 1, int(round(p / 100.0 * (len(s) - 1))))
+        out[p] = s[i]
+    return out
+
+
+class FakeConnection(object):
+    "Stands in for an OpenFlow connection and keeps what is sent to it."
+
+    def __init__(self, dpid, keep=False):
+        self.dpid = dpid
+        self.keep = keep
+        self.sent = []
+        self.count = 0
+        self.last = None
+
+    def send(self, msg):
+        self.count += 1
+        self.last = msg
+        if self.keep:
+            self.sent.append(msg)
+
+
+class FlowTableConnection(FakeConnection):
+    '''
+    A FakeConnection that also keeps the switch's flow table: flow_mods
+    are applied to it and flow stats requests are answered from it with a
+    FlowStatsReceived event on the nexus.
+    '''
+
+    def __init__(self, dpid, nexus, keep=False):
+        FakeConnection.__init__(self, dpid, keep)
+        self.nexus = nexus
+        self.table = {}  # (packed match, priority) -> ofp_flow_mod
+        self.flow_mods = 0
+
+    def send(self, msg):
+        FakeConnection.send(self, msg)
+        if isinstance(msg, of.ofp_flow_mod):
+            self.flow_mods += 1
+            key = (msg.match.pack(), msg.priority)
+            if msg.command == of.OFPFC_DELETE_STRICT:
+                self.table.pop(key, None)
+            elif msg.command == of.OFPFC_DELETE:
+                if msg.match == of.ofp_match():
+                    self.table.clear()
+                else:
+                    self.table.pop(key, None)
+            else:
+                self.table[key] = msg
+        elif (isinstance(msg, of.ofp_stats_request) and
+              isinstance(msg.body, of.ofp_flow_stats_request)):
+            stats = [of.ofp_flow_stats(match=m.match, priority=m.priority,
+                                       idle_timeout=m.idle_timeout,
+                                       actions=list(m.actions))
+                     for m in self.table.itervalues()]
+            self.nexus.raiseEvent(FlowStatsReceived(self, [], stats))
+
+
+class FakeOpenFlow(EventMixin):
+    "Stands in for core.openflow."
+
+    _eventMixin_events = set([FlowStatsReceived])
+
+    def __init__(self, tables=False):
+        self.connections = {}
+        self.tables = tables
+
+    def connect(self, dpid, keep=False):
+        if self.tables:
+            con = FlowTableConnection(dpid, self, keep)
+        else:
+            con = FakeConnection(dpid, keep)
+        self.connections[dpid] = con
+        return con
+
+    def getConnection(self, dpid):
+        return self.connections.get(dpid)
+
+    def sendToDPID(self, dpid, data):
+        con = self.connections.get(dpid)
+        if con is None:
+            return False
+        con.send(data)
+        return True
+
+
+class FakePacketIn(object):
+    "The parts of a PacketIn event the SD-MCAN handlers look at."
+
+    def __init__(self, connection, port, parsed, data=None):
+        self.connection = connection
+        self.dpid = connection.dpid
+        self.port = port
+        self.parsed = parsed
+        self.data = data
+        self.ofp = None
+
+
+def install_core(tables=False):
+    '''
+    Register a FakeOpenFlow as core.openflow and return it. With tables,
+    its connections keep flow tables (see FlowTableConnection).
+    '''
+    if not core.hasComponent('openflow'):
+        core.register('openflow', FakeOpenFlow(tables))
+    return core.openflow
+
+
+def add_links(graph):
+    '''
+    Give every switch-to-switch edge of graph a discovery Link the way
+    topology_tracker does, numbering each switch's ports from 1.
+    '''
+    ports = {}
+    for a, b in graph.edges():
+        if isinstance(a, str) or isinstance(b, str):
+            continue
+        pa = ports[a] = ports.get(a, 0) + 1
+        pb = ports[b] = ports.get(b, 0) + 1
+        graph[a][b]['link'] = Link(a, pa, b, pb)
+
+
+class Controller(object):
+    '''
+    dhcp_server and topology_tracker registered on core for a graph of
+    switches, the way sd-mcan brings them up. route_manager comes up once
+    dhcp_server is serving. stop() unregisters them all again.
+    '''
+
+    components = ('route_manager', 'topology_tracker', 'dhcp_server')
+
+    def __init__(self, graph, network, lease_time, passive=False):
+        self.dhcp = dhcp_server.DHCPDMulti(network, None, lease_time)
+        self.dhcp.passive = passive
+        core.register('dhcp_server', self.dhcp)
+        self.tracker = tt.DynamicTopology()
+        self.tracker._t.cancel()
+        self.tracker.graph = graph
+        core.register('topology_tracker', self.tracker)
+
+    def stable(self):
+        self.dhcp._topology_tracker_stable(tt.StableEvent(True,
+                                                          self.tracker.graph))
+
+    def dhcp_packet(self, dpid, port, mac, msg_type, xid, requested=None,
+                    ciaddr=None, server=None):
+        '''
+        Learn the host like topology_tracker would and hand a DHCP packet
+        from it to dhcp_server. Returns (reply type, yiaddr).
+        '''
+        graph = self.tracker.graph
+        con = graph.node[dpid]['connection']
+        self.tracker.learn_host(dpid, port, mac)
+        packet = dhcp_packet(mac, msg_type, xid, requested, ciaddr, server,
+                             broadcast=server is None)
+        con.last = None
+        self.dhcp._dhcp_PacketIn(tt.DHCPEvent(
+            FakePacketIn(con, port, packet), graph))
+        if con.last is None:
+            return None, None
+        return parse_reply(con.last)
+
+    def stop(self):
+        for name in self.components:
+            c = core.components.pop(name, None)
+            if getattr(c, '_t', None) is not None:
+                c._t.cancel()
+
+
+def switches_of(graph):
+    "A new graph with just the switches and links of graph."
+    g = nx.Graph()
+    for n in graph.nodes():
+        if not isinstance(n, str):
+            g.add_node(n, **graph.node[n])
+    for a, b, d in graph.edges(data=True):
+        if a in g and b in g:
+            g.add_edge(a, b, **d)
+    return g
+
+
+class SimClock(object):
+    '''
+    Simulated time for the controller modules. patch(module) points the
+    module's time and Timer at this clock, so time.time() reads simulated
+    time and Timers fire as run() advances it.
+    '''
+
+    def __init__(self, now=0.0):
+        self.now = now
+        self._queue = []
+        self._seq = 0
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, callback, *args):
+        heapq.heappush(self._queue, (when, self._seq, callback, args))
+        self._seq += 1
+
+    def run(self, until=float('inf')):
+        "Run everything due up to until, advancing the clock."
+        while self._queue and self._queue[0][0] <= until:
+            when, _, callback, args = heapq.heappop(self._queue)
+            self.now = max(self.now, when)
+            callback(*args)
+        if until != float('inf'):
+            self.now = max(self.now, until)
+
+    def patch(self, module):
+        clock = self
+
+        class Timer(object):
+            "recoco Timer on the simulated clock."
+
+            def __init__(self, timeToWake, callback, absoluteTime=False,
+                         recurring=False, args=(), kw={}, **_):
+                self.interval = timeToWake
+                self.callback = callback
+                self.recurring = recurring
+                self.args, self.kw = args, kw
+                self.cancelled = False
+                when = timeToWake if absoluteTime else clock.now + timeToWake
+                clock.call_at(when, self._fire)
+
+            def _fire(self):
+                if self.cancelled:
+                    return
+                self.callback(*self.args, **self.kw)
+                if self.recurring and not self.cancelled:
+                    clock.call_at(clock.now + self.interval, self._fire)
+
+            def cancel(self):
+                self.cancelled = True
+
+        module.time = self
+        module.Timer = Timer
+
+
+def campus_graph(num_core, edges_per_core, ofnexus=None):
+    '''
+    Build a switch graph with a full mesh of num_core core switches and
+    edges_per_core edge switches hanging off every core switch. Core dpids
+    come first, edge dpids follow. If ofnexus is given, a FakeConnection is
+    made for every switch.
+    '''
+
+    graph = nx.Graph()
+    core_dpids = range(1, num_core + 1)
+    edge_dpids = []
+    for dpid in core_dpids:
+        graph.add_node(dpid)
+    for i in core_dpids:
+        for j in core_dpids:
+            if i < j:
+                graph.add_edge(i, j)
+    dpid = num_core
+    for c in core_dpids:
+        for _ in range(edges_per_core):
+            dpid += 1
+            graph.add_node(dpid)
+            graph.add_edge(c, dpid)
+            edge_dpids.append(dpid)
+    if ofnexus is not None:
+        for n in graph.nodes():
+            graph.node[n]['connection'] = ofnexus.connect(n)
+    return graph, list(core_dpids), edge_dpids
+
+
+def pod_campus_graph(num_core, pods, access_per_pod, hosts_per_access=0,
+                     ofnexus=None):
+    '''
+    Build a meshier campus: a full mesh of num_core core switches and pods
+    of two interconnected distribution switches, each dual-homed to two core
+    switches, with access_per_pod access switches wired to both distribution
+    switches. Optionally hang hosts (MAC string nodes) off the access
+    switches, as topology_tracker would. Returns (graph, core, distribution,
+    access).
+    '''
+
+    graph = nx.Graph()
+    core_dpids = list(range(1, num_core + 1))
+    for i in core_dpids:
+        graph.add_node(i)
+        for j in core_dpids:
+            if i < j:
+                graph.add_edge(i, j)
+    dist, access = [], []
+    dpid = num_core
+    mac = 0
+    for p in range(pods):
+        d1, d2 = dpid + 1, dpid + 2
+        dpid += 2
+        dist.extend([d1, d2])
+        graph.add_edge(d1, d2)
+        for d, c in ((d1, p % num_core), (d2, (p + 1) % num_core)):
+            graph.add_edge(d, core_dpids[c])
+        for _ in range(access_per_pod):
+            dpid += 1
+            access.append(dpid)
+            graph.add_edge(d1, dpid)
+            graph.add_edge(d2, dpid)
+            for h in range(hosts_per_access):
+                mac += 1
+                graph.add_edge(dpid, str(int2mac(mac)), port=10 + h)
+    if ofnexus is not None:
+        for n in graph.nodes():
+            if not isinstance(n, str):
+                graph.node[n]['connection'] = ofnexus.connect(n)
+    return graph, core_dpids, dist, access
+
+
+def dhcp_packet(mac, msg_type, xid, requested=None, ciaddr=None,
+                server=None, broadcast=True):
+    '''
+    Build a parsed client DHCP packet the way it would arrive in a PacketIn.
+    '''
+
+    # reparse so the handlers see exactly what a switch would send up
+    return pkt.ethernet(dhcp_frame(mac, msg_type, xid, requested, ciaddr,
+                                   server, broadcast))
+
+
+def dhcp_frame(mac, msg_type, xid, requested=None, ciaddr=None,
+               server=None, broadcast=True):
+    '''
+    Build the raw frame of a client DHCP packet.
+    '''
+
+    d = pkt.dhcp()
+    d.op = d.BOOTREQUEST
+    d.htype = 1
+    d.hlen = 6
+    d.xid = xid
+    d.chaddr = mac
+    if broadcast:
+        d.flags |= d.BROADCAST_FLAG
+    if ciaddr is not None:
+        d.ciaddr = ciaddr
+    d.add_option(pkt.DHCP.DHCPMsgTypeOption(msg_type))
+    if requested is not None:
+        d.add_option(pkt.DHCP.DHCPRequestIPOption(requested))
+    d.add_option(pkt.DHCP.DHCPParameterRequestOption(
+        [d.SUBNET_MASK_OPT, d.ROUTERS_OPT, d.DNS_SERVER_OPT]))
+
+    u = pkt.udp(srcport=pkt.dhcp.CLIENT_PORT, dstport=pkt.dhcp.SERVER_PORT)
+    u.payload = d
+    ip = pkt.ipv4(srcip=ciaddr or IP_ANY, dstip=server or IP_BROADCAST)
+    ip.protocol = ip.UDP_PROTOCOL
+    ip.payload = u
+    eth = pkt.ethernet(src=mac, dst=pkt.ETHERNET.ETHER_BROADCAST,
+                       type=pkt.ethernet.IP_TYPE)
+    eth.payload = ip
+    return eth.pack()
+
+
+def parse_reply(msg):
+    "Return (message type, yiaddr) of a DHCP packet_out, or (None, None)."
+    data = msg.data if hasattr(msg, 'data') else msg
+    d = pkt.ethernet(data).find('dhcp')
+    if d is None:
+        return None, None
+    t = d.options.get(d.MSG_TYPE_OPT)
+    return (t.type if t is not None else None), d.yiaddr
+
+
+def reply_options(data):
+    "Return {option code: raw value} of a packed DHCP reply frame."
+    opts = {}
+    i = 282  # options follow the Ethernet/IPv4/UDP/BOOTP headers
+    while i < len(data):
+        code = ord(data[i:i + 1])
+        if code == 255:
+            break
+        if code == 0:
+            i += 1
+            continue
+        size = ord(data[i + 1:i + 2])
+        opts[code] = data[i + 2:i + 2 + size]
+        i += 2 + size
+    return opts
+
+
+def reply_times(msg):
+    '''
+    Return the (lease, renewal, rebinding) times in a DHCP packet_out.
+    Missing options are None.
+    '''
+
+    data = msg.data if hasattr(msg, 'data') else msg
+    opts = reply_options(data)
+
+    def seconds(code):
+        if len(opts.get(code, b'')) != 4:
+            return None
+        return struct.unpack('!I', opts[code])[0]
+
+    return seconds(51), seconds(58), seconds(59)
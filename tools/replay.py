@@ -0,0 +1,351 @@
+#!/usr/bin/python
+
+# Offline replay of a trace recorded with sd-mcan's --record=<file> (see
+# modules/recorder.py). Brings dhcp_server and topology_tracker up with the
+# settings the trace was recorded with, and route_manager once dhcp_server
+# is serving, then feeds them the recorded ConnectionUp/Down, packet-in,
+# port status and link events through a stand-in core.openflow and
+# discovery. Nothing is sent anywhere: connections pack what they are
+# given, as a real connection would, and count the OpenFlow messages in it.
+#
+# The modules run on a simulated clock set to each event's recorded time,
+# so their timers fire as they did when the trace was made. By default
+# events are replayed as fast as possible; --speed 1 replays them at the
+# recorded speed, --speed 10 ten times faster.
+#
+# Reports events per second, the latency of each handler (a handler that
+# raises events of its own includes the time their listeners take) and of
+# each kind of event as a whole, and the messages that would have gone to
+# the switches.
+
+# Usage: python replay.py TRACE [--speed X] [--option key=value] [--json FILE]
+
+import offline
+from offline import core, of, percentiles
+
+import dhcp_server
+import recorder
+import route_manager
+import topology_tracker as tt
+from pox.lib.revent import EventMixin
+from pox.openflow import (ConnectionUp, ConnectionDown, PacketIn, PortStatus,
+                          FlowStatsReceived)
+from pox.openflow.discovery import Link, LinkEvent
+
+import argparse
+import json
+import struct
+import sys
+import time
+from timeit import default_timer as timer
+
+OFP_HEADER = struct.Struct('!BBHI')
+FLOW_MOD_COMMAND = struct.Struct('!H')
+FLOW_MOD_COMMAND_OFFSET = 56  # header, match and cookie
+
+MESSAGES = {of.OFPT_FLOW_MOD: 'flow_mod', of.OFPT_PACKET_OUT: 'packet_out',
+            of.OFPT_STATS_REQUEST: 'stats_request',
+            of.OFPT_BARRIER_REQUEST: 'barrier_request'}
+COMMANDS = {of.OFPFC_ADD: 'add', of.OFPFC_MODIFY: 'modify',
+            of.OFPFC_MODIFY_STRICT: 'modify_strict',
+            of.OFPFC_DELETE: 'delete', of.OFPFC_DELETE_STRICT: 'delete_strict'}
+
+
+def count_messages(data, counts):
+    "Add the OpenFlow messages in data to counts, flow_mods by command."
+    i = 0
+    while i + OFP_HEADER.size <= len(data):
+        _, kind, length, _ = OFP_HEADER.unpack_from(data, i)
+        name = MESSAGES.get(kind, 'type %i' % kind)
+        counts[name] = counts.get(name, 0) + 1
+        if kind == of.OFPT_FLOW_MOD:
+            command = FLOW_MOD_COMMAND.unpack_from(
+                data, i + FLOW_MOD_COMMAND_OFFSET)[0]
+            name = 'flow_mod ' + COMMANDS.get(command, str(command))
+            counts[name] = counts.get(name, 0) + 1
+        if length < OFP_HEADER.size:
+            break
+        i += length
+
+
+class ReplayConnection(offline.FakeConnection):
+    "A connection that packs what it is sent and counts the messages."
+
+    def __init__(self, dpid, features):
+        offline.FakeConnection.__init__(self, dpid)
+        self.features = features
+        # port number -> ofp_phy_port, kept up to date from port status
+        # the way POX keeps connection.ports
+        self.ports = dict((p.port_no, p) for p in features.ports)
+        self.messages = {}
+
+    def send(self, data):
+        offline.FakeConnection.send(self, data)
+        if not isinstance(data, bytes):
+            data = data.pack()
+        count_messages(data, self.messages)
+
+
+class ReplayOpenFlow(offline.FakeOpenFlow):
+    "Stands in for core.openflow and raises the recorded events."
+
+    _eventMixin_events = set([ConnectionUp, ConnectionDown, PacketIn,
+                              PortStatus, FlowStatsReceived])
+
+
+class ReplayDiscovery(EventMixin):
+    "Stands in for core.openflow_discovery."
+
+    _eventMixin_events = set([LinkEvent])
+
+
+def timed(handler, samples):
+    "Wrap a listener so its run time is appended to samples."
+    def run(*args, **kw):
+        t = timer()
+        try:
+            return handler(*args, **kw)
+        finally:
+            samples.append(timer() - t)
+    run.timed = True
+    return run
+
+
+def handler_name(handler):
+    owner = getattr(handler, '__self__', None)
+    if owner is None:
+        return handler.__name__
+    return '%s.%s' % (type(owner).__name__, handler.__name__)
+
+
+def time_handlers(source, event_type, times):
+    '''
+    Wrap the listeners source has for event_type so their run times are
+    kept in times (handler name -> samples). Listeners added since the
+    last call are picked up.
+    '''
+    handlers = getattr(source, '_eventMixin_handlers', {}).get(event_type)
+    for i, (priority, handler, once, eid) in enumerate(handlers or ()):
+        if not getattr(handler, 'timed', False):
+            samples = times.setdefault(handler_name(handler), [])
+            handlers[i] = (priority, timed(handler, samples), once, eid)
+
+
+class Replay(object):
+    '''
+    The controller modules on a simulated clock, fed from a trace.
+    '''
+
+    def __init__(self, config, start):
+        self.clock = offline.SimClock(start)
+        for module in (tt, dhcp_server, route_manager):
+            self.clock.patch(module)
+        self.nexus = ReplayOpenFlow()
+        core.register('openflow', self.nexus)
+        self.discovery = ReplayDiscovery()
+        core.register('openflow_discovery', self.discovery)
+
+        def opt(name, default=None):
+            value = config.get(name)
+            return default if value is None else value
+
+        dhcp_server.launch(network=opt('network', '192.168.0.0/24'),
+                           lease_time=opt('lease_time', dhcp_server.timeoutSec[
+                               'leaseInterval']),
+                           lease_jitter=opt('lease_jitter', 0.0),
+                           adaptive_leases=opt('adaptive_leases', False),
+                           core_mode=opt('core_mode', 'clique'),
+                           core_dpids=opt('core_dpids', ''),
+                           clique_timeout=opt('clique_timeout', 1.0),
+                           route_options=dict(
+                               pending_dests=opt('pending_dests',
+                                                 route_manager.PENDING_DESTS),
+                               pending_timeout=opt(
+                                   'pending_timeout',
+                                   route_manager.PENDING_TIMEOUT),
+                               probe_rate=opt('probe_rate',
+                                              route_manager.PROBE_RATE),
+                               probe_source_rate=opt(
+                                   'probe_source_rate',
+                                   route_manager.PROBE_SOURCE_RATE),
+                               advertise_gateway=opt('advertise_gateway',
+                                                     True)))
+        tt.launch(settle=opt('settle'),
+                  expected_switches=opt('expected_switches'),
+                  expected_links=opt('expected_links'),
+                  expected_fingerprint=opt('expected_fingerprint'))
+
+        self.connections = []  # every connection, for the message counts
+        self.events = {}       # kind -> latencies of whole events
+        self.handlers = {}     # handler name -> latencies
+        self.timers = 0.0      # seconds spent in timers
+        self.skipped = 0       # events for switches that weren't connected
+
+    def event(self, kind, dpid, payload):
+        '''
+        Build the event for a record and the object that raises it, or
+        (None, None).
+        '''
+        if kind in (recorder.LINK_UP, recorder.LINK_DOWN):
+            link = Link(*recorder.LINK.unpack(payload))
+            return self.discovery, LinkEvent(kind == recorder.LINK_UP, link)
+        if kind == recorder.CONNECTION_UP:
+            features = of.ofp_features_reply()
+            features.unpack(payload)
+            con = ReplayConnection(dpid, features)
+            self.connections.append(con)
+            self.nexus.connections[dpid] = con
+            return self.nexus, ConnectionUp(con, features)
+        con = self.nexus.connections.get(dpid)
+        if con is None:
+            return None, None
+        if kind == recorder.CONNECTION_DOWN:
+            del self.nexus.connections[dpid]
+            return self.nexus, ConnectionDown(con)
+        if kind == recorder.PACKET_IN:
+            msg = of.ofp_packet_in()
+            msg.unpack(payload)
+            return self.nexus, PacketIn(con, msg)
+        if kind == recorder.PORT_STATUS:
+            msg = of.ofp_port_status()
+            msg.unpack(payload)
+            if msg.reason == of.OFPPR_DELETE:
+                con.ports.pop(msg.desc.port_no, None)
+            else:
+                con.ports[msg.desc.port_no] = msg.desc
+            return self.nexus, PortStatus(con, msg)
+        return None, None
+
+    def deliver(self, when, kind, dpid, payload):
+        t = timer()
+        self.clock.run(when)
+        self.timers += timer() - t
+
+        source, event = self.event(kind, dpid, payload)
+        if event is None:
+            self.skipped += 1
+            return
+        time_handlers(source, type(event), self.handlers)
+        t = timer()
+        source.raiseEventNoErrors(event)
+        self.events.setdefault(recorder.KINDS[kind], []).append(timer() - t)
+
+    def messages(self):
+        counts = {}
+        for con in self.connections:
+            for name, n in con.messages.iteritems():
+                counts[name] = counts.get(name, 0) + n
+        return counts
+
+    def state(self):
+        tracker = core.topology_tracker
+        dhcp = core.dhcp_server
+        switches = [n for n in tracker.graph if not isinstance(n, str)]
+        state = dict(switches=len(switches), links=tracker.num_links,
+                     hosts=len(tracker.hosts), stable=tracker.stable,
+                     serving=dhcp.plan is not None,
+                     leases=sum(len(l) for l in dhcp.leases.itervalues()))
+        if core.hasComponent('route_manager'):
+            routes = core.route_manager
+            state.update(path_rules=len(routes.path_rules),
+                         labels=len(routes.label_table),
+                         pending=dict(routes.pending_stats),
+                         gateway=dict(routes.gateway_stats))
+        return state
+
+
+def latency_table(title, samples):
+    "Rows of {name, calls, p50/p99/max in microseconds, total in ms}."
+    rows = []
+    for name, s in sorted(samples.iteritems()):
+        if not s:
+            continue
+        p = percentiles(s)
+        rows.append(dict(name=name, calls=len(s), p50_us=p[50] * 1e6,
+                         p99_us=p[99] * 1e6, max_us=max(s) * 1e6,
+                         total_ms=sum(s) * 1e3))
+    print('%-46s %8s %10s %10s %10s %10s' % (
+        title, 'calls', 'p50', 'p99', 'max', 'total'))
+    for r in rows:
+        print('%-46s %8i %8.1fus %8.1fus %8.1fus %8.1fms' % (
+            r['name'], r['calls'], r['p50_us'], r['p99_us'], r['max_us'],
+            r['total_ms']))
+    return rows
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Offline replay of a '
+                                     'recorded packet-in trace')
+    parser.add_argument('trace', help='trace written by sd-mcan --record')
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help='replay speed relative to the recording; 0 '
+                        'replays as fast as possible')
+    parser.add_argument('--option', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='override a recorded controller setting, '
+                        'e.g. settle=2')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv)
+
+    offline.quiet()
+    with open(args.trace, 'rb') as f:
+        config, records = recorder.read_trace(f)
+        for option in args.option:
+            key, _, value = option.partition('=')
+            config[key] = value
+        replay = None
+        count = 0
+        first = last = None
+        start = timer()
+        for when, kind, dpid, payload in records:
+            if replay is None:
+                first = when
+                replay = Replay(config, when)
+                start = timer()
+            if args.speed > 0:
+                wait = start + (when - first) / args.speed - timer()
+                if wait > 0:
+                    time.sleep(wait)
+            replay.deliver(when, kind, dpid, payload)
+            count += 1
+            last = when
+        elapsed = timer() - start
+    if replay is None:
+        print('%s holds no events' % args.trace)
+        return
+
+    busy = sum(sum(s) for s in replay.events.itervalues()) + replay.timers
+    print('%i events over %.1fs recorded, replayed in %.2fs: %.0f events/s, '
+          '%.0f events/s of handler time' % (
+              count, last - first, elapsed, count / elapsed,
+              count / busy if busy else 0.0))
+    if replay.skipped:
+        print('%i events for switches that were not connected' %
+              replay.skipped)
+    print('')
+    events = latency_table('event', replay.events)
+    print('')
+    handlers = latency_table('handler', replay.handlers)
+    print('timers: %.1fms' % (replay.timers * 1e3))
+    print('')
+    messages = replay.messages()
+    for name in sorted(messages):
+        print('%-24s %8i' % (name, messages[name]))
+    state = replay.state()
+    print('')
+    print('end state: %s' % ', '.join('%s=%s' % (k, state[k])
+                                      for k in sorted(state)))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(args=vars(args), config=config, events=count,
+                           recorded_s=last - first, elapsed_s=elapsed,
+                           events_per_s=count / elapsed,
+                           skipped=replay.skipped, event_latency=events,
+                           handler_latency=handlers,
+                           timers_ms=replay.timers * 1e3,
+                           messages=messages, state=state), f, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
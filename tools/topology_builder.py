@@ -2,78 +2,37 @@
 
 # Script to create mininet topologies
 # 2017 Adam Calabrigo
+#
+# Writes topos/<num switches>_<num hosts>.json: a spec for a star of
+# <num switches> switches around a centre switch, with the hosts spread
+# over them, expanded by topology_spec.py. Run it with
+#   sudo python topology_spec.py mininet topos/<num switches>_<num hosts>.json
 
 import sys
+
+import topology_spec
+
 if len(sys.argv) <= 2:
-    print("Usage: ./topology_builder.py <num switches> <num hosts> <bandwidth>")
+    print("Usage: ./topology_builder.py <num switches> <num hosts> [bandwidth]")
     exit()
 
 switches = int(sys.argv[1])
 hosts = int(sys.argv[2])
 
-outfile = 'topos/{0}_{1}.py'.format(switches, hosts)
-offset = 0
+outfile = 'topos/{0}_{1}.json'.format(switches, hosts)
 
 hosts_per_switch = hosts // switches
 extra_hosts = hosts % switches
 
 print('hosts per edge switches: {0} with {1} extra'.format(hosts_per_switch,
                                                             extra_hosts))
-with open(outfile, 'w') as f:
-    # add imports
-    f.write('#!/usr/bin/python\n')
-    f.write('from mininet.topo import Topo\n')
-    f.write('from mininet.net import Mininet\n')
-    f.write('from mininet.node import Controller, RemoteController, OVSKernelSwitch, UserSwitch\n')
-    f.write('from mininet.cli import CLI\n')
-    f.write('from mininet.log import setLogLevel\n')
-    f.write('from mininet.link import Link, TCLink\n')
-    f.write('import time\n')
-
-    # start topo class, add controller
-    f.write('\n\nclass Topology(Topo):\n')
-    f.write('  def build(self, **_opts):\n')
-    #f.write("  c0 = net.addController('c0', controller=RemoteController, ip='127.0.0.1', port=6633)\n\n")
-
-    # add switches
-    for n in range(0, switches + 1):
-        f.write("    s{0} = self.addSwitch('s{0}')\n".format(n))
-
-    # add hosts
-    f.write('\n')
-    for n in range(0, hosts):
-        f.write("    h{0} = self.addHost('h{0}', ip=None)\n".format(n))
-
-    # add links from center to switches
-    f.write('\n')
-    for n in range(1, switches + 1):
-        f.write("    self.addLink(s0, s{0})\n".format(n))
-
-    f.write('\n')
-    for n in range(1, switches + 1):
-        for m in range(0, hosts_per_switch):
-            f.write("    self.addLink(s{0}, h{1})\n".format(n, m + offset))
-        offset += hosts_per_switch
-
-    for n in range(1, extra_hosts + 1):
-        f.write("    self.addLink(s{0}, h{1})\n".format(n, n - 1 + offset))
-
-    f.write("\ndef run():\n")
-    f.write("  topo = Topology()\n")
-    f.write("  net = Mininet(topo=topo, controller=RemoteController, link=TCLink, switch=OVSKernelSwitch)\n")
-    f.write("  net.start()\n")
-    f.write("  time.sleep(10)\n")
-    f.write("  print('Establishing h0')\n")
-    f.write("  net.hosts[0].cmd('ping -c1 %s' % net.hosts[1].IP())\n")
-    f.write("  for n in range(1, len(net.hosts)):\n")
-    f.write("    print('Establishing h{0}'.format(n))\n")
-    f.write("    net.hosts[n].cmd('ping -c1 %s' % net.hosts[n - 1].IP())\n")
-    f.write("    net.hosts[0].cmd('ping -c1 %s' % net.hosts[n].IP())\n")
-    f.write("  net.pingAll()\n")
-    f.write("  net.pingAll()\n")
-    f.write("  CLI(net)\n")
-    f.write("  net.stop()\n\n")
-
-    f.write("if __name__ == '__main__':\n")
-    f.write("  setLogLevel('info')\n")
-    f.write("  run()\n")
+spec = {'core': {'switches': 1},
+        'distribution': {'per_core': switches},
+        'hosts': {'count': hosts}}
+if len(sys.argv) > 3:
+    bw = int(sys.argv[3])
+    spec['links'] = dict((kind, {'bw': bw}) for kind in
+                         ('core', 'edge', 'host'))
+topology = topology_spec.generate(spec)
+topology.save(outfile)
+print('{0} written to {1}'.format(topology.summary(), outfile))
@@ -0,0 +1,436 @@
+#!/usr/bin/python
+
+# Declarative topologies for SD-MCAN tests and benchmarks.
+#
+# A spec is a small JSON document describing a campus by its shape rather
+# than switch by switch:
+#
+#   {"core":         {"switches": 5},
+#    "distribution": {"per_core": 1, "uplinks": 1, "pairs": false},
+#    "edge":         {"lans": 5, "shape": "chain", "size": 5},
+#    "hosts":        {"per_switch": 0, "count": 40, "mobile": 0.5},
+#    "mobility":     {"pattern": "random", "interval": 5.0},
+#    "links":        {"core": {"bw": 1000, "delay": "1ms"},
+#                     "edge": {"bw": 1000, "delay": "1ms"},
+#                     "host": {"bw": 100, "delay": "1ms"}}}
+#
+# The core is a full mesh. Each core switch gets per_core distribution
+# switches, each wired to uplinks core switches, and with pairs the
+# distribution switches are linked two by two. Edge LANs hang off the
+# distribution switches in turn and are shaped as:
+#
+#   chain - the first switch on the distribution switch, the rest in a line
+#           behind it (load_test.py's SupportTopo)
+#   star  - the first switch on the distribution switch, the rest on it
+#   dual  - every switch on two distribution switches (pod_campus_graph)
+#
+# Hosts go on the leaf switches: the edge switches, or the distribution
+# switches when there are no LANs. A fraction of them is mobile, and moves
+# every interval seconds to a random leaf ("random") or along a path of
+# dpids ("walk"). Anything left out takes its value from DEFAULTS, and
+# PRESETS holds the topologies the tests used to hard-code.
+#
+# generate() expands a spec into switches, links and hosts; a 5000 switch
+# campus takes well under a second. The expanded topology is saved with
+# its spec, and load() reads either. A Topology drives Mininet (mininet()),
+# the offline simulator and benchmarks (graph(), which builds the networkx
+# graph topology_tracker would) and mobility scripts (moves()).
+
+# Usage:
+#   python topology_spec.py generate [--preset NAME] [--core N] ... -o FILE
+#   python topology_spec.py info FILE
+#   sudo python topology_spec.py mininet FILE
+
+import argparse
+import copy
+import json
+import random
+import sys
+from timeit import default_timer as timer
+
+VERSION = 1
+
+DEFAULTS = {
+    'core': {'switches': 5},
+    'distribution': {'per_core': 1, 'uplinks': 1, 'pairs': False},
+    'edge': {'lans': 0, 'shape': 'chain', 'size': 5},
+    'hosts': {'per_switch': 0, 'count': 0, 'mobile': 0.0},
+    'mobility': {'pattern': 'none', 'interval': 5.0, 'path': []},
+    'links': {'core': {'bw': 1000, 'delay': '1ms'},
+              'edge': {'bw': 1000, 'delay': '1ms'},
+              'host': {'bw': 100, 'delay': '1ms'}},
+    'seed': 0,
+}
+
+PRESETS = {
+    # tests/scale_tests/load_test.py
+    'support': {'core': {'switches': 5},
+                'edge': {'lans': 5, 'shape': 'chain', 'size': 5}},
+    # topos/walk_topo.py, hosts on s6 and s7
+    'walk': {'core': {'switches': 5},
+             'hosts': {'count': 2, 'mobile': 0.5},
+             'mobility': {'pattern': 'walk', 'path': [8, 9, 10, 7]}},
+    # topos/mobility_topo.py
+    'mobility': {'core': {'switches': 3},
+                 'hosts': {'count': 2, 'mobile': 0.5},
+                 'mobility': {'pattern': 'walk', 'path': [5, 6, 4]}},
+    # a large campus for controller benchmarks
+    'campus': {'core': {'switches': 10},
+               'distribution': {'per_core': 20, 'uplinks': 2, 'pairs': True},
+               'edge': {'lans': 600, 'shape': 'dual', 'size': 8},
+               'hosts': {'per_switch': 2, 'mobile': 0.1},
+               'mobility': {'pattern': 'random', 'interval': 5.0}},
+}
+
+SHAPES = ('chain', 'star', 'dual')
+PATTERNS = ('none', 'random', 'walk')
+
+
+def int2dpid(dpid):
+    "Mininet's 16 hex digit datapath ID for dpid."
+    return '%016x' % dpid
+
+
+def int2mac(n):
+    "Locally administered MAC address for host number n."
+    return '02:%02x:%02x:%02x:%02x:%02x' % (
+        (n >> 32) & 0xff, (n >> 24) & 0xff, (n >> 16) & 0xff,
+        (n >> 8) & 0xff, n & 0xff)
+
+
+def merge(base, over):
+    "base with the keys in over replaced, recursively."
+    out = copy.deepcopy(base)
+    for k, v in over.items():
+        if isinstance(v, dict) and isinstance(out.get(k), dict):
+            out[k] = merge(out[k], v)
+        else:
+            out[k] = v
+    return out
+
+
+def normalize(spec):
+    '''
+    A spec with every default filled in and its values checked. A spec
+    may name a preset to start from with "preset".
+    '''
+    spec = dict(spec)
+    preset = spec.pop('preset', None)
+    if preset is not None:
+        if preset not in PRESETS:
+            raise ValueError('unknown preset %r, expected one of %s' %
+                             (preset, ', '.join(sorted(PRESETS))))
+        spec = merge(PRESETS[preset], spec)
+    spec = merge(DEFAULTS, spec)
+    if spec['core']['switches'] < 1:
+        raise ValueError('need at least one core switch')
+    if spec['edge']['shape'] not in SHAPES:
+        raise ValueError('edge shape must be one of ' + ', '.join(SHAPES))
+    if spec['edge']['lans'] and spec['edge']['size'] < 1:
+        raise ValueError('edge LANs need at least one switch')
+    if spec['mobility']['pattern'] not in PATTERNS:
+        raise ValueError('mobility pattern must be one of ' +
+                         ', '.join(PATTERNS))
+    if not 0.0 <= spec['hosts']['mobile'] <= 1.0:
+        raise ValueError('the mobile fraction of hosts is between 0 and 1')
+    return spec
+
+
+class Topology(object):
+    '''
+    An expanded spec: switches as {dpid: role}, links as (a, b, kind)
+    with kind 'core' or 'edge', and hosts as (name, mac, dpid, mobile).
+    '''
+
+    def __init__(self, spec, switches, links, hosts):
+        self.spec = spec
+        self.switches = switches
+        self.links = links
+        self.hosts = hosts
+
+    def role(self, role):
+        return sorted(d for d, r in self.switches.items() if r == role)
+
+    @property
+    def core(self):
+        return self.role('core')
+
+    @property
+    def distribution(self):
+        return self.role('distribution')
+
+    @property
+    def edge(self):
+        return self.role('edge')
+
+    @property
+    def leaves(self):
+        "The switches hosts go on."
+        return self.edge or self.distribution or self.core
+
+    def to_dict(self):
+        return {'version': VERSION, 'spec': self.spec,
+                'switches': sorted(self.switches.items()),
+                'links': self.links, 'hosts': self.hosts}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, separators=(',', ':'))
+
+    def summary(self):
+        return ('%i switches (%i core, %i distribution, %i edge), %i links, '
+                '%i hosts (%i mobile)' % (
+                    len(self.switches), len(self.core),
+                    len(self.distribution), len(self.edge), len(self.links),
+                    len(self.hosts), sum(1 for h in self.hosts if h[3])))
+
+    def graph(self, ofnexus=None, hosts=False):
+        '''
+        The networkx graph topology_tracker would build: int dpids for
+        switches and, with hosts, MAC string nodes on numbered ports past
+        the switch ports. If ofnexus is given, every switch gets a
+        connection from it, as in tools/offline.py.
+        '''
+        import networkx as nx
+        graph = nx.Graph()
+        graph.add_nodes_from(self.switches)
+        graph.add_edges_from((a, b) for a, b, _ in self.links)
+        if hosts:
+            ports = {}
+            for name, mac, dpid, mobile in self.hosts:
+                port = ports[dpid] = ports.get(dpid, graph.degree(dpid)) + 1
+                graph.add_edge(dpid, mac, port=port)
+        if ofnexus is not None:
+            for dpid in self.switches:
+                graph.node[dpid]['connection'] = ofnexus.connect(dpid)
+        return graph
+
+    def mininet(self):
+        '''
+        A Mininet Topo of this topology. Switches are named s<dpid> and
+        hosts come up without an address, for DHCP.
+        '''
+        from mininet.topo import Topo
+        topology = self
+        links = self.spec['links']
+
+        class SpecTopo(Topo):
+            def build(self, **_opts):
+                for dpid in sorted(topology.switches):
+                    self.addSwitch('s%i' % dpid, dpid=int2dpid(dpid))
+                for a, b, kind in topology.links:
+                    self.addLink('s%i' % a, 's%i' % b, **links[kind])
+                for name, mac, dpid, mobile in topology.hosts:
+                    self.addHost(name, ip=None, mac=mac)
+                    self.addLink(name, 's%i' % dpid, **links['host'])
+
+        return SpecTopo()
+
+    def moves(self, duration, seed=None):
+        '''
+        The moves the mobility pattern makes in duration seconds, as
+        (time, host name, new dpid), in time order.
+        '''
+        mobility = self.spec['mobility']
+        pattern, interval = mobility['pattern'], mobility['interval']
+        mobile = [(name, dpid) for name, mac, dpid, m in self.hosts if m]
+        if pattern == 'none' or not mobile or interval <= 0:
+            return []
+        rng = random.Random(self.spec['seed'] if seed is None else seed)
+        leaves = self.leaves
+        path = mobility['path'] or leaves
+        where = dict(mobile)
+        step = dict((name, path.index(dpid) if dpid in path else -1)
+                    for name, dpid in mobile)
+        out = []
+        t = interval
+        while t <= duration:
+            for name, _ in mobile:
+                if pattern == 'walk':
+                    step[name] = (step[name] + 1) % len(path)
+                    new = path[step[name]]
+                else:
+                    new = rng.choice(leaves)
+                    if new == where[name] and len(leaves) > 1:
+                        new = leaves[(leaves.index(new) + 1) % len(leaves)]
+                where[name] = new
+                out.append((t, name, new))
+            t += interval
+        return out
+
+
+def generate(spec):
+    '''
+    Expand a spec into a Topology. Switches are numbered core first, then
+    distribution, then edge, from 1.
+    '''
+    spec = normalize(spec)
+    switches = {}
+    links = []
+
+    n = spec['core']['switches']
+    core = list(range(1, n + 1))
+    for dpid in core:
+        switches[dpid] = 'core'
+    for i in range(n):
+        for j in range(i + 1, n):
+            links.append((core[i], core[j], 'core'))
+    dpid = n
+
+    d = spec['distribution']
+    uplinks = max(1, min(d['uplinks'], n))
+    dist = []
+    for i in range(n * d['per_core']):
+        dpid += 1
+        dist.append(dpid)
+        switches[dpid] = 'distribution'
+        for k in range(uplinks):
+            links.append((core[(i + k) % n], dpid, 'core'))
+    if d['pairs']:
+        for i in range(0, len(dist) - 1, 2):
+            links.append((dist[i], dist[i + 1], 'core'))
+
+    e = spec['edge']
+    uplink = dist or core
+    edge = []
+    for lan in range(e['lans']):
+        up = uplink[lan % len(uplink)]
+        second = uplink[(lan + 1) % len(uplink)]
+        first = dpid + 1
+        for k in range(e['size']):
+            dpid += 1
+            edge.append(dpid)
+            switches[dpid] = 'edge'
+            if e['shape'] == 'dual':
+                links.append((up, dpid, 'edge'))
+                if second != up:
+                    links.append((second, dpid, 'edge'))
+            elif k == 0:
+                links.append((up, dpid, 'edge'))
+            elif e['shape'] == 'chain':
+                links.append((dpid - 1, dpid, 'edge'))
+            else:
+                links.append((first, dpid, 'edge'))
+
+    h = spec['hosts']
+    leaves = edge or dist or core
+    places = []
+    for dpid in leaves:
+        places.extend([dpid] * h['per_switch'])
+    for i in range(h['count']):
+        places.append(leaves[i % len(leaves)])
+    # mobile hosts are spread evenly over the hosts, so walk's h2 moves
+    f = h['mobile']
+    hosts = [('h%i' % (i + 1), int2mac(i + 1), dpid,
+              int((i + 1) * f) > int(i * f))
+             for i, dpid in enumerate(places)]
+    return Topology(spec, switches, links, hosts)
+
+
+def load(path):
+    '''
+    Read a Topology from a file holding an expanded topology or just a
+    spec, which is then generated.
+    '''
+    with open(path) as f:
+        data = json.load(f)
+    if 'switches' not in data:
+        return generate(data.get('spec', data))
+    if data.get('version') != VERSION:
+        raise ValueError('%s is version %s, expected %i' %
+                         (path, data.get('version'), VERSION))
+    return Topology(data['spec'], dict(data['switches']),
+                    [tuple(l) for l in data['links']],
+                    [(str(name), str(mac), dpid, mobile)
+                     for name, mac, dpid, mobile in data['hosts']])
+
+
+def run_mininet(topology, controller, port):
+    "Start the topology in Mininet against a remote controller."
+    from mininet.cli import CLI
+    from mininet.link import TCLink
+    from mininet.log import setLogLevel
+    from mininet.net import Mininet
+    from mininet.node import RemoteController
+
+    setLogLevel('info')
+    net = Mininet(topo=topology.mininet(), link=TCLink, build=False,
+                  controller=None)
+    net.addController(RemoteController('c0', ip=controller, port=port))
+    net.build()
+    net.start()
+    CLI(net)
+    net.stop()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Generate and load '
+                                     'declarative SD-MCAN topologies')
+    sub = parser.add_subparsers(dest='command')
+
+    g = sub.add_parser('generate', help='write a topology from a spec')
+    g.add_argument('--preset', choices=sorted(PRESETS))
+    g.add_argument('--spec', help='JSON spec to start from')
+    g.add_argument('--core', type=int, help='core mesh size')
+    g.add_argument('--per-core', type=int,
+                   help='distribution switches per core switch')
+    g.add_argument('--uplinks', type=int,
+                   help='core switches each distribution switch is wired to')
+    g.add_argument('--lans', type=int, help='edge LANs')
+    g.add_argument('--shape', choices=SHAPES, help='edge LAN shape')
+    g.add_argument('--size', type=int, help='switches per edge LAN')
+    g.add_argument('--hosts', type=int, help='hosts per leaf switch')
+    g.add_argument('--mobile', type=float, help='fraction of mobile hosts')
+    g.add_argument('--seed', type=int)
+    g.add_argument('--spec-only', action='store_true',
+                   help='write the spec alone, to be generated on load')
+    g.add_argument('-o', '--output', required=True)
+
+    i = sub.add_parser('info', help='summarize a topology')
+    i.add_argument('path')
+
+    m = sub.add_parser('mininet', help='run a topology in Mininet')
+    m.add_argument('path')
+    m.add_argument('--controller', default='127.0.0.1')
+    m.add_argument('--port', type=int, default=6633)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'generate':
+        spec = {}
+        if args.spec:
+            with open(args.spec) as f:
+                spec = json.load(f)
+        if args.preset:
+            spec['preset'] = args.preset
+        for section, key, value in (
+                ('core', 'switches', args.core),
+                ('distribution', 'per_core', args.per_core),
+                ('distribution', 'uplinks', args.uplinks),
+                ('edge', 'lans', args.lans), ('edge', 'shape', args.shape),
+                ('edge', 'size', args.size),
+                ('hosts', 'per_switch', args.hosts),
+                ('hosts', 'mobile', args.mobile)):
+            if value is not None:
+                spec.setdefault(section, {})[key] = value
+        if args.seed is not None:
+            spec['seed'] = args.seed
+        t = timer()
+        topology = generate(spec)
+        elapsed = timer() - t
+        if args.spec_only:
+            with open(args.output, 'w') as f:
+                json.dump(topology.spec, f, indent=2, sort_keys=True)
+        else:
+            topology.save(args.output)
+        print('%s, generated in %.2fs' % (topology.summary(), elapsed))
+    elif args.command == 'info':
+        t = timer()
+        topology = load(args.path)
+        print('%s, loaded in %.2fs' % (topology.summary(), timer() - t))
+    elif args.command == 'mininet':
+        run_mininet(load(args.path), args.controller, args.port)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
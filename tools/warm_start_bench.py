@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# Offline warm start benchmark. Brings dhcp_server, topology_tracker and
+# route_manager up on a synthetic campus twice:
+#
+#   cold - plans from scratch once the topology is stable, then saves the
+#          plan with plan_cache
+#   warm - a restarted controller finds the topology matches the saved
+#          fingerprint and serves on the saved plan
+#
+# and then boots one host through DHCP. Reports the time from the last link
+# being discovered to the first DHCP ACK, the part of it spent planning,
+# the path rules sent and whether the warm start came up with the same
+# labels and path rules. The cold time includes --check-interval, the
+# stability wait a warm start skips; LLDP discovery itself takes as long
+# either way and is not counted.
+
+# Usage: python warm_start_bench.py [--core N] [--edges N] [--plan FILE]
+
+import offline
+from offline import core, pkt
+
+import dhcp_server
+import plan_cache
+import topology_tracker as tt
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+
+def run(args, mode):
+    '''
+    Bring a controller up in the given mode and ACK one host. Returns a
+    result dict.
+    '''
+
+    nexus = offline.install_core()
+    nexus.connections.clear()
+    graph, _, _ = offline.campus_graph(args.core, args.edges, nexus)
+    offline.add_links(graph)
+    controller = offline.Controller(graph, args.network, args.lease)
+    cache = plan_cache.PlanCache(args.plan)
+
+    t = timer()
+    if mode == 'cold':
+        controller.stable()
+        cache.save(core.route_manager)
+    else:
+        cache._check()
+    serve = timer() - t
+    if controller.dhcp.plan is None:
+        controller.stop()
+        raise RuntimeError('%s start did not serve' % mode)
+    routes = core.route_manager
+
+    t = timer()
+    dpid = sorted(controller.dhcp.edges)[0]
+    mac = offline.int2mac(1)
+    _, offer = controller.dhcp_packet(dpid, 100, mac,
+                                      pkt.dhcp.DISCOVER_MSG, 1)
+    kind, _ = controller.dhcp_packet(dpid, 100, mac, pkt.dhcp.REQUEST_MSG, 2,
+                                     requested=offer)
+    ack = timer() - t
+
+    t = timer()
+    tt.fingerprint(graph)
+    check = timer() - t
+
+    result = dict(mode=mode, switches=len(nexus.connections),
+                  serve_ms=serve * 1000, ack_ms=ack * 1000,
+                  fingerprint_ms=check * 1000,
+                  acked=kind == pkt.dhcp.ACK_MSG,
+                  path_rules=len(routes.path_rules),
+                  flow_mods=sum(con.count for con in nexus.connections.values()),
+                  labels=sorted((tuple(k), v) for k, v in
+                                routes.label_table.iteritems()),
+                  rules=sorted(routes.path_rules))
+    controller.stop()
+    return result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Offline warm start '
+                                     'benchmark')
+    parser.add_argument('--core', type=int, default=4,
+                        help='core mesh size')
+    parser.add_argument('--edges', type=int, default=10,
+                        help='edge switches per core switch')
+    parser.add_argument('--network', default='10.0.0.0/24')
+    parser.add_argument('--lease', type=int,
+                        default=dhcp_server.timeoutSec['leaseInterval'])
+    parser.add_argument('--check-interval', type=float, default=5.0,
+                        help='topology_tracker check_interval; a cold '
+                        'start waits at least this long for a stable '
+                        'topology')
+    parser.add_argument('--plan', help='plan file to use (default: a '
+                        'temporary file)')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv)
+
+    offline.quiet()
+    temporary = args.plan is None
+    if temporary:
+        fd, args.plan = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+    if os.path.exists(args.plan):
+        os.remove(args.plan)
+    try:
+        cold = run(args, 'cold')
+        size = os.path.getsize(args.plan)
+        warm = run(args, 'warm')
+    finally:
+        if temporary and os.path.exists(args.plan):
+            os.remove(args.plan)
+
+    same = cold['labels'] == warm['labels'] and cold['rules'] == warm['rules']
+    print('%i switches, plan file %i bytes' % (cold['switches'], size))
+    print('%-5s %12s %10s %10s %10s %8s' % (
+        'mode', 'first ACK', 'serving', 'ACK', 'rules', 'flow_mods'))
+    for r, wait in ((cold, args.check_interval), (warm, 0.0)):
+        r['first_ack_ms'] = wait * 1000 + r['serve_ms'] + r['ack_ms']
+        print('%-5s %10.1fms %8.1fms %8.2fms %10i %8i' % (
+            r['mode'], r['first_ack_ms'], r['serve_ms'], r['ack_ms'],
+            r['path_rules'], r['flow_mods']))
+        del r['labels'], r['rules']
+    print('first ACK counts from the last link discovered and adds '
+          '--check-interval to the cold start; a fingerprint check takes '
+          '%.2fms' % warm['fingerprint_ms'])
+    print('%s: warm start %s the cold start\'s labels and path rules' % (
+        'OK' if same else 'FAIL', 'matches' if same else 'differs from'))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(args=vars(args), plan_bytes=size, same=same,
+                           results=[cold, warm]), f, indent=2)
+    if not same or not (cold['acked'] and warm['acked']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])